@@ -2,7 +2,11 @@ from PyQt5 import QtCore, QtGui
 import pyqtgraph as pg
 import matplotlib
 import numpy as np
-from pyqtgraph.functions import makeARGB
+
+# Number of colours brushes are quantized to
+BRUSH_BINS = 256
+# Brushes shared between all colour bars with the same colour map, keyed by (cmap_name, cbin)
+_BRUSH_CACHE = {}
 
 
 class ColorBar(pg.GraphicsWidget):
@@ -12,6 +16,7 @@ class ColorBar(pg.GraphicsWidget):
 
         # Create colour map from matplotlib colourmap name
         self.cmap_name = cmap_name
+        self.cbin = cbin
         cmap = matplotlib.cm.get_cmap(self.cmap_name)
         if type(cmap) == matplotlib.colors.LinearSegmentedColormap:
             cbins = np.linspace(0.0, 1.0, cbin)
@@ -25,17 +30,58 @@ class ColorBar(pg.GraphicsWidget):
         self.grad = self.map.getGradient()
 
     def getBrush(self, data, levels=None):
+        """
+        Map data values to brushes. Values are quantized to BRUSH_BINS colours so that all points
+        share at most BRUSH_BINS brush objects, nan values are given a transparent brush
+        :param data: values to map to colours
+        :type data: np.array((npoints))
+        :param levels: values mapped to the extremes of the colour map
+        :type levels: list [min, max]
+        :return brush: brush for each point
+        :type brush: np.array((npoints)) of QtGui.QBrush
+        """
         if levels is None:
-            levels = [np.min(data), np.max(data)]
-        brush_rgb, _ = makeARGB(data[:, np.newaxis], levels=levels, lut=self.lut, useRGBA=True)
-        brush = [QtGui.QColor(*col) for col in np.squeeze(brush_rgb)]
-        return brush
+            levels = [np.nanmin(data), np.nanmax(data)]
+        return self.getBrushLut()[self.getLutIndex(data, levels)]
+
+    def getLutIndex(self, data, levels):
+        """
+        Quantize data values to an index into the brush lookup table
+        """
+        data = np.asarray(data, dtype=float)
+        scale = BRUSH_BINS / (levels[1] - levels[0]) if levels[1] != levels[0] else 0
+        with np.errstate(invalid='ignore'):
+            idx = np.clip((data - levels[0]) * scale, 0, BRUSH_BINS - 1)
+        idx = np.nan_to_num(idx, nan=BRUSH_BINS).astype(int)
+        return idx
+
+    def getBrushLut(self):
+        """
+        Brushes for each colour of the quantized colour map, with an extra transparent brush for
+        nan values. Built once per colour map and shared between colour bars
+        """
+        brushes = _BRUSH_CACHE.get((self.cmap_name, self.cbin))
+        if brushes is None:
+            lut = self.map.getLookupTable(nPts=BRUSH_BINS, alpha=True)
+            brushes = np.empty(BRUSH_BINS + 1, dtype=object)
+            brushes[:BRUSH_BINS] = [QtGui.QBrush(QtGui.QColor(*col)) for col in lut.tolist()]
+            brushes[BRUSH_BINS] = QtGui.QBrush(QtGui.QColor(0, 0, 0, 0))
+            _BRUSH_CACHE[(self.cmap_name, self.cbin)] = brushes
+        return brushes
 
     def getColourMap(self):
         return self.lut
 
-    def makeColourBar(self, width, height, fig, min=0, max=1, label='', lim=False):
-        self.cbar = HorizontalBar(width, height, self.grad)
+    def makeColourBar(self, width, height, fig, min=0, max=1, label='', lim=False, cbar=None):
+        """
+        Set up the axis of fig to display the colour bar. If cbar is given the existing bar is
+        updated with the gradient of this colour map instead of creating a new one
+        """
+        if cbar is None:
+            self.cbar = HorizontalBar(width, height, self.grad)
+        else:
+            self.cbar = cbar
+            self.cbar.setGradient(self.grad)
         ax = fig.getAxis('top')
         ax.setPen('k')
         ax.setTextPen('k')
@@ -65,6 +111,10 @@ class HorizontalBar(pg.GraphicsWidget):
         self.grad = grad
         QtGui.QPainter()
 
+    def setGradient(self, grad):
+        self.grad = grad
+        self.update()
+
     def paint(self, p, *args):
         p.setPen(QtCore.Qt.NoPen)
         self.grad.setStart(0, self.height / 2)
@@ -81,6 +131,10 @@ class VerticalBar(pg.GraphicsWidget):
         self.grad = grad
         QtGui.QPainter()
 
+    def setGradient(self, grad):
+        self.grad = grad
+        self.update()
+
     def paint(self, p, *args):
         p.setPen(QtCore.Qt.NoPen)
         self.grad.setStart(self.width / 2, self.height)
@@ -0,0 +1,319 @@
+"""
+Offline benchmarks of the alignment GUI data processing on synthetic data, see synthetic_data.py.
+
+Each step is timed over a number of repeats and its peak memory is measured. Results can be
+saved as a baseline and later runs compared against it, the comparison fails if any step is
+slower by more than the given threshold.
+
+Usage:
+    python benchmark.py -s 1000000 -c 500 -l NP1.0 --save baseline.json
+    python benchmark.py -s 1000000 -c 500 -l NP1.0 --baseline baseline.json -t 0.2
+"""
+from pathlib import Path
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+import traceback
+
+import numpy as np
+
+import atlaselectrophysiology.plot_data as pd
+from atlaselectrophysiology import synthetic_data
+from atlaselectrophysiology.extract_files import rmsmap, extract_lfpcorr
+
+# Steps faster than this (s) are not checked for regressions as their timings are mostly noise
+MIN_DURATION = 0.01
+
+
+def measure(func, setup=None, repeat=3):
+    """
+    Time a function and measure its peak memory. The timed runs are done without tracing memory
+    so the tracing overhead doesn't affect the timings, the peak memory is measured on an extra
+    run
+    :param func: function to benchmark, called with the output of setup
+    :param setup: function called before each run whose output is passed to func, not timed
+    :param repeat: no. of timed runs
+    :return result: min and median duration (s) and peak memory allocated (MB)
+    :type result: dict
+    """
+    durations = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        t0 = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - t0)
+
+    args = setup() if setup is not None else ()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'duration': float(np.min(durations)), 'median': float(np.median(durations)),
+            'peak_memory': peak / 1024 ** 2}
+
+
+def clear_caches(alf_path):
+    """
+    Remove the RF map and passive response caches the GUI writes into the ALF folder
+    """
+    for file in Path(alf_path).glob('_alignmentgui_*.npz'):
+        file.unlink()
+
+
+def plot_data_benchmarks(alf_path, shank_idx=0, events=None):
+    """
+    Benchmarks of PlotData, each get_* method is run on a newly loaded PlotData, after removing
+    the caches written to the ALF folder, so that no cached data is reused between runs. The
+    passive datasets are expected relative to the ALF folder, see synthetic_data.make_passive
+    :param events: behavioural events for get_psth, see synthetic_data.make_behavioral_events
+    :return benchmarks: name, function and setup function of each benchmark
+    :type benchmarks: list of tuple
+    """
+    def new_plotdata():
+        clear_caches(alf_path)
+        return (pd.PlotData(alf_path, alf_path, shank_idx),)
+
+    def with_stats():
+        clear_caches(alf_path)
+        plotdata = pd.PlotData(alf_path, alf_path, shank_idx)
+        return (plotdata, int(np.argmax(plotdata.get_cluster_stats()['n_spikes'])))
+
+    def with_events():
+        return (*with_stats(), events)
+
+    benchmarks = [
+        ('PlotData.__init__', lambda: pd.PlotData(alf_path, alf_path, shank_idx), None),
+        ('PlotData.get_depth_data_scatter', lambda p: p.get_depth_data_scatter(), new_plotdata),
+        ('PlotData.get_fr_p2t_data_scatter', lambda p: p.get_fr_p2t_data_scatter(),
+         new_plotdata),
+        ('PlotData.get_correlation_data_img', lambda p: p.get_correlation_data_img(),
+         new_plotdata),
+        ('PlotData.get_lfp_corr_cov_data_img',
+         lambda p: p.get_lfp_corr_cov_data_img(if_corr=True), new_plotdata),
+        ('PlotData.get_fr_img', lambda p: p.get_fr_img(), new_plotdata),
+        ('PlotData.get_rms_data_img_probe_AP', lambda p: p.get_rms_data_img_probe('AP'),
+         new_plotdata),
+        ('PlotData.get_rms_data_img_probe_LF', lambda p: p.get_rms_data_img_probe('LF'),
+         new_plotdata),
+        ('PlotData.get_lfp_spectrum_data', lambda p: p.get_lfp_spectrum_data(), new_plotdata),
+        ('PlotData.get_fr_amp_data_line', lambda p: p.get_fr_amp_data_line(), new_plotdata),
+        ('PlotData.get_rfmap_data', lambda p: p.get_rfmap_data(), new_plotdata),
+        ('PlotData.get_passive_events', lambda p: p.get_passive_events(), new_plotdata),
+        ('PlotData.get_autocorr', lambda p, c: p.get_autocorr(c), with_stats),
+        ('PlotData.get_template_wf', lambda p, c: p.get_template_wf(c), with_stats),
+    ]
+    if events is not None:
+        benchmarks.append(('PlotData.get_psth', lambda p, c, e: p.get_psth(c, e), with_events))
+    return benchmarks
+
+
+def extraction_benchmarks(ephys_path):
+    """
+    Benchmarks of the extraction of rms maps and lfp correlation from raw spikeglx files
+    """
+    ephys_path = Path(ephys_path)
+    ap_file = next(ephys_path.glob('*.ap.bin'))
+    lf_file = next(ephys_path.glob('*.lf.bin'))
+    out_path = ephys_path.joinpath('benchmark_out')
+    out_path.mkdir(exist_ok=True)
+
+    benchmarks = [
+        ('extract_files.rmsmap_AP', lambda: rmsmap(ap_file, spectra=False), None),
+        ('extract_files.rmsmap_LF', lambda: rmsmap(lf_file, spectra=True), None),
+        ('extract_files.extract_lfpcorr', lambda: extract_lfpcorr(lf_file, out_path), None),
+    ]
+    return benchmarks
+
+
+def alignment_benchmarks(alf_path, n_lines=10, brain_atlas=None):
+    """
+    Benchmarks of the fit and offset updates done each time the alignment is changed in the GUI,
+    on a straight track through the brain. Requires the Allen atlas
+    :param n_lines: no. of reference lines used in the fit
+    :param brain_atlas: atlas to use, defaults to 25 um Allen atlas
+    """
+    from ibllib.pipes.ephys_alignment import EphysAlignment
+    if brain_atlas is None:
+        from ibllib.atlas import AllenAtlas
+        brain_atlas = AllenAtlas(25)
+
+    chn_depths = pd.PlotData(alf_path, alf_path, 0).chn_coords[:, 1]
+    xyz_picks = np.c_[np.full(50, -2000e-6), np.full(50, -2000e-6),
+                      np.linspace(-500e-6, -5000e-6, 50)]
+    ephysalign = EphysAlignment(xyz_picks, chn_depths, brain_atlas=brain_atlas)
+    feature, track, _ = ephysalign.get_track_and_feature()
+    rng = np.random.default_rng(0)
+
+    def fit():
+        # Equivalent of MainWindow.scale_hist_data with n_lines reference lines
+        line_feature = np.sort(rng.uniform(feature[0], feature[-1], n_lines))
+        line_track = line_feature + rng.normal(0, 50e-6, n_lines)
+        depths_track = np.sort(np.r_[track[[0, -1]], line_track])
+        new_track = ephysalign.feature2track(depths_track, feature, track)
+        new_feature = np.sort(np.r_[feature[[0, -1]], line_feature])
+        if new_feature.size >= 5:
+            new_feature, new_track = ephysalign.adjust_extremes_linear(new_feature, new_track, 1)
+        else:
+            new_track = ephysalign.adjust_extremes_uniform(new_feature, new_track)
+        region, _ = ephysalign.scale_histology_regions(new_feature, new_track)
+        ephysalign.get_scale_factor(region)
+        ephysalign.get_channel_locations(new_feature, new_track)
+
+    def offset():
+        # Equivalent of MainWindow.offset_hist_data
+        new_track = track + rng.normal(0, 100e-6)
+        region, _ = ephysalign.scale_histology_regions(feature, new_track)
+        ephysalign.get_scale_factor(region)
+        ephysalign.get_channel_locations(feature, new_track)
+
+    return [('EphysAlignment.fit', fit, None), ('EphysAlignment.offset', offset, None)]
+
+
+def run_benchmarks(benchmarks, repeat=3):
+    """
+    Run benchmarks, a failing benchmark is reported and doesn't stop the others
+    :return results: result of each benchmark, see measure
+    :type results: dict
+    """
+    results = dict()
+    for name, func, setup in benchmarks:
+        try:
+            results[name] = measure(func, setup=setup, repeat=repeat)
+            results[name]['status'] = 'ok'
+        except Exception:
+            print(f'{name} failed:\n{traceback.format_exc()}')
+            results[name] = {'status': 'failed'}
+        print(f"{name}: " + ', '.join(f'{key}={val:.4f}' if isinstance(val, float) else
+                                      f'{key}={val}' for key, val in results[name].items()))
+    return results
+
+
+def max_rss():
+    """
+    Memory high water mark of this process (MB), None if not supported on this platform
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kB on linux
+    return rss / 1024 ** 2 if platform.system() == 'Darwin' else rss / 1024
+
+
+def compare_results(results, baseline, threshold=0.2):
+    """
+    Find benchmarks that have regressed compared to a baseline
+    :param results: results of run_benchmarks
+    :param baseline: results of a previous run
+    :param threshold: allowed relative increase in duration and peak memory
+    :return regressions: description of each regression
+    :type regressions: list of str
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or base.get('status') != 'ok':
+            continue
+        if result.get('status') != 'ok':
+            regressions.append(f'{name}: failed')
+            continue
+        if result['duration'] > MIN_DURATION and \
+                result['duration'] > base['duration'] * (1 + threshold):
+            regressions.append(f"{name}: duration {base['duration']:.4f} -> "
+                               f"{result['duration']:.4f} s")
+        if result['peak_memory'] > base['peak_memory'] * (1 + threshold) + 1:
+            regressions.append(f"{name}: peak memory {base['peak_memory']:.1f} -> "
+                               f"{result['peak_memory']:.1f} MB")
+    return regressions
+
+
+def benchmark(data_path=None, n_spikes=1000000, duration=3600, n_clusters=500, layout='NP1.0',
+              raw_duration=10, repeat=3, alignment=True):
+    """
+    Generate synthetic data and run all benchmarks on it
+    :param data_path: folder to write synthetic data to, defaults to a temporary folder. The
+    ALF data is written to alf/probe00 and the passive data next to it as for a session
+    :param raw_duration: length of raw spikeglx files (s), 0 to not benchmark extraction
+    :param alignment: whether to benchmark the fit and offset updates, needs the Allen atlas
+    :return results: result of each benchmark and the configuration it was run with
+    :type results: dict
+    """
+    with tempfile.TemporaryDirectory() as tmp_path:
+        alf_path = Path(data_path or tmp_path).joinpath('alf', 'probe00')
+        synthetic_data.make_alf(alf_path, n_spikes=n_spikes, duration=duration,
+                                n_clusters=n_clusters, layout=layout)
+        synthetic_data.make_passive(alf_path, duration=duration)
+        events = synthetic_data.make_behavioral_events(duration=duration)
+        benchmarks = plot_data_benchmarks(alf_path, events=events)
+        if raw_duration:
+            synthetic_data.make_spikeglx(alf_path, duration=raw_duration, band='ap')
+            synthetic_data.make_spikeglx(alf_path, duration=raw_duration, band='lf')
+            benchmarks += extraction_benchmarks(alf_path)
+        if alignment:
+            try:
+                benchmarks += alignment_benchmarks(alf_path)
+            except Exception as err:
+                print(f'skipping alignment benchmarks: {err}')
+
+        results = run_benchmarks(benchmarks, repeat=repeat)
+
+    config = {'n_spikes': n_spikes, 'duration': duration, 'n_clusters': n_clusters,
+              'layout': layout, 'raw_duration': raw_duration, 'repeat': repeat,
+              'max_rss': max_rss()}
+    return {'config': config, 'results': results}
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Benchmark alignment GUI data processing')
+    parser.add_argument('-s', '--n_spikes', default=1000000, type=int, required=False)
+    parser.add_argument('-d', '--duration', default=3600, type=float, required=False,
+                        help='Length of recording (s)')
+    parser.add_argument('-c', '--n_clusters', default=500, type=int, required=False)
+    parser.add_argument('-l', '--layout', default='NP1.0', choices=synthetic_data.LAYOUTS,
+                        required=False)
+    parser.add_argument('-r', '--raw_duration', default=10, type=float, required=False,
+                        help='Length of raw spikeglx files (s), 0 to skip extraction benchmarks')
+    parser.add_argument('-n', '--repeat', default=3, type=int, required=False)
+    parser.add_argument('-o', '--data_path', default=None, required=False,
+                        help='Folder to write synthetic data to, defaults to temporary folder')
+    parser.add_argument('--no_alignment', default=False, action='store_true',
+                        help='Skip fit and offset benchmarks that need the Allen atlas')
+    parser.add_argument('--save', default=None, required=False,
+                        help='Save results to this json file')
+    parser.add_argument('--baseline', default=None, required=False,
+                        help='Compare results to this json file')
+    parser.add_argument('-t', '--threshold', default=0.2, type=float, required=False,
+                        help='Allowed relative increase in duration and memory')
+    args = parser.parse_args()
+
+    run = benchmark(data_path=args.data_path, n_spikes=args.n_spikes, duration=args.duration,
+                    n_clusters=args.n_clusters, layout=args.layout,
+                    raw_duration=args.raw_duration, repeat=args.repeat,
+                    alignment=not args.no_alignment)
+    print(f"max rss: {run['config']['max_rss']} MB")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(run, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['config'] != {**run['config'], 'max_rss': baseline['config']['max_rss']}:
+            print('warning: baseline was run with a different configuration')
+        regressions = compare_results(run['results'], baseline['results'],
+                                      threshold=args.threshold)
+        if regressions:
+            print('regressions:\n' + '\n'.join(regressions))
+            sys.exit(1)
+        print('no regressions')
@@ -0,0 +1,128 @@
+"""
+Channel locations of an alignment as a columnar table. The table is saved as ALF channels.*.npy
+datasets that can be memory mapped, and as the channel_locations json file read by older tools.
+"""
+from pathlib import Path
+import json
+
+import numpy as np
+
+# ALF attribute each column of the table is saved as
+ALF_ATTRIBUTES = {'mlapdv': 'mlapdv',
+                  'localCoordinates': 'localCoordinates',
+                  'brain_region_id': 'brainLocationIds_ccf_2017',
+                  'brain_region': 'brainLocationAcronyms_ccf_2017'}
+
+
+def channel_table(xyz_channels, chn_coords, brain_regions):
+    """
+    Build the channel table
+    :param xyz_channels: 3D coordinates of channels relative to bregma (m)
+    :type xyz_channels: np.array((nchannels, 3))
+    :param chn_coords: lateral and axial position of channels on probe (um)
+    :type chn_coords: np.array((nchannels, 2))
+    :param brain_regions: brain regions of channels, from brain_atlas.regions.get
+    :type brain_regions: Bunch
+    :return table: columns of channel table, mlapdv (um), localCoordinates (um),
+    brain_region_id and brain_region acronym
+    :type table: dict of np.array
+    """
+    table = {'mlapdv': np.asarray(xyz_channels, dtype=float) * 1e6,
+             'localCoordinates': np.asarray(chn_coords, dtype=float),
+             'brain_region_id': np.asarray(brain_regions['id'], dtype=np.int64),
+             'brain_region': np.asarray(brain_regions['acronym']).astype(str)}
+    assert np.unique([len(col) for col in table.values()]).size == 1
+    return table
+
+
+def save_alf(table, folder):
+    """
+    Save channel table as ALF channels.*.npy datasets
+    :return files: files written
+    :type files: list of pathlib.Path
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    files = []
+    for key, attribute in ALF_ATTRIBUTES.items():
+        files.append(folder.joinpath(f'channels.{attribute}.npy'))
+        np.save(files[-1], table[key])
+    return files
+
+
+def load_alf(folder, mmap_mode='r'):
+    """
+    Load channel table saved with save_alf, memory mapped by default
+    """
+    return {key: np.load(Path(folder).joinpath(f'channels.{attribute}.npy'), mmap_mode=mmap_mode)
+            for key, attribute in ALF_ATTRIBUTES.items()}
+
+
+def _columns(table):
+    """
+    Columns of the json channel dictionary as lists of python types, in json key order
+    """
+    return {'x': table['mlapdv'][:, 0].tolist(),
+            'y': table['mlapdv'][:, 1].tolist(),
+            'z': table['mlapdv'][:, 2].tolist(),
+            'axial': table['localCoordinates'][:, 1].tolist(),
+            'lateral': table['localCoordinates'][:, 0].tolist(),
+            'brain_region_id': table['brain_region_id'].tolist(),
+            'brain_region': table['brain_region'].tolist()}
+
+
+def channel_dict(table):
+    """
+    Channel table as a dictionary of dictionaries, one per channel
+    """
+    columns = _columns(table)
+    return {f'channel_{i}': dict(zip(columns.keys(), values))
+            for i, values in enumerate(zip(*columns.values()))}
+
+
+def alyx_channels(table):
+    """
+    Channel table as the list of records created with the Alyx channels endpoint, without the
+    trajectory_estimate
+    """
+    columns = _columns(table)
+    columns['brain_region'] = columns.pop('brain_region_id')
+    return [dict(zip(columns.keys(), values)) for values in zip(*columns.values())]
+
+
+def _json_values(col):
+    """
+    Json representation of each value of a column
+    """
+    if not col or isinstance(col[0], str):
+        return [json.dumps(val) for val in col]
+    # repr of python floats and ints is what json writes, except for nan and inf
+    values = list(map(repr, col))
+    for i in np.flatnonzero(~np.isfinite(col)):
+        values[i] = json.dumps(col[i])
+    return values
+
+
+def write_json(table, file, extra=None):
+    """
+    Write channel table to json one channel at a time, the output is the same as json.dump of
+    channel_dict(table) with extra added, with indent=2
+    :param extra: additional top level entries, e.g. origin
+    :type extra: dict
+    """
+    columns = _columns(table)
+    keys = [json.dumps(key) for key in columns.keys()]
+    values = [_json_values(col) for col in columns.values()]
+    with open(file, 'w') as f:
+        f.write('{')
+        sep = '\n'
+        for i, channel in enumerate(zip(*values)):
+            f.write(f'{sep}  "channel_{i}": {{\n' +
+                    ',\n'.join(f'    {key}: {val}' for key, val in zip(keys, channel)) +
+                    '\n  }')
+            sep = ',\n'
+        for key, val in (extra or {}).items():
+            lines = json.dumps(val, indent=2, separators=(',', ': ')).split('\n')
+            f.write(f'{sep}  {json.dumps(key)}: ' + '\n  '.join(lines))
+            sep = ',\n'
+        f.write('\n}' if sep != '\n' else '}')
@@ -1,159 +1,387 @@
-# import modules
-from oneibl.one import ONE
-from ibllib.pipes.ephys_alignment import EphysAlignment
+"""
+Compare the alignments made by different users for many probe insertions.
+
+The atlas label volume is loaded once and placed in shared memory for a pool of worker
+processes. Each worker computes the channel locations, brain regions and region scaling of the
+alignments of one insertion. Results are cached on disk keyed by a hash of the alignment, so
+later runs only compute new or changed alignments.
+
+Usage:
+    python compare_alignments.py -o agreement.csv -n 8
+    python compare_alignments.py -o agreement.csv -p /path/to/figures
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from pathlib import Path
+import copy
+import hashlib
+
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib
+from ibllib.pipes.ephys_alignment import EphysAlignment
+from ibllib.ephys.neuropixel import SITES_COORDINATES
 import ibllib.atlas as atlas
-from pathlib import Path
-# Instantiate brain atlas and one
-brain_atlas = atlas.AllenAtlas(25)
-one = ONE()
-
-fig_path = Path('C:/Users/Mayo/Documents/PYTHON/alignment_figures/scale_factor')
-# Find eid of interest
-aligned_sess = one.alyx.rest('trajectories', 'list', provenance='Ephys aligned histology track',
-                             django='probe_insertion__session__project__name__icontains,'
-                                    'ibl_neuropixel_brainwide_01,'
-                                    'probe_insertion__session__qc__lt,30')
-eids = np.array([s['session']['id'] for s in aligned_sess])
-probes = np.array([s['probe_name'] for s in aligned_sess])
-
-json = [s['json'] for s in aligned_sess]
-idx_none = [i for i, val in enumerate(json) if val is None]
-json_val = np.delete(json, idx_none)
-keys = [list(s.keys()) for s in json_val]
-
-eids = np.delete(eids, idx_none)
-probes = np.delete(probes, idx_none)
-
-# Find index of json fields with 2 or more keys
-len_key = [len(s) for s in keys]
-idx_several = [i for i, val in enumerate(keys) if len(val) >= 2]
-eid_several = eids[idx_several]
-probe_several = probes[idx_several]
-
-
-# subject = 'KS023'
-# date = '2019-12-10'
-# sess_no = 1
-# probe_label = 'probe00'
-# eid = one.search(subject=subject, date=date, number=sess_no)[0]
-# eid = 'e2448a52-2c22-4ecc-bd48-632789147d9c'
-
-small_scaling = [["CSHL045", "2020-02-25", "probe00", "2020-06-12T10:40:22_noam.roth"],
-                 ["CSHL045", "2020-02-25", "probe01", "2020-09-12T23:43:03_petrina.lau"],
-                 ["CSHL047", "2020-01-20", "probe00", "2020-09-28T08:18:19_noam.roth"],
-                 ["CSHL047", "2020-01-27", "probe00", "2020-09-13T15:51:21_petrina.lau"],
-                 ["CSHL049", "2020-01-08", "probe00", "2020-09-14T15:44:56_nate"],
-                 ["CSHL051", "2020-02-05", "probe00", "2020-06-12T14:05:49_guido"],
-                 ["CSHL055", "2020-02-18", "probe00", "2020-08-13T12:07:08_jeanpaul"],
-                 ["CSH_ZAD_001", "2020-01-13", "probe00", "2020-09-22T17:23:50_petrina.lau"],
-                 ["KS014", "2019-12-03", "probe01", "2020-06-17T19:42:02_Karolina_Socha"],
-                 ["KS016", "2019-12-05", "probe01", "2020-06-18T10:26:54_Karolina_Socha"],
-                 ["KS020", "2020-02-06", "probe00", "2020-09-13T15:08:15_petrina.lau"],
-                 ["NYU-11", "2020-02-21", "probe01", "2020-09-13T11:19:59_petrina.lau"],
-                 ["SWC_014", "2019-12-15", "probe01", "2020-07-26T22:24:39_noam.roth"],
-                 ["ZM_2240", "2020-01-23", "probe00", "2020-06-05T14:57:46_guido"]]
-
-big_scaling = [["CSHL045", "2020-02-25", "probe00", "2020-06-12T10:40:22_noam.roth"],
-               ["CSHL045", "2020-02-25", "probe01", "2020-09-12T23:43:03_petrina.lau"],
-               ["CSH_ZAD_001", "2020-01-13", "probe00", "2020-09-22T17:23:50_petrina.lau"],
-               ["KS014", "2019-12-03", "probe00", "2020-06-17T15:15:01_Karolina_Socha"],
-               ["KS014", "2019-12-03", "probe01", "2020-06-17T19:42:02_Karolina_Socha"],
-               ["KS014", "2019-12-04", "probe00", "2020-09-12T16:39:14_petrina.lau"],
-               ["KS014", "2019-12-06", "probe00", "2020-06-17T13:40:00_Karolina_Socha"],
-               ["KS014", "2019-12-07", "probe00", "2020-06-17T16:21:35_Karolina_Socha"],
-               ["KS016", "2019-12-04", "probe00", "2020-08-13T14:02:44_jeanpaul"],
-               ["KS016", "2019-12-05", "probe00", "2020-06-18T10:49:53_Karolina_Socha"],
-               ["KS023", "2019-12-07", "probe00", "2020-09-09T14:21:35_nate"],
-               ["KS023", "2019-12-07", "probe01", "2020-06-18T15:50:55_Karolina_Socha"],
-               ["KS023", "2019-12-10", "probe01", "2020-06-12T13:59:02_guido"],
-               ["KS023", "2019-12-11", "probe01", "2020-06-18T16:04:18_Karolina_Socha"],
-               ["NYU-11", "2020-02-21", "probe01", "2020-09-13T11:19:59_petrina.lau"],
-               ["NYU-12", "2020-01-22", "probe00", "2020-09-13T19:53:43_petrina.lau"],
-               ["SWC_014", "2019-12-12", "probe00", "2020-07-27T11:27:16_noam.roth"],
-               ["SWC_038", "2020-08-01", "probe01", "2020-08-31T12:32:05_nate"],
-               ["ibl_witten_14", "2019-12-11", "probe00", "2020-06-14T15:33:45_noam.roth"]]
-
-for sess in small_scaling:
-    eid = one.search(subject=sess[0], date=sess[1])[0]
-    probe_label = sess[2]
-# for eid, probe_label in zip(eid_several, probe_several):
-    trajectory = one.alyx.rest('trajectories', 'list', provenance='Ephys aligned histology track',
-                               session=eid, probe=probe_label)
-
-    subject = trajectory[0]['session']['subject']
-    date = trajectory[0]['session']['start_time'][0:10]
-    chn_coords = one.load(eid, dataset_types=['channels.localCoordinates'])[0]
-    depths = chn_coords[:, 1]
-
-    insertion = one.alyx.rest('insertions', 'list', session=eid, name=probe_label)
-    xyz_picks = np.array(insertion[0]['json']['xyz_picks']) / 1e6
-
-    alignments = trajectory[0]['json']
-
-    def plot_regions(region, label, colour, ax):
-        for reg, col in zip(region, colour):
-            height = np.abs(reg[1] - reg[0])
-            color = col / 255
-            ax.bar(x=0.5, height=height, width=1, color=color, bottom=reg[0], edgecolor='w')
-
-        ax.set_yticks(label[:, 0].astype(int))
-        ax.set_yticklabels(label[:, 1])
-        ax.yaxis.set_tick_params(labelsize=10)
-        ax.tick_params(axis="y", direction="in", pad=-50)
-        ax.set_ylim([20, 3840])
-        ax.get_xaxis().set_visible(False)
-
-    def plot_scaling(region, scale, mapper, ax):
-        for reg, col in zip(region_scaled, scale_factor):
-            height = np.abs(reg[1] - reg[0])
-            color = np.array(mapper.to_rgba(col, bytes=True)) / 255
-            ax.bar(x=1.1, height=height, width=0.2, color=color, bottom=reg[0], edgecolor='w')
-
-        sec_ax = ax.secondary_yaxis('right')
-        sec_ax.set_yticks(np.mean(region, axis=1))
-        sec_ax.set_yticklabels(np.around(scale, 2))
-        sec_ax.tick_params(axis="y", direction="in")
-        sec_ax.set_ylim([20, 3840])
-
-    fig, ax = plt.subplots(1, len(alignments) + 1, figsize=(15, 15))
-    ephysalign = EphysAlignment(xyz_picks, depths, brain_atlas=brain_atlas)
-    feature, track, _ = ephysalign.get_track_and_feature()
-    channels_orig = ephysalign.get_channel_locations(feature, track)
-    region, region_label = ephysalign.scale_histology_regions(feature, track)
-    region_scaled, scale_factor = ephysalign.get_scale_factor(region)
-    region_colour = ephysalign.region_colour
 
-    norm = matplotlib.colors.Normalize(vmin=0.5, vmax=1.5, clip=True)
-    mapper = matplotlib.cm.ScalarMappable(norm=norm, cmap=matplotlib.cm.seismic)
+CACHE_DIR = Path.home().joinpath('.iblapps', 'alignment_cache')
+# Atlas volumes placed in shared memory, the image volume isn't used by EphysAlignment
+SHARED_VOLUMES = ['label']
+BRAINWIDE_DJANGO = ('probe_insertion__session__project__name__icontains,'
+                    'ibl_neuropixel_brainwide_01,probe_insertion__session__qc__lt,30')
+
+# Atlas of the worker process, set by _init_worker
+_worker = {}
+
+
+def alignment_hash(xyz_picks, depths, feature=None, track=None):
+    """
+    Hash of everything the result of an alignment depends on. The original alignment, without
+    reference lines, has feature and track None
+    :return: hex digest
+    :type: str
+    """
+    h = hashlib.md5()
+    for data in [xyz_picks, depths, feature, track]:
+        h.update(b'None' if data is None else np.ascontiguousarray(data, dtype=float).tobytes())
+    return h.hexdigest()
+
 
-    ax_i = fig.axes[0]
-    plot_regions(region, region_label, region_colour, ax_i)
-    plot_scaling(region_scaled, scale_factor, mapper, ax_i)
-    ax_i.set_title('Original')
-
-    for iK, key in enumerate(alignments):
-        # Location of reference lines used for alignmnet
-        feature = np.array(alignments[key][0])
-        track = np.array(alignments[key][1])
-        user = key[20:]
-        # Instantiate EphysAlignment object
-        ephysalign = EphysAlignment(xyz_picks, depths, track_prev=track, feature_prev=feature,
-                                    brain_atlas=brain_atlas)
-
-        channels = ephysalign.get_channel_locations(feature, track)
-        avg_dist = np.mean(np.sqrt(np.sum((channels - channels_orig) ** 2, axis=1)), axis=0)
+class SharedAtlas:
+    """
+    Copy of the volumes of an atlas in shared memory, together with a copy of the atlas without
+    them that is sent to the worker processes
+    """
+    def __init__(self, brain_atlas):
+        self.template = copy.copy(brain_atlas)
+        self.template.image = None
+        self.shm = {}
+        self.volumes = {}
+        for name in SHARED_VOLUMES:
+            vol = getattr(brain_atlas, name)
+            self.shm[name] = shared_memory.SharedMemory(create=True, size=vol.nbytes)
+            np.ndarray(vol.shape, dtype=vol.dtype, buffer=self.shm[name].buf)[:] = vol
+            self.volumes[name] = (self.shm[name].name, vol.shape, vol.dtype.str)
+            setattr(self.template, name, None)
+
+    def close(self):
+        for shm in self.shm.values():
+            shm.close()
+            shm.unlink()
+        self.shm = {}
+
+
+def attach_atlas(template, volumes):
+    """
+    Copy of the atlas template with the volumes of a SharedAtlas attached, called in the worker
+    processes
+    :param template: SharedAtlas.template
+    :param volumes: SharedAtlas.volumes
+    :return: atlas
+    """
+    brain_atlas = copy.copy(template)
+    for name, (shm_name, shape, dtype) in volumes.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        setattr(brain_atlas, name, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        # Keep a reference so the shared memory stays attached
+        _worker.setdefault('shm', []).append(shm)
+    return brain_atlas
+
+
+def _init_worker(template, volumes):
+    _worker['brain_atlas'] = attach_atlas(template, volumes)
+
+
+def compute_insertion(insertion, keys=None, brain_atlas=None):
+    """
+    Compute the channel locations, brain regions and region scaling of the original track and
+    the alignments of an insertion
+    :param insertion: insertion info, see AlignmentComparison.get_insertions
+    :type insertion: dict
+    :param keys: alignment keys to compute, 'original' for the track without alignment. Defaults
+    to all
+    :param brain_atlas: atlas, defaults to the shared atlas of the worker process
+    :return results: result of each alignment keyed by alignment key
+    :type results: dict
+    """
+    brain_atlas = brain_atlas or _worker['brain_atlas']
+    xyz_picks = np.array(insertion['xyz_picks']) / 1e6
+    depths = np.array(insertion['depths'])
+    keys = keys or ['original'] + list(insertion['alignments'].keys())
+
+    ephysalign = EphysAlignment(xyz_picks, depths, brain_atlas=brain_atlas)
+    results = dict()
+    for key in keys:
+        if key == 'original':
+            feature, track, _ = ephysalign.get_track_and_feature()
+        else:
+            feature = np.array(insertion['alignments'][key][0])
+            track = np.array(insertion['alignments'][key][1])
+        xyz_channels = ephysalign.get_channel_locations(feature, track)
         region, region_label = ephysalign.scale_histology_regions(feature, track)
         region_scaled, scale_factor = ephysalign.get_scale_factor(region)
+        results[key] = {
+            'xyz_channels': xyz_channels,
+            'region_id': brain_atlas.regions.get(brain_atlas.get_labels(xyz_channels))['id'],
+            'region': region,
+            'region_label_pos': region_label[:, 0].astype(float),
+            'region_label': region_label[:, 1].astype(str),
+            'region_colour': ephysalign.region_colour,
+            'region_scaled': region_scaled,
+            'scale_factor': scale_factor,
+            'n_lines': feature.size - 2}
+    return results
+
+
+class AlignmentComparison:
+    def __init__(self, one=None, brain_atlas=None, cache_dir=CACHE_DIR, n_workers=None):
+        """
+        :param one: ONE instance, only needed to query insertions
+        :param brain_atlas: atlas, defaults to 25 um Allen atlas loaded when first needed
+        :param cache_dir: folder results are cached in, no cache if None
+        :param n_workers: number of processes, defaults to number of cpus
+        """
+        self.one = one
+        self._brain_atlas = brain_atlas
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.n_workers = n_workers
+
+    @property
+    def brain_atlas(self):
+        if self._brain_atlas is None:
+            self._brain_atlas = atlas.AllenAtlas(25)
+        return self._brain_atlas
+
+    def get_depths(self, traj):
+        """
+        Channel depths of the probe of a trajectory from the channels.localCoordinates dataset of
+        its session, the default Neuropixel site depths if the dataset is missing
+        """
+        try:
+            chn_coords = self.one.load_dataset(traj['session']['id'],
+                                               'channels.localCoordinates.npy',
+                                               collection=f"alf/{traj['probe_name']}")
+            return np.asarray(chn_coords)[:, 1]
+        except Exception as err:
+            print(f"{traj['probe_insertion']}: using default channel depths, {err}")
+            return SITES_COORDINATES[:, 1]
 
-        ax_i = fig.axes[iK + 1]
-        plot_regions(region, region_label, region_colour, ax_i)
-        plot_scaling(region_scaled, scale_factor, mapper, ax_i)
-        ax_i.set_title(user + '\n Avg dist = ' + str(np.around(avg_dist * 1e6, 2)))
+    def get_insertions(self, django=BRAINWIDE_DJANGO, load_channels=True):
+        """
+        Find the insertions with ephys aligned trajectories
+        :param django: django filter of the trajectories query
+        :param load_channels: load the channel depths of each session, see get_depths, otherwise
+        the default Neuropixel site depths are used for all insertions
+        :return insertions: info of each insertion
+        :type insertions: list of dict
+        """
+        aligned = self.one.alyx.rest('trajectories', 'list',
+                                     provenance='Ephys aligned histology track', django=django)
+        insertions = []
+        for traj in aligned:
+            if not traj['json']:
+                continue
+            ins = self.one.alyx.rest('insertions', 'read', id=traj['probe_insertion'])
+            xyz_picks = (ins['json'] or {}).get('xyz_picks')
+            if xyz_picks is None:
+                continue
+            depths = self.get_depths(traj) if load_channels else SITES_COORDINATES[:, 1]
+            insertions.append({'probe_insertion': traj['probe_insertion'],
+                               'subject': traj['session']['subject'],
+                               'date': traj['session']['start_time'][:10],
+                               'probe_name': traj['probe_name'],
+                               'xyz_picks': xyz_picks,
+                               'depths': np.asarray(depths).tolist(),
+                               'alignments': traj['json']})
+        return insertions
 
-    fig.suptitle(subject + '_' + str(date) + '_' + probe_label, fontsize=16)
-    plt.show()
-    fig.savefig(fig_path.joinpath(subject + '_' + str(date) + '_' + probe_label + '.png'), dpi=100)
+    def cache_file(self, key_hash):
+        return self.cache_dir.joinpath(f'{key_hash}.npz')
+
+    def load_cached(self, key_hash):
+        if self.cache_dir is None or not self.cache_file(key_hash).exists():
+            return None
+        try:
+            with np.load(self.cache_file(key_hash)) as cached:
+                return {key: cached[key] for key in cached.files}
+        except Exception as err:
+            print(f'could not load cached alignment {key_hash}: {err}')
+            return None
+
+    def save_cached(self, key_hash, result):
+        if self.cache_dir is None:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        np.savez(self.cache_file(key_hash), **result)
+
+    @staticmethod
+    def hashes(insertion):
+        """
+        Alignment hash of the original track and each alignment of an insertion
+        """
+        hashes = {'original': alignment_hash(insertion['xyz_picks'], insertion['depths'])}
+        for key, val in insertion['alignments'].items():
+            hashes[key] = alignment_hash(insertion['xyz_picks'], insertion['depths'], val[0],
+                                         val[1])
+        return hashes
+
+    def compute(self, insertions):
+        """
+        Compute the results of all alignments of the insertions, cached alignments are loaded
+        and the others computed in a pool of processes
+        :return results: results of each insertion, keyed by probe insertion and alignment key
+        :type results: dict of dict
+        """
+        results = dict()
+        todo = []
+        for insertion in insertions:
+            hashes = self.hashes(insertion)
+            results[insertion['probe_insertion']] = {key: self.load_cached(key_hash)
+                                                     for key, key_hash in hashes.items()}
+            keys = [key for key, val in results[insertion['probe_insertion']].items()
+                    if val is None]
+            if keys:
+                todo.append((insertion, keys, hashes))
+
+        if not todo:
+            return results
+
+        shared = SharedAtlas(self.brain_atlas)
+        try:
+            with ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                     initargs=(shared.template, shared.volumes)) as executor:
+                computed = executor.map(compute_insertion, [task[0] for task in todo],
+                                        [task[1] for task in todo],
+                                        chunksize=max(1, len(todo) // (8 * (self.n_workers or 8))))
+                for (insertion, keys, hashes), result in zip(todo, computed):
+                    for key, val in result.items():
+                        self.save_cached(hashes[key], val)
+                        results[insertion['probe_insertion']][key] = val
+        finally:
+            shared.close()
+
+        return results
+
+    @staticmethod
+    def score(insertions, results):
+        """
+        Agreement of the alignments of each insertion
+        :return scores: for each alignment the average distance of its channels to the original
+        track and to the other alignments (um), and the fraction of channels in the same region as
+        in the other alignments
+        :type scores: pandas.DataFrame
+        """
+        rows = []
+        for insertion in insertions:
+            res = results[insertion['probe_insertion']]
+            keys = list(insertion['alignments'].keys())
+            xyz = np.array([res[key]['xyz_channels'] for key in keys])
+            region_id = np.array([res[key]['region_id'] for key in keys])
+            # Pairwise average channel distance and fraction of channels in same region
+            dist = np.mean(np.sqrt(np.sum((xyz[:, np.newaxis] - xyz[np.newaxis]) ** 2, axis=3)),
+                           axis=2) * 1e6
+            same = np.mean(region_id[:, np.newaxis] == region_id[np.newaxis], axis=2)
+            dist_orig = np.mean(np.sqrt(np.sum((xyz - res['original']['xyz_channels']) ** 2,
+                                               axis=2)), axis=1) * 1e6
+            others = ~np.eye(len(keys), dtype=bool)
+            for i, key in enumerate(keys):
+                rows.append({'probe_insertion': insertion['probe_insertion'],
+                             'subject': insertion['subject'], 'date': insertion['date'],
+                             'probe_name': insertion['probe_name'], 'alignment': key,
+                             'user': key[20:], 'n_alignments': len(keys),
+                             'dist_original': dist_orig[i],
+                             'dist_others': np.mean(dist[i, others[i]]) if len(keys) > 1
+                             else np.nan,
+                             'region_agreement': np.mean(same[i, others[i]]) if len(keys) > 1
+                             else np.nan})
+        return pd.DataFrame(rows)
+
+
+def plot_regions(region, label_pos, label, colour, ax):
+    for reg, col in zip(region, colour):
+        height = np.abs(reg[1] - reg[0])
+        color = col / 255
+        ax.bar(x=0.5, height=height, width=1, color=color, bottom=reg[0], edgecolor='w')
+
+    ax.set_yticks(label_pos.astype(int))
+    ax.set_yticklabels(label)
+    ax.yaxis.set_tick_params(labelsize=10)
+    ax.tick_params(axis="y", direction="in", pad=-50)
+    ax.set_ylim([20, 3840])
+    ax.get_xaxis().set_visible(False)
+
+
+def plot_scaling(region, scale, mapper, ax):
+    for reg, col in zip(region, scale):
+        height = np.abs(reg[1] - reg[0])
+        color = np.array(mapper.to_rgba(col, bytes=True)) / 255
+        ax.bar(x=1.1, height=height, width=0.2, color=color, bottom=reg[0], edgecolor='w')
+
+    sec_ax = ax.secondary_yaxis('right')
+    sec_ax.set_yticks(np.mean(region, axis=1))
+    sec_ax.set_yticklabels(np.around(scale, 2))
+    sec_ax.tick_params(axis="y", direction="in")
+    sec_ax.set_ylim([20, 3840])
+
+
+def plot_insertion(insertion, results, fig_path):
+    """
+    Plot the brain regions and scale factors of the original track and each alignment of an
+    insertion, saved as png in fig_path
+    """
+    norm = matplotlib.colors.Normalize(vmin=0.5, vmax=1.5, clip=True)
+    mapper = matplotlib.cm.ScalarMappable(norm=norm, cmap=matplotlib.cm.seismic)
+
+    keys = ['original'] + list(insertion['alignments'].keys())
+    fig, ax = plt.subplots(1, len(keys), figsize=(15, 15))
+    for ax_i, key in zip(fig.axes, keys):
+        res = results[key]
+        plot_regions(res['region'], res['region_label_pos'], res['region_label'],
+                     results['original']['region_colour'], ax_i)
+        plot_scaling(res['region_scaled'], res['scale_factor'], mapper, ax_i)
+        if key == 'original':
+            ax_i.set_title('Original')
+        else:
+            avg_dist = np.mean(np.sqrt(np.sum((res['xyz_channels'] -
+                                               results['original']['xyz_channels']) ** 2,
+                                              axis=1)), axis=0)
+            ax_i.set_title(key[20:] + '\n Avg dist = ' + str(np.around(avg_dist * 1e6, 2)))
+
+    name = insertion['subject'] + '_' + insertion['date'] + '_' + insertion['probe_name']
+    fig.suptitle(name, fontsize=16)
+    fig.savefig(Path(fig_path).joinpath(name + '.png'), dpi=100)
     plt.close(fig)
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from oneibl.one import ONE
+
+    parser = argparse.ArgumentParser(description='Compare alignments of probe insertions')
+    parser.add_argument('-o', '--output', default='alignment_agreement.csv', required=False,
+                        help='csv file to save agreement scores to')
+    parser.add_argument('-n', '--n_workers', default=None, type=int, required=False,
+                        help='Number of processes')
+    parser.add_argument('-d', '--django', default=BRAINWIDE_DJANGO, required=False,
+                        help='Django filter of the aligned trajectories query')
+    parser.add_argument('-g', '--default_geometry', default=False, action='store_true',
+                        help='Use the default Neuropixel geometry instead of loading the channel '
+                             'depths of each session')
+    parser.add_argument('-p', '--plot', default=None, required=False,
+                        help='Save a figure of each insertion with 2 or more alignments here')
+    args = parser.parse_args()
+
+    comparison = AlignmentComparison(one=ONE(), n_workers=args.n_workers)
+    insertions = comparison.get_insertions(django=args.django,
+                                           load_channels=not args.default_geometry)
+    results = comparison.compute(insertions)
+    scores = comparison.score(insertions, results)
+    scores.to_csv(args.output, index=False)
+    print(f'{len(insertions)} insertions, {len(scores)} alignments compared')
+
+    if args.plot:
+        Path(args.plot).mkdir(parents=True, exist_ok=True)
+        for insertion in insertions:
+            if len(insertion['alignments']) >= 2:
+                plot_insertion(insertion, results[insertion['probe_insertion']], args.plot)
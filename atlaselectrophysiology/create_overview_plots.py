@@ -1,90 +1,179 @@
-import matplotlib.pyplot as plt
+"""
+Combine the images of the plots saved from the alignment GUI into a single overview image.
+
+The images are pasted one at a time into the overview with PIL, so only the overview and a
+single plot are held in memory. Overviews of many insertions can be made in parallel without a
+display, e.g.
+    python create_overview_plots.py /path/to/lab/Subjects -n 8 -w 4000
+"""
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import glob
-import os
-
-
-def make_overview_plot(folder, sess_info, save_folder=None, shank_info=''):
-    insertion_name = [name for i,name in enumerate(folder.parts[:-1]) if folder.parts[i+1] == 'alf'][0] + shank_info
-    image_folder = folder
-    image_info = sess_info
-    if not save_folder:
-        save_folder = image_folder
-
-    def load_image(image_name, ax, stretch=True):
-        with image_name as ifile:
-            image = plt.imread(ifile)
-
-        ax.spines['right'].set_visible(False)
-        ax.spines['top'].set_visible(False)
-        ax.spines['left'].set_visible(False)
-        ax.spines['bottom'].set_visible(False)
-        ax.set_axis_off()
-        if not stretch: ax.set_aspect('equal')
-        ax.imshow(image, aspect='auto' if stretch else 'equal')
-        return image
-
-    fig = plt.figure(figsize=(8, 4), dpi=700)
-    gs = fig.add_gridspec(2, 18, wspace=-0.1, hspace=0.05, top=0.88, bottom=0.05, left=0.01, right=0.99)
-    plt.figtext(0.02, 0.9, insertion_name, fontsize=7)
-
-    # Image view
-    img_row_order = [0, 0, 0, 0, 0, 1]
-    img_column_order = [0, 3, 6, 9, 12, 3]
-    img_idx = [0, 4, 10, 7, 5, 1]
-    img_files = glob.glob(str(image_folder.joinpath(image_info + 'img_*.png')))
-    img_files_sort = [img_files[idx] for idx in img_idx]
-
-    for iF, file in enumerate(img_files_sort):
-        ax = fig.add_subplot(gs[img_row_order[iF], img_column_order[iF]:img_column_order[iF] + 3])
-        load_image(Path(file), ax)
-
-    # Probe and line view
-    probe_row_order = [1, 1, 1, 1, 1, 1, 1, 1, 1]
-    probe_column_order = [8, 9, 10, 11, 12, 13, 14, 6, 7]
-    probe_idx = [5, 6, 0, 3, 1, 2, 4]
-    probe_files = glob.glob(str(image_folder.joinpath(image_info + 'probe_*.png')))
-    probe_files_sort = [probe_files[idx] for idx in probe_idx]
-    line_files = glob.glob(str(image_folder.joinpath(image_info + 'line_*.png')))
-
-    for iF, file in enumerate(probe_files_sort + line_files):
-        ax = fig.add_subplot(gs[probe_row_order[iF], probe_column_order[iF]])
-        load_image(Path(file), ax)
-        
-    # Slice view
-    slice_files = glob.glob(str(image_folder.joinpath(image_info + 'slice_*.png')))
-    slice_row_order = [1]
-    slice_idx = [0]
-    slice_column_order = [0]
-    slice_files_sort = [slice_files[idx] for idx in slice_idx]
-
-    for iF, file in enumerate(slice_files_sort):
-        ax = fig.add_subplot(gs[slice_row_order[iF],
-                                slice_column_order[iF]:slice_column_order[iF] + 3])
-        load_image(Path(file), ax, stretch=False)
-
-    slice_files_zoom = glob.glob(str(image_folder.joinpath(image_info + 'slice_zoom*.png')))
-    slice_row_order = [1]
-    slice_idx = [0]
-    slice_column_order = [2]
-    slice_files_sort = [slice_files_zoom[idx] for idx in slice_idx]
-
-    for iF, file in enumerate(slice_files_sort):
-        ax = fig.add_subplot(gs[slice_row_order[iF], slice_column_order[iF]])
-        load_image(Path(file), ax, stretch=False)
-
-    # Histology view
-    hist_files = glob.glob(str(image_folder.joinpath(image_info + 'hist*.png')))
-    for iF, file in enumerate(hist_files):
-        ax = fig.add_subplot(gs[0, 15:17])
-        load_image(Path(file), ax)
-        
-        ax = fig.add_subplot(gs[1, 15:17])
-        load_image(Path(file), ax)
-
-    ax.text(0.5, 0, image_info[:-1], va="center", ha="center", transform=ax.transAxes)
-
-    plt.savefig(save_folder.joinpath(image_info + insertion_name + "_overview.png"),
-                bbox_inches='tight', pad_inches=0)
-    plt.close()
-    os.startfile(save_folder.joinpath(image_info + insertion_name + "_overview.png"))
\ No newline at end of file
+
+from PIL import Image, ImageDraw, ImageFont
+
+# Width of overview image (pixels), the height is half the width
+OVERVIEW_WIDTH = 5600
+N_COLUMNS = 18
+# Fraction of overview height above the plots used for the title and below the plots
+TOP = 0.12
+BOTTOM = 0.05
+# Fraction of overview width left and right of the plots
+SIDE = 0.01
+ROW_SPACE = 0.05
+# Font height relative to overview width
+FONT_SIZE = 0.012
+
+# Plots to include, each given by the file pattern, the index of the file in the sorted list of
+# matching files and the row, first column and no. of columns it occupies. Stretched plots fill
+# their space, others keep their aspect ratio
+LAYOUT = (
+    [('img_*.png', idx, 0, col, 3, True) for idx, col in zip([0, 4, 10, 7, 5], [0, 3, 6, 9, 12])] +
+    [('img_*.png', 1, 1, 3, 3, True)] +
+    [('probe_*.png', idx, 1, col, 1, True)
+     for idx, col in zip([5, 6, 0, 3, 1, 2, 4], [8, 9, 10, 11, 12, 13, 14])] +
+    [('line_*.png', idx, 1, col, 1, True) for idx, col in zip([0, 1], [6, 7])] +
+    [('slice_*.png', 0, 1, 0, 3, False), ('slice_zoom*.png', 0, 1, 2, 1, False),
+     ('hist*.png', 0, 0, 15, 2, True), ('hist*.png', 0, 1, 15, 2, True)])
+
+
+def get_insertion_name(folder):
+    """
+    Name of the folder containing the alf folder the plots were saved in
+    """
+    parts = Path(folder).parts
+    names = [name for i, name in enumerate(parts[:-1]) if parts[i + 1] == 'alf']
+    return names[0] if names else ''
+
+
+def load_font(size):
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def paste_image(overview, file, box, stretch=True):
+    """
+    Resize image to fit in box and paste it into overview
+    :param box: left, top, right and bottom of space in overview (pixels)
+    :type box: tuple
+    """
+    width = box[2] - box[0]
+    height = box[3] - box[1]
+    with Image.open(file) as image:
+        image = image.convert('RGB')
+        if not stretch:
+            scale = min(width / image.width, height / image.height)
+            width = max(int(image.width * scale), 1)
+            height = max(int(image.height * scale), 1)
+        image = image.resize((width, height), Image.BILINEAR)
+    # Images that keep their aspect ratio are centred in their space
+    overview.paste(image, (box[0] + (box[2] - box[0] - width) // 2,
+                           box[1] + (box[3] - box[1] - height) // 2))
+
+
+def make_overview_plot(folder, sess_info, save_folder=None, shank_info='',
+                       width=OVERVIEW_WIDTH):
+    """
+    Make the overview image of the plots of an insertion
+    :param folder: folder the plots were saved in
+    :param sess_info: prefix of the plot file names
+    :param save_folder: folder to save overview to, defaults to folder
+    :param width: width of overview image (pixels)
+    :return: path of overview image
+    :type: pathlib.Path
+    """
+    folder = Path(folder)
+    save_folder = Path(save_folder or folder)
+    insertion_name = get_insertion_name(folder) + shank_info
+    height = width // 2
+
+    overview = Image.new('RGB', (width, height), 'white')
+    col_width = width * (1 - 2 * SIDE) / N_COLUMNS
+    row_height = height * (1 - TOP - BOTTOM) / (2 + ROW_SPACE)
+    files = {}
+    for pattern, idx, row, col, n_col, stretch in LAYOUT:
+        if pattern not in files:
+            files[pattern] = sorted(glob.glob(str(folder.joinpath(sess_info + pattern))))
+        if idx >= len(files[pattern]):
+            print(f'{sess_info + pattern} plot {idx} not found in {folder}')
+            continue
+        top = height * TOP + row * row_height * (1 + ROW_SPACE)
+        box = (int(width * SIDE + col * col_width), int(top),
+               int(width * SIDE + (col + n_col) * col_width), int(top + row_height))
+        paste_image(overview, files[pattern][idx], box, stretch=stretch)
+
+    font = load_font(int(width * FONT_SIZE))
+    draw = ImageDraw.Draw(overview)
+    draw.text((int(width * 0.02), int(height * 0.02)), insertion_name, fill='black', font=font)
+    # Label the histology plot with the session info
+    draw.text((int(width * SIDE + 15 * col_width), int(height * (1 - BOTTOM))), sess_info[:-1],
+              fill='black', font=font)
+
+    save_folder.mkdir(parents=True, exist_ok=True)
+    save_file = save_folder.joinpath(sess_info + insertion_name + '_overview.png')
+    overview.save(save_file)
+    return save_file
+
+
+def _make_overview_plot(args):
+    folder, sess_info, shank_info, save_folder, width = args
+    try:
+        return make_overview_plot(folder, sess_info, save_folder=save_folder,
+                                  shank_info=shank_info, width=width)
+    except Exception as err:
+        print(f'could not make overview of {folder}: {err}')
+        return None
+
+
+def find_plot_folders(root):
+    """
+    Find the folders containing plots saved from the alignment GUI
+    :return: folder, prefix of the plot file names and shank of each insertion
+    :type: list of tuple
+    """
+    plot_folders = []
+    for file in sorted(Path(root).rglob('*hist.png')):
+        # Plots of multi shank probes are saved in a GUI_plots_shank<n> folder
+        shank_info = [part[len('GUI_plots'):] for part in file.parts
+                      if part.startswith('GUI_plots')]
+        plot_folders.append((file.parent, file.name[:-len('hist.png')],
+                             shank_info[0] if shank_info else ''))
+    return plot_folders
+
+
+def make_overview_plots(plot_folders, save_folder=None, width=OVERVIEW_WIDTH, n_workers=None):
+    """
+    Make the overview images of many insertions in parallel
+    :param plot_folders: folder, prefix of the plot file names and shank of each insertion, see
+    find_plot_folders
+    :param save_folder: folder to save overviews to, defaults to the folder of each insertion
+    :param n_workers: number of processes, defaults to number of cpus
+    :return: paths of overview images, None where the overview could not be made
+    :type: list
+    """
+    args = [(folder, sess_info, shank_info, save_folder, width)
+            for folder, sess_info, shank_info in plot_folders]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(_make_overview_plot, args))
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Make overview images of alignment GUI plots')
+    parser.add_argument('root', help='Folder to search for plots saved from the alignment GUI')
+    parser.add_argument('-o', '--output', default=None, required=False,
+                        help='Folder to save overviews to, defaults to folder of plots')
+    parser.add_argument('-w', '--width', default=OVERVIEW_WIDTH, type=int, required=False,
+                        help='Width of overview images (pixels)')
+    parser.add_argument('-n', '--n_workers', default=None, type=int, required=False,
+                        help='Number of processes')
+    args = parser.parse_args()
+
+    plot_folders = find_plot_folders(args.root)
+    overviews = make_overview_plots(plot_folders, save_folder=args.output, width=args.width,
+                                    n_workers=args.n_workers)
+    print(f'{sum(file is not None for file in overviews)} of {len(plot_folders)} overviews made')
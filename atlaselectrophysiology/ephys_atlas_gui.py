@@ -2,6 +2,7 @@ from PyQt5 import QtWidgets, QtCore, QtGui
 import pyqtgraph as pg
 import pyqtgraph.exporters
 import numpy as np
+from scipy.spatial import cKDTree
 from random import randrange
 from atlaselectrophysiology.load_data import LoadData
 from atlaselectrophysiology.load_data_local import LoadDataLocal
@@ -9,6 +10,10 @@ from ibllib.pipes.ephys_alignment import EphysAlignment
 import atlaselectrophysiology.plot_data as pd
 import atlaselectrophysiology.ColorBar as cb
 import atlaselectrophysiology.ephys_gui_setup as ephys_gui
+import atlaselectrophysiology.nearest_boundary as nb
+import atlaselectrophysiology.precompute_plot_data as precompute
+import atlaselectrophysiology.timing as timing
+import atlaselectrophysiology.upload_outbox as outbox
 from atlaselectrophysiology.create_overview_plots import make_overview_plot
 from pathlib import Path
 import os
@@ -18,23 +23,37 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
     def __init__(self, offline=False, probe_id=None, one=None):
         super(MainWindow, self).__init__()
 
+        # Nearby boundaries only depend on the track, keep them between sessions and shanks
+        self.nearby_cache = {}
+        self.nearby_workers = {}
+        self.nearby_key = None
+
+        # Uploads to Alyx are sent from an outbox in the background
+        self.outbox = None
+        self.upload_worker = None
+        self.upload_pending = False
+
         self.init_variables()
         self.init_layout(self, offline=offline)
         self.configure = True
         if not offline and probe_id is None:
-            self.loaddata = LoadData()
+            self.loaddata = timing.instrument(LoadData())
             self.populate_lists(self.loaddata.get_subjects(), self.subj_list, self.subj_combobox)
         elif not offline and probe_id is not None:
-            self.loaddata = LoadData(probe_id=probe_id, one=one)
+            self.loaddata = timing.instrument(LoadData(probe_id=probe_id, one=one))
             self.loaddata.get_info(0)
             self.feature_prev, self.track_prev = self.loaddata.get_starting_alignment(0)
             self.data_status = False
-            self.data_button_pressed()
         else:
-            self.loaddata = LoadDataLocal()
+            self.loaddata = timing.instrument(LoadDataLocal())
+
+        if not offline:
+            self.init_outbox()
 
         self.allen = self.loaddata.get_allen_csv()
         self.init_region_lookup(self.allen)
+        if not offline and probe_id is not None:
+            self.data_button_pressed()
 
     def init_variables(self):
         """
@@ -79,16 +98,11 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.points = np.empty((0, 1))
         self.scale = 1
 
-        # Variables to keep track of plots and colorbars
-        self.img_plots = []
-        self.line_plots = []
-        self.probe_plots = []
-        self.img_cbars = []
-        self.probe_cbars = []
+        # Variables to keep track of plots, the data plots themselves are reused from item pools
+        self.data = None
         self.scale_regions = np.empty((0, 1))
         self.slice_lines = []
         self.slice_items = []
-        self.probe_bounds = []
 
         # Variables to keep track of popup plots
         self.cluster_popups = []
@@ -428,7 +442,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
 
         # Next go through the line plots
         self.fig_data_layout.addItem(self.fig_probe_cb, 0, 0, 1, 2)
-        self.fig_probe_cb.clear()
+        self.probe_cbar_pool.hide()
         text = self.fig_probe_cb.getAxis('top').label.toPlainText()
         self.set_axis(self.fig_probe_cb, 'top', pen='w')
         self.fig_data_layout.addItem(self.fig_line, 1, 0)
@@ -449,7 +463,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             self.toggle_plots(self.line_options_group)
             plot = self.line_options_group.checkedAction()
 
-        [self.fig_probe_cb.addItem(cbar) for cbar in self.probe_cbars]
+        self.probe_cbar_pool.show()
         self.set_axis(self.fig_probe_cb, 'top', pen='k', label=text)
         self.set_font(self.fig_line, 'left', ptsize=8, width=ax_width)
         self.set_font(self.fig_line, 'bottom', ptsize=8)
@@ -535,6 +549,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
     Plot functions
     """
 
+    @timing.timed()
     def plot_histology(self, fig, ax='left', movable=True):
         """
         Plots histology figure - brain regions that intersect with probe track
@@ -596,6 +611,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         fig.addItem(self.tip_pos)
         fig.addItem(self.top_pos)
 
+    @timing.timed()
     def plot_histology_ref(self, fig, ax='right', movable=False):
         """
         Plots histology figure - brain regions that intersect with probe track
@@ -638,6 +654,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         fig.addItem(self.tip_pos)
         fig.addItem(self.top_pos)
 
+    @timing.timed()
     def plot_histology_nearby(self, fig, ax='right', movable=False):
         """
         Plots histology figure - brain regions that intersect with probe track
@@ -737,6 +754,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         # to automatically have lines go to correct position
         # self.loaddata.track2feature(line_track, self.idx)
 
+    @timing.timed()
     def plot_scale_factor(self):
         """
         Plots the scale factor applied to brain regions along probe track, displayed
@@ -771,6 +789,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.set_axis(self.fig_scale, 'bottom', pen='w', label='blank')
         self.fig_scale_cb.addItem(cbar)
 
+    @timing.timed()
     def plot_fit(self):
         """
         Plots the scale factor and offset applied to channels along depth of probe track
@@ -788,6 +807,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         else:
             self.fit_plot_lin.setData()
 
+    @timing.timed()
     def plot_slice(self, data, img_type):
         self.fig_slice.clear()
         self.slice_chns = []
@@ -828,6 +848,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.fig_slice.addItem(self.traj_line)
         self.plot_channels()
 
+    @timing.timed()
     def plot_channels(self):
         self.channel_status = True
         self.xyz_channels = self.ephysalign.get_channel_locations(self.features[self.idx],
@@ -862,6 +883,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             self.slice_chns.setData(x=self.xyz_channels[:, 0], y=self.xyz_channels[:, 2], pen='r',
                                     brush='r')
 
+    @timing.timed()
     def plot_scatter(self, data):
         """
         Plots a 2D scatter plot with electrophysiology data
@@ -879,60 +901,51 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             print('data for this plot not available')
             return
         else:
-            [self.fig_img.removeItem(plot) for plot in self.img_plots]
-            [self.fig_img_cb.removeItem(cbar) for cbar in self.img_cbars]
-            self.img_plots = []
-            self.img_cbars = []
+            self.clear_img_plots()
 
             size = data['size'].tolist()
             symbol = data['symbol'].tolist()
 
             color_bar = cb.ColorBar(data['cmap'])
-            cbar = color_bar.makeColourBar(20, 5, self.fig_img_cb, min=np.min(data['levels'][0]),
-                                           max=np.max(data['levels'][1]), label=data['title'])
-            self.fig_img_cb.addItem(cbar)
-            self.img_cbars.append(cbar)
+            color_bar.makeColourBar(20, 5, self.fig_img_cb, min=np.min(data['levels'][0]),
+                                    max=np.max(data['levels'][1]), label=data['title'],
+                                    cbar=self.img_cbar_pool.use()[0])
 
             if type(np.any(data['colours'])) == QtGui.QColor:
                 brush = data['colours'].tolist()
-                plot = pg.ScatterPlotItem()
-                plot.setData(x=data['x'], y=data['y'],
-                             symbol=symbol, size=size, brush=brush, pen=data['pen'])
-
             else:
                 brush = color_bar.getBrush(data['colours'],
                                            levels=[data['levels'][0], data['levels'][1]])
-                plot = pg.ScatterPlotItem()
-                plot.setData(x=data['x'], y=data['y'],
-                             symbol=symbol, size=size, brush=brush, pen=data['pen'])
+
+            plot = self.img_scatter_pool.use()[0]
+            plot.setData(x=data['x'], y=data['y'],
+                         symbol=symbol, size=size, brush=brush, pen=data['pen'])
                            
             # Add markers to indicate behavioral events, if any
             if 'events' in data:
-                for events in data['events']:
-                    plot_events = pg.ScatterPlotItem()
-                    plot_events.setData(x=events['times'], 
-                                        y=[self.probe_top + self.probe_extra + events['offset']] * len(events['times']), 
-                                        **events['setting'])
-                    self.fig_img.addItem(plot_events)
-                    self.img_plots.append(plot_events)
-
-            self.fig_img.addItem(plot)
+                self.plot_events(data['events'])
+
             self.fig_img.setXRange(min=data['xrange'][0], max=data['xrange'][1],
                                    padding=0)
             self.fig_img.setYRange(min=self.probe_tip - self.probe_extra,
                                    max=self.probe_top + self.probe_extra, padding=self.pad)
             self.set_axis(self.fig_img, 'bottom', label=data['xaxis'])
             self.scale = 1
-            self.img_plots.append(plot)
             self.data_plot = plot
             self.xrange = data['xrange']
 
             if data['cluster']:
-                self.data = {'x': data['x'], 'y': data['y']}
-                self.click_indicator = []
-                self.data_plot.sigClicked.connect(self.cluster_clicked)
-
-
+                self.data = {'x': data['x'], 'y': data['y'], 'clust_idx': data['clust_idx']}
+                # Spatial index of the points, coordinates are scaled by the extent of the plot
+                # so distances are comparable along both axes
+                self.data['scale'] = np.array([np.ptp(data['xrange']) or 1,
+                                               self.probe_top - self.probe_tip +
+                                               2 * self.probe_extra])
+                self.data['tree'] = cKDTree(np.c_[data['x'], data['y']] / self.data['scale'])
+                # Point on the scatter of each cluster
+                self.data['point_idx'] = np.argsort(data['clust_idx'])
+
+    @timing.timed()
     def plot_line(self, data):
         """
         Plots a 1D line plot with electrophysiology data
@@ -948,18 +961,15 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             print('data for this plot not available')
             return
         else:
-            [self.fig_line.removeItem(plot) for plot in self.line_plots]
-            self.line_plots = []
-            line = pg.PlotCurveItem()
+            line = self.line_pool.use()[0]
             line.setData(x=data['x'], y=data['y'])
             line.setPen(self.kpen_solid)
-            self.fig_line.addItem(line)
             self.fig_line.setXRange(min=data['xrange'][0], max=data['xrange'][1], padding=0)
             self.fig_line.setYRange(min=self.probe_tip - self.probe_extra,
                                     max=self.probe_top + self.probe_extra, padding=self.pad)
             self.set_axis(self.fig_line, 'bottom', label=data['xaxis'])
-            self.line_plots.append(line)
 
+    @timing.timed()
     def plot_probe(self, data, bounds=None):
         """
         Plots a 2D image with probe geometry
@@ -978,30 +988,22 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             print('data for this plot not available')
             return
         else:
-            [self.fig_probe.removeItem(plot) for plot in self.probe_plots]
-            [self.fig_probe_cb.removeItem(cbar) for cbar in self.probe_cbars]
-            [self.fig_probe.removeItem(line) for line in self.probe_bounds]
             self.set_axis(self.fig_probe_cb, 'top', pen='w')
-            self.probe_plots = []
-            self.probe_cbars = []
-            self.probe_bounds = []
             color_bar = cb.ColorBar(data['cmap'])
             lut = color_bar.getColourMap()
-            for img, scale, offset in zip(data['img'], data['scale'], data['offset']):
-                image = pg.ImageItem()
+            images = self.probe_image_pool.use(len(data['img']))
+            for image, img, scale, offset in zip(images, data['img'], data['scale'],
+                                                 data['offset']):
                 image.setImage(img)
                 transform = [scale[0], 0., 0., 0., scale[1], 0., offset[0],
                              offset[1], 1.]
                 image.setTransform(QtGui.QTransform(*transform))
                 image.setLookupTable(lut)
                 image.setLevels((data['levels'][0], data['levels'][1]))
-                self.fig_probe.addItem(image)
-                self.probe_plots.append(image)
 
-            cbar = color_bar.makeColourBar(20, 5, self.fig_probe_cb, min=data['levels'][0],
-                                           max=data['levels'][1], label=data['title'], lim=True)
-            self.fig_probe_cb.addItem(cbar)
-            self.probe_cbars.append(cbar)
+            color_bar.makeColourBar(20, 5, self.fig_probe_cb, min=data['levels'][0],
+                                    max=data['levels'][1], label=data['title'], lim=True,
+                                    cbar=self.probe_cbar_pool.use()[0])
 
             self.fig_probe.setXRange(min=data['xrange'][0], max=data['xrange'][1], padding=0)
             self.fig_probe.setYRange(min=self.probe_tip - self.probe_extra,
@@ -1010,11 +1012,13 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             self.set_axis(self.fig_probe, 'bottom', pen='w', label='blank')
             if bounds is not None:
                 # add some infinite line stuff
-                for bound in bounds:
-                    line = pg.InfiniteLine(pos=bound, angle=0, pen='w')
-                    self.fig_probe.addItem(line)
-                    self.probe_bounds.append(line)
+                lines = self.probe_bound_pool.use(len(bounds))
+                for line, bound in zip(lines, bounds):
+                    line.setPos(bound)
+            else:
+                self.probe_bound_pool.clear()
 
+    @timing.timed()
     def plot_image(self, data):
         """
         Plots a 2D image with with electrophysiology data
@@ -1033,13 +1037,10 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             print('data for this plot not available')
             return
         else:
-            [self.fig_img.removeItem(plot) for plot in self.img_plots]
-            [self.fig_img_cb.removeItem(cbar) for cbar in self.img_cbars]
+            self.clear_img_plots()
             self.set_axis(self.fig_img_cb, 'top', pen='w')
-            self.img_plots = []
-            self.img_cbars = []
 
-            image = pg.ImageItem()
+            image = self.img_image_pool.use()[0]
             image.setImage(data['img'])
             transform = [data['scale'][0], 0., 0., 0., data['scale'][1], 0., data['offset'][0],
                          data['offset'][1], 1.]
@@ -1050,25 +1051,17 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
                 lut = color_bar.getColourMap()
                 image.setLookupTable(lut)
                 image.setLevels((data['levels'][0], data['levels'][1]))
-                cbar = color_bar.makeColourBar(20, 5, self.fig_img_cb, min=data['levels'][0],
-                                               max=data['levels'][1], label=data['title'])
-                self.fig_img_cb.addItem(cbar)
-                self.img_cbars.append(cbar)
+                color_bar.makeColourBar(20, 5, self.fig_img_cb, min=data['levels'][0],
+                                        max=data['levels'][1], label=data['title'],
+                                        cbar=self.img_cbar_pool.use()[0])
             else:
+                image.setLookupTable(None)
                 image.setLevels((1, 0))
                 
             # Add markers to indicate behavioral events, if any
             if 'events' in data:
-                for events in data['events']:
-                    plot_events = pg.ScatterPlotItem()
-                    plot_events.setData(x=events['times'], 
-                                        y=[self.probe_top + self.probe_extra + events['offset']] * len(events['times']), 
-                                        **events['setting'])
-                    self.fig_img.addItem(plot_events)
-                    self.img_plots.append(plot_events)
-
-            self.fig_img.addItem(image)
-            self.img_plots.append(image)
+                self.plot_events(data['events'])
+
             self.fig_img.setXRange(min=data['xrange'][0], max=data['xrange'][1], padding=0)
             self.fig_img.setYRange(min=self.probe_tip - self.probe_extra,
                                    max=self.probe_top + self.probe_extra, padding=self.pad)
@@ -1077,6 +1070,58 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             self.data_plot = image
             self.xrange = data['xrange']
 
+    def plot_events(self, events):
+        """
+        Plots behavioural event markers above the probe. All events of a group are drawn as
+        vertical ticks in a single curve so that long sessions don't add an item per trial
+        param events: list of event groups
+            [{'name': name of event group, used to toggle its visibility, string
+              'times': times of events, np.array((nevents)), float
+              'offset': offset above probe top of markers, float
+              'setting': arguments to pg.mkPen, dict
+            }]
+        type events: list
+        """
+        y = self.probe_top + self.probe_extra
+        for event in events:
+            times = np.asarray(event['times'], dtype=float)
+            times = times[np.isfinite(times)]
+            item = self.event_items.get(event['name'])
+            if item is None:
+                item = pg.PlotCurveItem()
+                self.fig_img.addItem(item)
+                self.event_items[event['name']] = item
+                action = QtGui.QAction(event['name'], self, checkable=True, checked=True)
+                action.toggled.connect(lambda checked, name=event['name']:
+                                       self.toggle_event_markers(name, checked))
+                self.event_menu.addAction(action)
+                self.event_actions[event['name']] = action
+
+            item.setData(x=np.repeat(times, 2),
+                         y=np.tile([y + event['offset'] - self.event_height / 2,
+                                    y + event['offset'] + self.event_height / 2], times.size),
+                         connect='pairs', pen=pg.mkPen(**event['setting']))
+            item.setVisible(self.event_actions[event['name']].isChecked())
+            self.event_shown.add(event['name'])
+
+    def toggle_event_markers(self, name, checked):
+        """
+        Show or hide a group of behavioural event markers without replotting
+        """
+        self.event_items[name].setVisible(checked and name in self.event_shown)
+
+    def clear_img_plots(self):
+        """
+        Hide the event markers and pooled data items of the image figure
+        """
+        [item.setVisible(False) for item in self.event_items.values()]
+        self.event_shown = set()
+        self.data = None
+        self.img_image_pool.clear()
+        self.img_scatter_pool.clear()
+        self.img_cbar_pool.clear()
+        self.click_indicator.setVisible(False)
+
     """
     Interaction functions
     """
@@ -1136,17 +1181,18 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
     def on_alignment_selected(self, idx):
         self.feature_prev, self.track_prev = self.loaddata.get_starting_alignment(idx)
 
+    @timing.timed()
     def data_button_pressed(self):
         """
         Triggered when Get Data button pressed, uses subject and session info to find eid and
         downloads and computes data needed for GUI display
         """
         # Clear all plots from previous session
-        [self.fig_img.removeItem(plot) for plot in self.img_plots]
-        [self.fig_img.removeItem(cbar) for cbar in self.img_cbars]
-        [self.fig_line.removeItem(plot) for plot in self.line_plots]
-        [self.fig_probe.removeItem(plot) for plot in self.probe_plots]
-        [self.fig_probe.removeItem(cbar) for cbar in self.probe_cbars]
+        self.clear_img_plots()
+        self.line_pool.clear()
+        self.probe_image_pool.clear()
+        self.probe_cbar_pool.clear()
+        self.probe_bound_pool.clear()
         self.fig_slice.clear()
         self.fig_hist.clear()
         self.fig_hist_ref.clear()
@@ -1161,16 +1207,19 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             if not self.alf_path:
                 return
             else:
+                timing.set_session(self.alf_path)
                 self.xyz_picks = self.loaddata.get_xyzpicks()
 
-        if np.any(self.feature_prev):
-            self.ephysalign = EphysAlignment(self.xyz_picks, self.chn_depths,
-                                             track_prev=self.track_prev,
-                                             feature_prev=self.feature_prev,
-                                             brain_atlas=self.loaddata.brain_atlas)
-        else:
-            self.ephysalign = EphysAlignment(self.xyz_picks, self.chn_depths,
-                                             brain_atlas=self.loaddata.brain_atlas)
+        with timing.span('EphysAlignment.__init__'):
+            if np.any(self.feature_prev):
+                self.ephysalign = EphysAlignment(self.xyz_picks, self.chn_depths,
+                                                 track_prev=self.track_prev,
+                                                 feature_prev=self.feature_prev,
+                                                 brain_atlas=self.loaddata.brain_atlas)
+            else:
+                self.ephysalign = EphysAlignment(self.xyz_picks, self.chn_depths,
+                                                 brain_atlas=self.loaddata.brain_atlas)
+        timing.instrument(self.ephysalign)
 
         self.features[self.idx], self.track[self.idx], self.xyz_track \
             = self.ephysalign.get_track_and_feature()
@@ -1186,29 +1235,32 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             = self.ephysalign.scale_histology_regions(self.ephysalign.track_extent,
                                                       self.ephysalign.track_extent)
         self.hist_data_ref['colour'] = self.ephysalign.region_colour
+        # Start computing the nearby boundaries in the background
+        self.compute_nearby_boundaries()
 
         if not self.data_status:
-            self.plotdata = pd.PlotData(self.alf_path, ephys_path, self.current_shank_idx)
+            self.plotdata = timing.instrument(pd.PlotData(self.alf_path, ephys_path,
+                                                          self.current_shank_idx))
             self.set_lims(np.min([0, self.plotdata.chn_min]), self.plotdata.chn_max)
             
             self.behav_event_data = self.loaddata.get_behavioral_event_data()
-            
-            self.scat_drift_data = self.plotdata.get_depth_data_scatter(events=self.behav_event_data)
-            (self.scat_fr_data, self.scat_p2t_data,
-             self.scat_amp_data) = self.plotdata.get_fr_p2t_data_scatter()
-            self.img_corr_data = self.plotdata.get_correlation_data_img()
 
-            self.img_lfp_corr_data = self.plotdata.get_lfp_corr_cov_data_img(if_corr=True)
-            self.img_lfp_cov_data = self.plotdata.get_lfp_corr_cov_data_img(if_corr=False)
-            
-            self.img_fr_data = self.plotdata.get_fr_img(events=self.behav_event_data)
-            self.img_rms_APdata, self.probe_rms_APdata = self.plotdata.get_rms_data_img_probe('AP')
-            self.img_rms_LFPdata, self.probe_rms_LFPdata = self.plotdata.get_rms_data_img_probe(
-                'LF')
-            self.img_lfp_data, self.probe_lfp_data = self.plotdata.get_lfp_spectrum_data()
-            self.line_fr_data, self.line_amp_data = self.plotdata.get_fr_amp_data_line()
-            self.probe_rfmap, self.rfmap_boundaries = self.plotdata.get_rfmap_data()
-            self.img_stim_data = self.plotdata.get_passive_events()
+            # Use plot data precomputed by precompute_plot_data if it is up to date
+            plot_data = precompute.load_plot_data(self.alf_path, ephys_path,
+                                                  self.current_shank_idx)
+            if plot_data is None:
+                plot_data = precompute.compute_plot_data(self.plotdata)
+            elif self.plotdata.spike_data_status:
+                # Sets the cluster ids used by the cluster popups, normally set while computing
+                self.plotdata.get_cluster_stats()
+            for key, data in plot_data.items():
+                setattr(self, key, data)
+
+            # Add behavioral events, if any
+            if self.behav_event_data is not None:
+                for data in [self.scat_drift_data, self.img_fr_data]:
+                    if data:
+                        self.plotdata.add_behavioral_events(data, self.behav_event_data)
 
             self.slice_data = self.loaddata.get_slice_images(self.ephysalign.xyz_samples)
 
@@ -1247,19 +1299,50 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.configure = False
 
     def compute_nearby_boundaries(self):
-        nearby_bounds = self.ephysalign.get_nearest_boundary(self.ephysalign.xyz_samples,
-                                                             self.allen, steps=6,
-                                                             brain_atlas=self.loaddata.brain_atlas)
-        [self.hist_nearby_x, self.hist_nearby_y,
-         self.hist_nearby_col] = self.ephysalign.arrange_into_regions(
-            self.ephysalign.sampling_trk, nearby_bounds['id'], nearby_bounds['dist'],
-            nearby_bounds['col'])
-
-        [self.hist_nearby_parent_x,
-         self.hist_nearby_parent_y,
-         self.hist_nearby_parent_col] = self.ephysalign.arrange_into_regions(
-            self.ephysalign.sampling_trk, nearby_bounds['parent_id'], nearby_bounds['parent_dist'],
-            nearby_bounds['parent_col'])
+        """
+        Computes the distance to the nearest boundary along the track on a worker thread. Results
+        are cached by track hash, so only a new trajectory triggers a computation
+        """
+        self.nearby_key = nb.track_hash(self.ephysalign.xyz_samples)
+        if self.nearby_key in self.nearby_cache:
+            self.set_nearby_boundaries(self.nearby_cache[self.nearby_key])
+            return
+        if self.nearby_key in self.nearby_workers:
+            return
+
+        worker = nb.NearbyBoundaryWorker(self.nearby_key, self.ephysalign.xyz_samples,
+                                         self.ephysalign.sampling_trk, self.allen,
+                                         self.loaddata.brain_atlas)
+        worker.computed.connect(self.nearby_boundaries_computed)
+        worker.finished.connect(lambda key=self.nearby_key: self.nearby_workers.pop(key, None))
+        self.nearby_workers[self.nearby_key] = worker
+        worker.start()
+
+    def nearby_boundaries_computed(self, key, nearby):
+        """
+        Triggered when the worker thread has finished computing the nearby boundaries
+        :param key: hash of track the boundaries were computed for
+        :type key: str
+        :param nearby: nearby regions and their parents arranged for plotting
+        :type nearby: dict
+        """
+        if nearby is None:
+            return
+        self.nearby_cache[key] = nearby
+        # Ignore results for a track that is no longer displayed
+        if key != self.nearby_key:
+            return
+        self.set_nearby_boundaries(nearby)
+        if not self.hist_bound_status:
+            self.plot_histology_nearby(self.fig_hist_ref)
+
+    def set_nearby_boundaries(self, nearby):
+        self.hist_nearby_x = nearby['x']
+        self.hist_nearby_y = nearby['y']
+        self.hist_nearby_col = nearby['col']
+        self.hist_nearby_parent_x = nearby['parent_x']
+        self.hist_nearby_parent_y = nearby['parent_y']
+        self.hist_nearby_parent_col = nearby['parent_col']
 
     def toggle_histology_button_pressed(self):
         self.hist_bound_status = not self.hist_bound_status
@@ -1267,8 +1350,9 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         if not self.hist_bound_status:
             if self.hist_nearby_x is None:
                 self.compute_nearby_boundaries()
-
-            self.plot_histology_nearby(self.fig_hist_ref)
+            # If still being computed the plot is made once the worker has finished
+            if self.hist_nearby_x is not None:
+                self.plot_histology_nearby(self.fig_hist_ref)
         else:
             self.plot_histology_ref(self.fig_hist_ref)
 
@@ -1289,6 +1373,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.plot_probe(self.probe_rms_APdata)
         self.plot_line(self.line_fr_data)
 
+    @timing.timed()
     def fit_button_pressed(self):
         """
         Triggered when fit button or Enter key pressed, applies scaling factor to brain regions
@@ -1325,6 +1410,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
                                 max=self.probe_top + self.probe_extra, padding=self.pad)
         self.update_string()
 
+    @timing.timed()
     def offset_button_pressed(self):
         """
         Triggered when offset button or o key pressed, applies offset to brain regions according to
@@ -1579,16 +1665,76 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         Triggered when complete button or Shift+F key pressed. Uploads final channel locations to
         Alyx
         """
+        # Whether the channels are uploaded depends on the qc of the previous upload, which is
+        # only known once it has been sent
+        if self.outbox.find(type='alignment', probe_id=self.loaddata.probe_id):
+            QtGui.QMessageBox.warning(self, 'Status', "Previous alignment of this probe is still "
+                                                      "being uploaded, try again once it is done")
+            # Retry the upload in case it failed before
+            self.start_uploads()
+            return
+
         upload = QtGui.QMessageBox.question(self, '', "Upload alignment?",
                                             QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
 
         if upload == QtGui.QMessageBox.Yes:
-            upload_channels = self.loaddata.upload_data(self.xyz_channels)
-            self.loaddata.update_alignments(self.features[self.idx], self.track[self.idx])
-            self.prev_alignments = self.loaddata.get_previous_alignments()
+            steps, upload_channels = self.loaddata.build_upload(self.xyz_channels,
+                                                                self.features[self.idx],
+                                                                self.track[self.idx])
+            self.outbox.add(steps, info={'type': 'alignment', 'upload_channels': upload_channels,
+                                         'probe_id': self.loaddata.probe_id})
+            self.start_uploads()
+            self.prev_alignments = self.loaddata.set_previous_alignments()
             self.populate_lists(self.prev_alignments, self.align_list, self.align_combobox)
             self.loaddata.get_starting_alignment(0)
-            resolved = self.loaddata.update_qc()
+        else:
+            pass
+            QtGui.QMessageBox.information(self, 'Status', "Channels not saved")
+
+    def init_outbox(self):
+        """
+        Create the outbox of uploads to Alyx and send any uploads left from previous sessions
+        """
+        base_url = getattr(self.loaddata.one.alyx, '_base_url', None) or ''
+        self.outbox = outbox.UploadOutbox(self.loaddata.one.alyx.rest,
+                                          folder=outbox.outbox_folder(base_url),
+                                          handlers={'qc': self.loaddata.run_qc,
+                                                    'dj': self.loaddata.insert_dj})
+        self.start_uploads()
+
+    def start_uploads(self):
+        """
+        Send the uploads in the outbox in a worker thread. If the worker is already running the
+        outbox is flushed again once it has finished
+        """
+        if self.upload_worker is not None and self.upload_worker.isRunning():
+            self.upload_pending = True
+            return
+        self.upload_pending = False
+        self.upload_worker = outbox.UploadWorker(self.outbox)
+        self.upload_worker.done.connect(self.upload_done)
+        self.upload_worker.failed.connect(self.upload_failed)
+        self.upload_worker.finished.connect(self.upload_worker_finished)
+        self.upload_worker.start()
+
+    def upload_worker_finished(self):
+        if self.upload_pending:
+            self.start_uploads()
+
+    def upload_failed(self, job_id, info, error):
+        if info.get('type') == 'alignment':
+            QtGui.QMessageBox.warning(self, 'Status', ("Alignment could not be uploaded, it is "
+                                                       "kept and will be uploaded again later\n" +
+                                                       error))
+
+    def upload_done(self, job_id, info, results):
+        """
+        Triggered when the upload worker has sent a job, reports the outcome of an alignment
+        upload
+        """
+        if info.get('type') == 'alignment':
+            upload_channels = info['upload_channels']
+            resolved = results['resolved']
 
             if upload_channels and resolved == 0:
                 # channels saved alignment not resolved
@@ -1606,9 +1752,6 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
                                                          " as alignment has already been "
                                                          "resolved. New user reference lines"
                                                          " have been saved"))
-        else:
-            pass
-            QtGui.QMessageBox.information(self, 'Status', "Channels not saved")
 
     def complete_button_pressed_offline(self):
         """
@@ -1645,7 +1788,9 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             self.display_qc_options()
             return
 
-        self.loaddata.upload_dj(align_qc, ephys_qc, ephys_desc)
+        self.outbox.add([self.loaddata.build_dj_upload(align_qc, ephys_qc, ephys_desc)],
+                        info={'type': 'dj'})
+        self.start_uploads()
         self.complete_button_pressed()
 
     def reset_axis_button_pressed(self):
@@ -1727,24 +1872,32 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
              self, 'Select unit by ID', 'Cluster ID:')
         
         # Manual select unit
-        if done:
+        if done and self.data is None:
+            print('select a cluster plot to select units')
+        elif done:
             clust_idx_in_fig = np.argwhere(self.plotdata.clust_id == clust_id)[0][0]
             self.cluster_clicked([], [], clust_idx_in_fig)
 
+    def scatter_clicked(self, item, point):
+        # Scatter items are reused across plots, only respond when showing clusters
+        if self.data is not None:
+            self.cluster_clicked(item, point)
+
     def cluster_clicked(self, item, point, clust_idx_in_fig=None):
+        # Points may be ordered differently to the clusters, e.g. sorted by peak to trough
         if clust_idx_in_fig is None:  # Otherwise, override
             point_pos = point[0].pos()
-            clust_idx_in_fig = np.argwhere(self.data['x'] == point_pos.x())[0][0]
+            _, point_idx = self.data['tree'].query(np.array([point_pos.x(), point_pos.y()]) /
+                                                   self.data['scale'])
+            clust_idx_in_fig = self.data['clust_idx'][point_idx]
             xx, yy = [point_pos.x()], [point_pos.y()]
         else:
-            xx, yy = [self.data['x'][clust_idx_in_fig]], [self.data['y'][clust_idx_in_fig]]
+            point_idx = self.data['point_idx'][clust_idx_in_fig]
+            xx, yy = [self.data['x'][point_idx]], [self.data['y'][point_idx]]
         
-        # Add click indicator     
-        if self.click_indicator == []:
-            self.click_indicator = pg.ScatterPlotItem()
-            self.fig_img.addItem(self.click_indicator)
-            self.img_plots.append(self.click_indicator)
+        # Add click indicator
         self.click_indicator.setData(x=xx, y=yy, symbol='+', size=30, pen='c')
+        self.click_indicator.setVisible(True)
 
 
         autocorr = self.plotdata.get_autocorr(clust_idx_in_fig)
@@ -1890,6 +2043,27 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             self.fig_fit.addItem(point)
             self.points = np.vstack([self.points, point])
 
+    def on_mouse_moved(self, pos):
+        """
+        Shows the id of the cluster under the mouse as a tooltip when a cluster scatter plot is
+        displayed
+        :param pos: position of mouse in scene coordinates
+        :type pos: QtCore.QPointF
+        """
+        if self.data is None or not self.fig_img.sceneBoundingRect().contains(pos):
+            return
+        view_pos = self.fig_img.vb.mapSceneToView(pos)
+        # Only consider points within a few pixels of the mouse
+        pixel = np.array(self.fig_img.vb.viewPixelSize()) / self.data['scale']
+        dist, point_idx = self.data['tree'].query(
+            np.array([view_pos.x(), view_pos.y()]) / self.data['scale'],
+            distance_upper_bound=5 * np.max(pixel))
+        if np.isinf(dist):
+            self.data_plot.setToolTip('')
+        else:
+            clust = self.plotdata.clust_id[self.data['clust_idx'][point_idx]]
+            self.data_plot.setToolTip(f'Cluster {clust}')
+
     def on_mouse_hover(self, items):
         """
         Returns the pyqtgraph items that the mouse is hovering over. Used to identify reference
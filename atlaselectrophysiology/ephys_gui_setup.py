@@ -4,6 +4,7 @@ import pyqtgraph.exporters
 import numpy as np
 from random import randrange
 from atlaselectrophysiology.AdaptedAxisItem import replace_axis
+import atlaselectrophysiology.ColorBar as cb
 from ibllib.qc.critical_reasons import REASONS_INS_CRIT_GUI
 
 pg.setConfigOption('background', 'w')
@@ -245,11 +246,11 @@ class Setup():
         # Shortcut to apply interpolation
         fit_option = QtGui.QAction('Fit', self)
         fit_option.setShortcut('Return')
-        fit_option.triggered.connect(self.fit_button_pressed)
+        fit_option.triggered.connect(lambda: self.fit_button_pressed())
         # Shortcuts to apply offset
         offset_option = QtGui.QAction('Offset', self)
         offset_option.setShortcut('O')
-        offset_option.triggered.connect(self.offset_button_pressed)
+        offset_option.triggered.connect(lambda: self.offset_button_pressed())
         moveup_option = QtGui.QAction('Offset + 50um', self)
         moveup_option.setShortcut('Shift+Up')
         moveup_option.triggered.connect(self.moveup_button_pressed)
@@ -413,6 +414,8 @@ class Setup():
         
         add_on = menu_bar.addMenu('Add On')
         add_on.addAction(select_unit_by_id)
+        # Groups of behavioural event markers are added when first plotted
+        self.event_menu = add_on.addMenu('Behavioral Events')
 
         # Display other sessions that are closeby if online mode
         if not self.offline:
@@ -426,10 +429,10 @@ class Setup():
         """
         # Button to apply interpolation
         self.fit_button = QtWidgets.QPushButton('Fit')
-        self.fit_button.clicked.connect(self.fit_button_pressed)
+        self.fit_button.clicked.connect(lambda: self.fit_button_pressed())
         # Button to apply offset
         self.offset_button = QtWidgets.QPushButton('Offset')
-        self.offset_button.clicked.connect(self.offset_button_pressed)
+        self.offset_button.clicked.connect(lambda: self.offset_button_pressed())
         # Button to go to next move
         self.next_button = QtWidgets.QPushButton('Next')
         self.next_button.clicked.connect(self.next_button_pressed)
@@ -490,7 +493,7 @@ class Setup():
 
         # Button to get data to display in GUI
         self.data_button = QtWidgets.QPushButton('Get Data')
-        self.data_button.clicked.connect(self.data_button_pressed)
+        self.data_button.clicked.connect(lambda: self.data_button_pressed())
 
         # Arrange interaction features into three different layout groups
         # Group 1
@@ -680,6 +683,7 @@ class Setup():
         self.fig_data_area = pg.GraphicsLayoutWidget()
         self.fig_data_area.scene().sigMouseClicked.connect(self.on_mouse_double_clicked)
         self.fig_data_area.scene().sigMouseHover.connect(self.on_mouse_hover)
+        self.fig_data_area.scene().sigMouseMoved.connect(self.on_mouse_moved)
         self.fig_data_layout = pg.GraphicsLayout()
 
         self.fig_data_layout.addItem(self.fig_img_cb, 0, 0)
@@ -695,6 +699,26 @@ class Setup():
 
         self.fig_data_area.addItem(self.fig_data_layout)
 
+        # Items are added to the data figures once and reused when switching between plots
+        self.img_image_pool = ItemPool(self.fig_img, pg.ImageItem)
+        self.img_scatter_pool = ItemPool(self.fig_img, self.create_cluster_scatter)
+        self.img_cbar_pool = ItemPool(self.fig_img_cb,
+                                      lambda: cb.HorizontalBar(20, 5, QtGui.QLinearGradient()))
+        self.line_pool = ItemPool(self.fig_line, pg.PlotCurveItem)
+        self.probe_image_pool = ItemPool(self.fig_probe, pg.ImageItem)
+        self.probe_cbar_pool = ItemPool(self.fig_probe_cb,
+                                        lambda: cb.HorizontalBar(20, 5, QtGui.QLinearGradient()))
+        self.probe_bound_pool = ItemPool(self.fig_probe,
+                                         lambda: pg.InfiniteLine(angle=0, pen='w'))
+        self.click_indicator = pg.ScatterPlotItem()
+        self.click_indicator.setVisible(False)
+        self.fig_img.addItem(self.click_indicator)
+        # Behavioural event markers, one curve per group of events
+        self.event_items = {}
+        self.event_actions = {}
+        self.event_shown = set()
+        self.event_height = 40
+
         # Figures to show histology data
         # Histology figure that will be updated with user input
         self.fig_hist = pg.PlotItem()
@@ -807,12 +831,59 @@ class Setup():
         self.lin_fit_option.stateChanged.connect(self.lin_fit_option_changed)
         self.on_fig_size_changed()
 
+    def create_cluster_scatter(self):
+        """
+        Scatter item for the image figure, clicks are only handled when it displays clusters
+        """
+        plot = pg.ScatterPlotItem()
+        plot.sigClicked.connect(self.scatter_clicked)
+        return plot
+
     def on_fig_size_changed(self):
         # fig_width = self.fig_fit_exporter.getTargetRect().width()
         # fig_height = self.fig_fit_exporter.getTargetRect().width()
         self.lin_fit_option.move(70, 10)
 
 
+class ItemPool():
+    """
+    Pool of plot items that belong to a figure. Items are created and added to the figure the
+    first time they are needed, after that they are only updated and shown or hidden so that
+    switching between plots doesn't rebuild the scene
+    """
+    def __init__(self, fig, factory):
+        self.fig = fig
+        self.factory = factory
+        self.items = []
+        self.n_used = 0
+
+    def use(self, n=1):
+        """
+        Get n items to plot on, any other items in the pool are hidden
+        :param n: no. of items needed
+        :type n: int
+        :return: list of visible items
+        :type: list
+        """
+        while len(self.items) < n:
+            item = self.factory()
+            self.fig.addItem(item)
+            self.items.append(item)
+        self.n_used = n
+        self.show()
+        return self.items[:n]
+
+    def show(self):
+        [item.setVisible(i < self.n_used) for i, item in enumerate(self.items)]
+
+    def hide(self):
+        [item.setVisible(False) for item in self.items]
+
+    def clear(self):
+        self.n_used = 0
+        self.hide()
+
+
 class PopupWindow(QtGui.QMainWindow):
     closed = QtCore.pyqtSignal(QtGui.QMainWindow)
     moved = QtCore.pyqtSignal()
@@ -1,91 +1,192 @@
 '''
-Extract channel locations from reference points of previous alignments saved in json field of
+Compute the scale factors of the histology regions of previous alignments saved in json field of
 trajectory object
-Create plot showing histology regions which channels pass through as well as coronal slice with
-channel locations shown
+The histology regions are sampled once per trajectory and the scale factors of all alignments
+solved with vectorised piecewise linear interpolation. Results are saved to a parquet table keyed
+by alignment hash so only new or changed alignments are computed when run again
+Create plot showing the scale factors of the alignments of a subject
 '''
 
 # import modules
-from oneibl.one import ONE
+from pathlib import Path
+
 from ibllib.pipes.ephys_alignment import EphysAlignment
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import ibllib.atlas as atlas
 
+from atlaselectrophysiology.compare_alignments import (AlignmentComparison, alignment_hash,
+                                                       BRAINWIDE_DJANGO)
 
-# Instantiate brain atlas and one
-brain_atlas = atlas.AllenAtlas(25)
-one = ONE()
+SCALE_FACTOR_FILE = Path.home().joinpath('.iblapps', 'scale_factors.pqt')
+COLUMNS = ['alignment_hash', 'probe_insertion', 'Session', 'User', 'Scale Factor',
+           'Avg Scale Factor', 'Region Start', 'Region End']
 
-# Find eid of interest
-subject = 'KS022'
 
-# Find the ephys aligned trajectory for eid probe combination
-trajectory = one.alyx.rest('trajectories', 'list', provenance='Ephys aligned histology track',
-                           subject=subject)
+def track2feature(x, feature, track):
+    """
+    Piecewise linear map from track to feature coordinates defined by the reference lines of an
+    alignment, extrapolated linearly beyond the first and last reference line. Same as
+    EphysAlignment.track2feature for any number of points at once
+    """
+    order = np.argsort(track)
+    track = np.asarray(track, dtype=float)[order]
+    feature = np.asarray(feature, dtype=float)[order]
+    slope = np.diff(feature) / np.diff(track)
+    seg = np.clip(np.searchsorted(track, x, side='right') - 1, 0, track.size - 2)
+    return feature[seg] + slope[seg] * (x - track[seg])
 
-# Load in channels.localCoordinates dataset type
-chn_coords = one.load(trajectory[0]['session']['id'],
-                      dataset_types=['channels.localCoordinates'])[0]
-depths = chn_coords[:, 1]
 
-subject_summary = pd.DataFrame(columns={'Session', 'User', 'Scale Factor', 'Avg Scale Factor'})
-sf = []
-sess = []
-user = []
-for traj in trajectory:
-    alignments = traj['json']
+def scale_regions(region, feature, track):
+    """
+    Scale factor of each histology region and the regions merged where consecutive regions have
+    the same scale factor, as EphysAlignment.get_scale_factor
+    :param region: boundaries of histology regions along track of the original track (m)
+    :type region: np.array((nregions, 2))
+    :return scaled_region: boundaries of the merged regions in feature space (um)
+    :type scaled_region: np.array((nscaled, 2))
+    :return scale_factor: scale factor of each merged region
+    :type scale_factor: np.array(nscaled)
+    """
+    region_feature = track2feature(region, feature, track) * 1e6
+    scale = np.diff(region_feature, axis=1)[:, 0] / np.diff(region * 1e6, axis=1)[:, 0]
+    # Last region of each run of regions with same scale factor
+    last = np.r_[np.flatnonzero(np.diff(np.around(scale, 3))), scale.size - 1]
+    first = np.r_[0, last[:-1] + 1]
+    scaled_region = np.c_[region_feature[first, 0], region_feature[last, 1]]
+    if last.size == 1:
+        return scaled_region, np.unique(scale)
+    return scaled_region, scale[last]
 
-    insertion = one.alyx.rest('insertions', 'list', session=traj['session']['id'],
-                              name=traj['probe_name'])
-    xyz_picks = np.array(insertion[0]['json']['xyz_picks']) / 1e6
 
-    session_info = traj['session']['start_time'][:10] + '_' + traj['probe_name']
+def average_scale_factor(scale_factor, feature):
+    """
+    Single scale factor representing the scaling of an alignment
+    """
+    if np.all(np.round(np.diff(scale_factor), 3) == 0):
+        # Case where there is no scaling but just an offset
+        return 1
+    if feature.size > 4:
+        # Case where 3 or more reference lines have been placed so take gradient of
+        # linear fit to represent average scaling factor
+        return scale_factor[0]
+    # Case where 2 reference lines have been used. Only have local scaling between
+    # two reference lines, everywhere else scaling is 1. Use the local scaling as the
+    # average scaling factor
+    return np.mean(scale_factor[1:-1])
 
-    for iK, key in enumerate(alignments):
-        # Location of reference lines used for alignmnet
-        feature = np.array(alignments[key][0])
-        track = np.array(alignments[key][1])
-        user = key[:19]
-        # Instantiate EphysAlignment object
-        ephysalign = EphysAlignment(xyz_picks, depths, track_prev=track, feature_prev=feature)
-        region_scaled, _ = ephysalign.scale_histology_regions(feature, track)
-        _, scale_factor = ephysalign.get_scale_factor(region_scaled)
 
+def compute_scale_factors(insertion, region, keys=None):
+    """
+    Rows of the scale factor table for the alignments of an insertion
+    :param insertion: insertion info, see AlignmentComparison.get_insertions
+    :param region: histology regions along the track of the insertion, EphysAlignment.region
+    :param keys: alignment keys to compute, defaults to all
+    :return: one row per scale factor of each alignment
+    :type: list of dict
+    """
+    rows = []
+    for key in keys or insertion['alignments'].keys():
+        feature = np.array(insertion['alignments'][key][0])
+        track = np.array(insertion['alignments'][key][1])
+        scaled_region, scale_factor = scale_regions(region, feature, track)
         if np.all(np.round(np.diff(scale_factor), 3) == 0):
-            # Case where there is no scaling but just an offset
+            scaled_region = np.array([[scaled_region[0, 0], scaled_region[-1, 1]]])
             scale_factor = np.array([1])
-            avg_sf = 1
+        avg_sf = average_scale_factor(scale_factor, feature)
+        key_hash = alignment_hash(insertion['xyz_picks'], insertion['depths'], feature, track)
+        for iS, (sf, reg) in enumerate(zip(scale_factor, scaled_region)):
+            rows.append({'alignment_hash': key_hash,
+                         'probe_insertion': insertion['probe_insertion'],
+                         'Session': insertion['date'] + '_' + insertion['probe_name'],
+                         'User': key[:19], 'Scale Factor': float(sf),
+                         'Avg Scale Factor': float(avg_sf) if iS == 0 else np.NaN,
+                         'Region Start': reg[0], 'Region End': reg[1]})
+    return rows
+
+
+class ScaleFactorTable:
+    def __init__(self, file=SCALE_FACTOR_FILE, brain_atlas=None):
+        """
+        :param file: parquet file scale factors are saved to
+        :param brain_atlas: atlas, only loaded when histology regions need to be sampled
+        """
+        self.file = Path(file)
+        self._brain_atlas = brain_atlas
+        if self.file.exists():
+            self.table = pd.read_parquet(self.file)
         else:
-            if feature.size > 4:
-                # Case where 3 or more reference lines have been placed so take gradient of
-                # linear fit to represent average scaling factor
-                avg_sf = scale_factor[0]
-            else:
-                # Case where 2 reference lines have been used. Only have local scaling between
-                # two reference lines, everywhere else scaling is 1. Use the local scaling as the
-                # average scaling factor
-                avg_sf = np.mean(scale_factor[1:-1])
-
-        for iS, sf in enumerate(scale_factor):
-            if iS == 0:
-                subject_summary = subject_summary.append(
-                    {'Session': session_info, 'User': user, 'Scale Factor': sf,
-                     'Avg Scale Factor': avg_sf}, ignore_index=True)
-            else:
-                subject_summary = subject_summary.append(
-                    {'Session': session_info, 'User': user, 'Scale Factor': sf,
-                     'Avg Scale Factor': np.NaN}, ignore_index=True)
-
-fig, ax = plt.subplots(figsize=(10, 8))
-sns.swarmplot(x='Session', y='Scale Factor', hue='User', data=subject_summary, ax=ax)
-sns.swarmplot(x='Session', y='Avg Scale Factor', hue='User', size=8, linewidth=1,
-                data=subject_summary, ax=ax)
-# ensures value in legend isn't repeated
-handles, labels = ax.get_legend_handles_labels()
-by_label = dict(zip(labels, handles))
-ax.legend(by_label.values(), by_label.keys())
-
-plt.show()
+            self.table = pd.DataFrame(columns=COLUMNS)
+
+    @property
+    def brain_atlas(self):
+        if self._brain_atlas is None:
+            self._brain_atlas = atlas.AllenAtlas(25)
+        return self._brain_atlas
+
+    def update(self, insertions):
+        """
+        Compute the scale factors of alignments not in the table yet and save the table
+        :param insertions: insertion info, see AlignmentComparison.get_insertions
+        :return: rows of the table for the alignments of the insertions
+        :type: pandas.DataFrame
+        """
+        done = set(self.table['alignment_hash'])
+        hashes = []
+        rows = []
+        for insertion in insertions:
+            ins_hashes = AlignmentComparison.hashes(insertion)
+            ins_hashes.pop('original')
+            hashes += ins_hashes.values()
+            keys = [key for key, key_hash in ins_hashes.items() if key_hash not in done]
+            if not keys:
+                continue
+            # Histology regions only depend on the picks so are sampled once per trajectory
+            region = EphysAlignment(np.array(insertion['xyz_picks']) / 1e6,
+                                    np.array(insertion['depths']),
+                                    brain_atlas=self.brain_atlas).region
+            rows += compute_scale_factors(insertion, region, keys)
+
+        if rows:
+            self.table = pd.concat([self.table, pd.DataFrame(rows, columns=COLUMNS)],
+                                   ignore_index=True)
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            self.table.to_parquet(self.file)
+        print(f'{len(rows)} new scale factors computed')
+
+        return self.table[self.table['alignment_hash'].isin(hashes)].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from oneibl.one import ONE
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    parser = argparse.ArgumentParser(description='Scale factors of alignments')
+    parser.add_argument('-s', '--subject', default='KS022', required=False,
+                        help='Subject to plot')
+    parser.add_argument('-a', '--all', default=False, action='store_true',
+                        help='Compute scale factors of all aligned brainwide map insertions')
+    parser.add_argument('-f', '--file', default=SCALE_FACTOR_FILE, required=False,
+                        help='Parquet file to save scale factors to')
+    args = parser.parse_args()
+
+    django = BRAINWIDE_DJANGO if args.all else \
+        f'probe_insertion__session__subject__nickname,{args.subject}'
+    comparison = AlignmentComparison(one=ONE())
+    # Scale factors don't depend on the channel depths so use the default geometry
+    insertions = comparison.get_insertions(django=django, load_channels=False)
+    subject_summary = ScaleFactorTable(args.file).update(insertions)
+
+    fig, ax = plt.subplots(figsize=(10, 8))
+    sns.swarmplot(x='Session', y='Scale Factor', hue='User', data=subject_summary, ax=ax)
+    sns.swarmplot(x='Session', y='Avg Scale Factor', hue='User', size=8, linewidth=1,
+                  data=subject_summary, ax=ax)
+    # ensures value in legend isn't repeated
+    handles, labels = ax.get_legend_handles_labels()
+    by_label = dict(zip(labels, handles))
+    ax.legend(by_label.values(), by_label.keys())
+
+    plt.show()
@@ -10,9 +10,12 @@ import alf.io
 import glob
 import os
 from atlaselectrophysiology.load_histology import download_histology_data, tif2nrrd
+from atlaselectrophysiology.trajectory_cache import TrajectoryCache, cache_file
+import atlaselectrophysiology.channel_table as channel_table
 import ibllib.qc.critical_reasons as usrpmt
 
 ONE_BASE_URL = "https://alyx.internationalbrainlab.org"
+ALIGNED_PROVENANCE = 'Ephys aligned histology track'
 
 
 class LoadData:
@@ -33,8 +36,7 @@ class LoadData:
 
         # Initialise all variables that get assigned
         self.sess_with_hist = None
-        self.traj_ids = None
-        self.traj_coords = None
+        self.traj_cache = None
         self.subjects = None
         self.sess = None
         self.eid = None
@@ -62,23 +64,16 @@ class LoadData:
         :return subjects: list of subjects
         :type: list of strings
         """
-        # All sessions that have a histology track
-        all_hist = self.one.alyx.rest('trajectories', 'list', provenance='Histology track')
-        # Some do not have tracing, exclude these ones
-        self.sess_with_hist = [sess for sess in all_hist if sess['x'] is not None]
+        # All sessions that have a traced histology track, together with the coordinates of the
+        # active part of the track (where electrodes are located). These are cached locally and
+        # only trajectories modified since the last time are downloaded. Used in
+        # get_nearby_trajectories to find sessions with close-by insertions
+        if self.traj_cache is None:
+            base_url = getattr(self.one.alyx, '_base_url', None) or ONE_BASE_URL
+            self.traj_cache = TrajectoryCache(self.one.alyx.rest, file=cache_file(base_url))
+        self.sess_with_hist = self.traj_cache.refresh()
         self.subj_with_hist = [sess['session']['subject'] for sess in self.sess_with_hist]
 
-        # For all histology tracks find the trajectory and coordinates of active part (where
-        # electrodes are located). Used in get_nearby trajectories to find sessions close-by
-        # insertions
-        depths = np.arange(200, 4100, 20) / 1e6
-        trajectories = [atlas.Insertion.from_dict(sess) for sess in self.sess_with_hist]
-        self.traj_ids = [sess['id'] for sess in self.sess_with_hist]
-        self.traj_coords = np.empty((len(self.traj_ids), len(depths), 3))
-        for iT, traj in enumerate(trajectories):
-            self.traj_coords[iT, :] = (histology.interpolate_along_track
-                                       (np.vstack([traj.tip, traj.entry]), depths))
-
         self.subjects = np.unique(self.subj_with_hist)
 
         return self.subjects
@@ -124,16 +119,22 @@ class LoadData:
 
         # Looks for any previous alignments
         ephys_traj_prev = self.one.alyx.rest('trajectories', 'list', probe_insertion=self.probe_id,
-                                             provenance='Ephys aligned histology track')
+                                             provenance=ALIGNED_PROVENANCE)
 
         if ephys_traj_prev:
             self.alignments = ephys_traj_prev[0]['json'] or {}
-            self.prev_align = [*self.alignments.keys()]
-            self.prev_align = sorted(self.prev_align, reverse=True)
-            self.prev_align.append('original')
         else:
             self.alignments = {}
-            self.prev_align = ['original']
+
+        return self.set_previous_alignments()
+
+    def set_previous_alignments(self):
+        """
+        List the alignments already loaded, used when the latest alignment has not been uploaded
+        yet
+        """
+        self.prev_align = sorted(self.alignments.keys(), reverse=True)
+        self.prev_align.append('original')
 
         return self.prev_align
 
@@ -172,19 +173,12 @@ class LoadData:
         :type: list of float
         """
 
-        chosen_traj = self.traj_ids.index(self.traj_id)
-        avg_dist = np.mean(np.sqrt(np.sum((self.traj_coords - self.traj_coords[chosen_traj]) ** 2,
-                                          axis=2)), axis=1)
-        avg_dist_mlap = np.mean(np.sqrt(np.sum((self.traj_coords[:, :, 0:2] -
-                                                self.traj_coords[chosen_traj][:, 0:2]) ** 2,
-                                        axis=2)), axis=1)
-
-        closest_traj = np.argsort(avg_dist)
-        close_dist = avg_dist[closest_traj[0:10]] * 1e6
-        close_dist_mlap = avg_dist_mlap[closest_traj[0:10]] * 1e6
+        closest_traj, close_dist, close_dist_mlap = self.traj_cache.nearby(self.traj_id, n=10)
+        close_dist = close_dist * 1e6
+        close_dist_mlap = close_dist_mlap * 1e6
 
         close_sessions = []
-        for sess_idx in closest_traj[0:10]:
+        for sess_idx in closest_traj:
             close_sessions.append((self.sess_with_hist[sess_idx]['session']['subject'] + ' ' +
                                   self.sess_with_hist[sess_idx]['session']['start_time'][:10] +
                                    ' ' + self.sess_with_hist[sess_idx]['probe_name']))
@@ -387,7 +381,43 @@ class LoadData:
 
         return channel_upload
 
-    def update_alignments(self, feature, track, key_info=None, user_eval=None):
+    def build_upload(self, xyz_channels, feature, track, channels=True):
+        """
+        Build the requests of upload_data, update_alignments and update_qc as the steps of an
+        upload_outbox job. The alignments are updated straight away
+        :return steps: steps of the upload job
+        :type steps: list of dict
+        :return channel_upload: whether the channel locations are uploaded
+        :type channel_upload: bool
+        """
+        self.update_alignments(feature, track, upload=False)
+        steps = []
+        channel_upload = not self.resolved
+        if channel_upload:
+            # Same trajectory and channels as histology.register_aligned_track, the alignments
+            # are added to the new trajectory directly
+            insertion = atlas.Insertion.from_track(xyz_channels, self.brain_atlas)
+            tdict = histology.create_trajectory_dict(self.probe_id, insertion,
+                                                     provenance=ALIGNED_PROVENANCE)
+            tdict['json'] = self.alignments
+            steps.append({'type': 'trajectory',
+                          'data': {key: float(val) if isinstance(val, np.floating) else val
+                                   for key, val in tdict.items()}})
+            if channels:
+                brain_regions = self.brain_atlas.regions.get(
+                    self.brain_atlas.get_labels(xyz_channels))
+                table = channel_table.channel_table(xyz_channels, self.chn_coords, brain_regions)
+                steps.append({'type': 'channels', 'data': channel_table.alyx_channels(table)})
+        else:
+            steps.append({'type': 'json', 'data': {'probe_insertion': self.probe_id,
+                                                   'provenance': ALIGNED_PROVENANCE,
+                                                   'json': self.alignments}})
+
+        steps.append({'type': 'qc', 'data': self.qc_data()})
+
+        return steps, channel_upload
+
+    def update_alignments(self, feature, track, key_info=None, user_eval=None, upload=True):
         if not key_info:
             user = self.one._par.ALYX_LOGIN
             date = datetime.now().replace(microsecond=0).isoformat()
@@ -405,18 +435,25 @@ class LoadData:
             self.alignments.pop(old_user[0])
 
         self.alignments.update(data)
-        self.update_json(self.alignments)
+        if upload:
+            self.update_json(self.alignments)
 
     def update_json(self, json_data):
         # Get the new trajectory
         ephys_traj = self.one.alyx.rest('trajectories', 'list', probe_insertion=self.probe_id,
-                                        provenance='Ephys aligned histology track')
+                                        provenance=ALIGNED_PROVENANCE)
         patch_dict = {'json': json_data}
         self.one.alyx.rest('trajectories', 'partial_update', id=ephys_traj[0]['id'],
                            data=patch_dict)
 
     def upload_dj(self, align_qc, ephys_qc, ephys_desc):
         # Upload qc results to datajoint table
+        self.insert_dj(self.build_dj_upload(align_qc, ephys_qc, ephys_desc)['data'])
+
+    def build_dj_upload(self, align_qc, ephys_qc, ephys_desc):
+        """
+        Build the qc results to insert in the datajoint table as an upload_outbox job step
+        """
         user = self.one._par.ALYX_LOGIN
         if len(ephys_desc) == 0:
             ephys_desc_str = 'None'
@@ -425,24 +462,51 @@ class LoadData:
             ephys_desc_str = ", ".join(ephys_desc)
             ephys_dj_str = ephys_desc_str
 
-        self.qc.insert1(dict(probe_insertion_uuid=self.probe_id, user_name=user,
-                             alignment_qc=align_qc, ephys_qc=ephys_qc,
-                             ephys_qc_description=ephys_dj_str),
-                        allow_direct_insert=True, replace=True)
         self.alyx_str = ephys_qc.upper() + ': ' + ephys_desc_str
 
         if ephys_qc.upper() == 'CRITICAL':
             usrpmt.main_gui(eid=self.probe_id, reasons_selected=ephys_desc, one=self.one)
 
-    def update_qc(self, upload_alyx=True, upload_flatiron=True):
-        # if resolved just update the alignment_number
-        align_qc = AlignmentQC(self.probe_id, one=self.one, brain_atlas=self.brain_atlas)
-        align_qc.load_data(prev_alignments=self.alignments, xyz_picks=self.xyz_picks,
-                           depths=self.chn_depths, cluster_chns=self.cluster_chns)
-        results = align_qc.run(update=True, upload_alyx=upload_alyx,
-                               upload_flatiron=upload_flatiron)
-        align_qc.update_experimenter_evaluation(prev_alignments=self.alignments)
+        return {'type': 'dj', 'data': dict(probe_insertion_uuid=self.probe_id, user_name=user,
+                                           alignment_qc=align_qc, ephys_qc=ephys_qc,
+                                           ephys_qc_description=ephys_dj_str)}
 
-        self.resolved = results['alignment_resolved']
+    def insert_dj(self, data, *args):
+        self.qc.insert1(data, allow_direct_insert=True, replace=True)
+
+    def qc_data(self, upload_alyx=True, upload_flatiron=True):
+        """
+        Data needed to run the alignment qc, stored in upload_outbox jobs
+        """
+        def tolist(data):
+            return None if data is None else np.asarray(data).tolist()
 
-        return self.resolved
+        return {'probe_id': self.probe_id, 'alignments': self.alignments,
+                'xyz_picks': tolist(self.xyz_picks), 'depths': tolist(self.chn_depths),
+                'cluster_chns': tolist(self.cluster_chns), 'upload_alyx': upload_alyx,
+                'upload_flatiron': upload_flatiron}
+
+    def update_qc(self, upload_alyx=True, upload_flatiron=True):
+        return self.run_qc(self.qc_data(upload_alyx=upload_alyx,
+                                        upload_flatiron=upload_flatiron))['resolved']
+
+    def run_qc(self, data, *args):
+        """
+        Run the alignment qc, data from qc_data
+        :return: {'resolved': whether the alignment is resolved}
+        :type: dict
+        """
+        # if resolved just update the alignment_number
+        align_qc = AlignmentQC(data['probe_id'], one=self.one, brain_atlas=self.brain_atlas)
+        xyz_picks, depths, cluster_chns = [None if data[key] is None else np.array(data[key])
+                                           for key in ['xyz_picks', 'depths', 'cluster_chns']]
+        align_qc.load_data(prev_alignments=data['alignments'], xyz_picks=xyz_picks,
+                           depths=depths, cluster_chns=cluster_chns)
+        results = align_qc.run(update=True, upload_alyx=data['upload_alyx'],
+                               upload_flatiron=data['upload_flatiron'])
+        align_qc.update_experimenter_evaluation(prev_alignments=data['alignments'])
+
+        if data['probe_id'] == self.probe_id:
+            self.resolved = results['alignment_resolved']
+
+        return {'resolved': int(results['alignment_resolved'])}
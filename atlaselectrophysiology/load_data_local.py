@@ -5,10 +5,15 @@ from pathlib import Path
 import alf.io
 import glob
 import json
-import scipy
+import scipy.io
+import atlaselectrophysiology.channel_table as channel_table
 
 # brain_atlas = atlas.AllenAtlas(25)
 
+# Columns of digMarkerPerTrial in bitcode.mat, saved as ALF trials.<attribute>.npy
+BITCODE_TRIALS = ['stimTrigger_times', 'goCue_times', 'choiceLeft_times', 'choiceRight_times',
+                  'reward_times', 'iti_times']
+
 
 class LoadDataLocal:
     def __init__(self):
@@ -206,20 +211,16 @@ class LoadDataLocal:
 
         brain_regions = self.brain_atlas.regions.get(self.brain_atlas.get_labels
                                                      (xyz_channels))
-        brain_regions['xyz'] = xyz_channels
-        brain_regions['lateral'] = self.chn_coords[:, 0]
-        brain_regions['axial'] = self.chn_coords[:, 1]
-        assert np.unique([len(brain_regions[k]) for k in brain_regions]).size == 1
-        channel_dict = self.create_channel_dict(brain_regions)
+        table = channel_table.channel_table(xyz_channels, self.chn_coords, brain_regions)
         bregma = atlas.ALLEN_CCF_LANDMARKS_MLAPDV_UM['bregma'].tolist()
         origin = {'origin': {'bregma': bregma}}
-        channel_dict.update(origin)
-        # Save the channel locations
+        # Save the channel locations, as ALF datasets in a folder with the same name as the json
+        # file so they aren't mixed with the channels of the whole probe
         chan_loc_filename = 'channel_locations.json' if self.n_shanks == 1 else \
             f'channel_locations_shank{self.shank_idx + 1}.json'
-
-        with open(self.folder_path.joinpath(chan_loc_filename), "w") as f:
-            json.dump(channel_dict, f, indent=2, separators=(',', ': '))
+        channel_table.save_alf(table, self.folder_path.joinpath(Path(chan_loc_filename).stem))
+        channel_table.write_json(table, self.folder_path.joinpath(chan_loc_filename),
+                                 extra=origin)
         original_json = self.alignments
         date = datetime.now().replace(microsecond=0).isoformat()
         data = {date: [feature.tolist(), track.tolist()]}
@@ -242,94 +243,97 @@ class LoadDataLocal:
         :return channel_dict:
         :type channel_dict: dictionary of dictionaries
         """
-        channel_dict = {}
-        for i in np.arange(brain_regions.id.size):
-            channel = {
-                'x': brain_regions.xyz[i, 0] * 1e6,
-                'y': brain_regions.xyz[i, 1] * 1e6,
-                'z': brain_regions.xyz[i, 2] * 1e6,
-                'axial': brain_regions.axial[i],
-                'lateral': brain_regions.lateral[i],
-                'brain_region_id': int(brain_regions.id[i]),
-                'brain_region': brain_regions.acronym[i]
-            }
-            data = {'channel_' + str(i): channel}
-            channel_dict.update(data)
-
-        return channel_dict
+        table = channel_table.channel_table(brain_regions.xyz,
+                                            np.c_[brain_regions.lateral, brain_regions.axial],
+                                            brain_regions)
+        return channel_table.channel_dict(table)
 
 
     def get_behavioral_event_data(self):
-        # Read behavioral data from bitcode.mat        
-        STRIG_, GOCUE_, CHOICEL_, CHOICER_, REWARD_, ITI_ = 0, 1, 2, 3, 4, 5
-
-        # Load bitcode.mat
-        try:
-            mat = scipy.io.loadmat(glob.glob(str(self.folder_path.parent) + '\\*\\*bitcode.mat')[0])
-            print('Bitcode.mat loaded!')
-        except:
-            print('No bitcode.mat...')
+        """
+        Get the behavioural events of the session grouped by event type and trial outcome
+        :return events: event times, None if the session has no bitcode.mat
+        :type events: dict
+        """
+        trials = self.load_trials()
+        if trials is None:
             return None
-            
-        dig_marker_per_trial = mat['digMarkerPerTrial']
-        
+
+        gocue = trials['goCue_times']
+        iti = trials['iti_times']
+        choiceL = trials['choiceLeft_times']
+        choiceR = trials['choiceRight_times']
+
         # Trial types
-        ignore_trials = np.all(np.isnan(dig_marker_per_trial[:, [CHOICEL_, CHOICER_]]), 1)
-        reward_trials = ~np.isnan(dig_marker_per_trial[:, REWARD_])
+        choiceL_trials = ~np.isnan(choiceL)
+        choiceR_trials = ~np.isnan(choiceR)
+        ignore_trials = ~choiceL_trials & ~choiceR_trials
+        reward_trials = ~np.isnan(trials['reward_times'])
         noreward_trials = ~ignore_trials & ~reward_trials
-        choiceL_trials = ~np.isnan(dig_marker_per_trial[:, CHOICEL_])
-        choiceR_trials = ~np.isnan(dig_marker_per_trial[:, CHOICER_])
-        choice_times = np.nanmean(dig_marker_per_trial[:, [CHOICEL_, CHOICER_]], 1)
+        choice_times = np.where(choiceL_trials, choiceL, choiceR)
+        if np.any(choiceL_trials & choiceR_trials):
+            both = choiceL_trials & choiceR_trials
+            choice_times[both] = (choiceL[both] + choiceR[both]) / 2
+
+        trial_types = {'L_reward': reward_trials & choiceL_trials,
+                       'R_reward': reward_trials & choiceR_trials,
+                       'L_noreward': noreward_trials & choiceL_trials,
+                       'R_noreward': noreward_trials & choiceR_trials}
+
         events = {}
-        
         # ----- All go cues ----
-        events['gocue_all'] = dig_marker_per_trial[:, GOCUE_]
-        events['ignore_all'] = dig_marker_per_trial[ignore_trials, GOCUE_]
+        events['gocue_all'] = np.array(gocue)
+        events['ignore_all'] = gocue[ignore_trials]
         events['left_all'] = choice_times[choiceL_trials]
         events['right_all'] = choice_times[choiceR_trials]
-        events['iti_all'] = dig_marker_per_trial[:, ITI_]
+        events['iti_all'] = np.array(iti)
 
         # ----- Define events times ------
-        # 1. Choice_direction
-        # events['choice_direction'] = {'Left': mat['choiceL'], 'Right': mat['choiceR']}
-
-        # 2. Choice_outcome
-        # choice_reward = choice_times[reward_trials]
-        # choice_noreward = choice_times[noreward_trials]
-        # events['choice_outcome'] = {'reward': choice_reward, 'no_reward': choice_noreward}
-
-        # 1. Gocue_outcome
-        # gocue_reward = dig_marker_per_trial[reward_trials, GOCUE_]
-        # gocue_noreward = dig_marker_per_trial[noreward_trials, GOCUE_]
-        gocue_L_reward = dig_marker_per_trial[reward_trials & choiceL_trials, GOCUE_]
-        gocue_R_reward = dig_marker_per_trial[reward_trials & choiceR_trials, GOCUE_]
-        gocue_L_noreward = dig_marker_per_trial[noreward_trials & choiceL_trials, GOCUE_]
-        gocue_R_noreward = dig_marker_per_trial[noreward_trials & choiceR_trials, GOCUE_]
-        gocue_ignore = dig_marker_per_trial[ignore_trials, GOCUE_]
-        # events['gocue_direction_outcome'] = {'reward': gocue_reward, 'no_reward': gocue_noreward, 'ignore': gocue_ignore}
-        events['gocue_direction_outcome'] = {'L_reward': gocue_L_reward, 'R_reward': gocue_R_reward,
-                                            'L_noreward': gocue_L_noreward, 'R_noreward': gocue_R_noreward,
-                                            'ignore': gocue_ignore}
+        # 1. Gocue_direction_outcome
+        events['gocue_direction_outcome'] = {key: gocue[idx] for key, idx in trial_types.items()}
+        events['gocue_direction_outcome']['ignore'] = gocue[ignore_trials]
         # 2. Choice_direction_outcome
-        choice_L_reward = choice_times[reward_trials & choiceL_trials]
-        choice_R_reward = choice_times[reward_trials & choiceR_trials]
-        choice_L_noreward = choice_times[noreward_trials & choiceL_trials]
-        choice_R_noreward = choice_times[noreward_trials & choiceR_trials]
-        events['choice_direction_outcome'] = {'L_reward': choice_L_reward, 'R_reward': choice_R_reward,
-                                            'L_noreward': choice_L_noreward, 'R_noreward': choice_R_noreward}
-
-        # iti_reward = dig_marker_per_trial[reward_trials, ITI_]
-        # iti_noreward = dig_marker_per_trial[noreward_trials, ITI_]
-        # iti_ignore = dig_marker_per_trial[ignore_trials, ITI_]
-        # events['iti_outcome'] = {'reward': iti_reward, 'no_reward': iti_noreward, 'ignore': iti_ignore}
-
+        events['choice_direction_outcome'] = {key: choice_times[idx] for key, idx in
+                                              trial_types.items()}
         # 3. ITI_choice*outcome
-        iti_L_reward = dig_marker_per_trial[reward_trials & choiceL_trials, ITI_]
-        iti_R_reward = dig_marker_per_trial[reward_trials & choiceR_trials, ITI_]
-        iti_L_noreward = dig_marker_per_trial[noreward_trials & choiceL_trials, ITI_]
-        iti_R_noreward = dig_marker_per_trial[noreward_trials & choiceR_trials, ITI_]
-        events['iti_direction_outcome'] = {'L_reward': iti_L_reward, 'R_reward': iti_R_reward,
-                                        'L_noreward': iti_L_noreward, 'R_noreward': iti_R_noreward}
-
-        return events  
-        
\ No newline at end of file
+        events['iti_direction_outcome'] = {key: iti[idx] for key, idx in trial_types.items()}
+
+        return events
+
+    def load_trials(self):
+        """
+        Load the per trial event times from the bitcode.mat file found in a subfolder of the
+        session. The first time a session is opened the table is parsed from the MATLAB file and
+        saved next to it as ALF trials.*.npy files, these are memory mapped on subsequent opens
+        :return trials: event times for each trial, None if no bitcode.mat found
+        :type trials: dict of np.array((ntrials))
+        """
+        bitcode_files = sorted(self.folder_path.parent.glob('*/*bitcode.mat'))
+        if len(bitcode_files) == 0:
+            print('No bitcode.mat...')
+            return None
+        bitcode_file = bitcode_files[0]
+
+        trials_files = {attr: bitcode_file.parent.joinpath(f'trials.{attr}.npy')
+                        for attr in BITCODE_TRIALS}
+        if all(file.exists() and file.stat().st_mtime >= bitcode_file.stat().st_mtime
+               for file in trials_files.values()):
+            return {attr: np.load(file, mmap_mode='r') for attr, file in trials_files.items()}
+
+        try:
+            mat = scipy.io.loadmat(bitcode_file, variable_names=['digMarkerPerTrial'])
+            dig_marker_per_trial = np.asarray(mat['digMarkerPerTrial'], dtype=float)
+            print('Bitcode.mat loaded!')
+        except Exception as err:
+            print(f'Could not load bitcode.mat: {err}')
+            return None
+
+        trials = {attr: np.ascontiguousarray(dig_marker_per_trial[:, i])
+                  for i, attr in enumerate(BITCODE_TRIALS)}
+        try:
+            for attr, file in trials_files.items():
+                np.save(file, trials[attr])
+        except OSError as err:
+            print(f'Could not save trials table next to bitcode.mat: {err}')
+
+        return trials
@@ -0,0 +1,178 @@
+import hashlib
+
+import numpy as np
+from PyQt5 import QtCore
+import ibllib.atlas as atlas
+from ibllib.pipes.ephys_alignment import EphysAlignment
+
+
+def track_hash(xyz_coords):
+    """
+    Hash of the 3D coordinates sampled along a track, used as a cache key for results that only
+    depend on the position of the track in the atlas
+    :param xyz_coords: 3D coordinates of points along probe or track
+    :type xyz_coords: np.array((n_points, 3))
+    :return: hex digest
+    :type: str
+    """
+    return hashlib.md5(np.ascontiguousarray(xyz_coords, dtype=float).tobytes()).hexdigest()
+
+
+def region_table(allen):
+    """
+    Lookup table of allen regions sorted by id so that ids can be mapped to their parent and
+    colour with a single searchsorted
+    :param allen: dataframe containing allen info. Loaded from allen_structure_tree in
+    ibllib/atlas
+    :type allen: pandas Dataframe
+    :return table: dict with sorted 'id', 'parent' and 'col' arrays
+    :type table: dict
+    """
+    ids = np.asarray(allen['id'])
+    order = np.argsort(ids)
+    parent = np.asarray(allen['parent_structure_id'], dtype=float)[order]
+    parent[np.isnan(parent)] = 0
+    return {'id': ids[order],
+            'parent': parent,
+            'col': np.asarray(allen['color_hex_triplet'], dtype=object)[order]}
+
+
+def _lookup(table, ids):
+    """
+    Find the row of each id in the region table
+    :return idx: row index, clipped to the table size
+    :return found: whether the id was present in the table
+    """
+    idx = np.clip(np.searchsorted(table['id'], ids), 0, table['id'].size - 1)
+    return idx, table['id'][idx] == ids
+
+
+def _first_boundary(ids, dist, max_dist):
+    """
+    For each row of region ids sorted by distance from the point on the track, find the distance
+    to the first sample that lies in a different region
+    """
+    differs = ids != ids[:, :1]
+    first = np.argmax(differs, axis=1)
+    return np.where(np.any(differs, axis=1), dist[first], max_dist) * 1e6
+
+
+def get_nearest_boundary(xyz_coords, allen, extent=100, steps=8, parent=True, brain_atlas=None):
+    """
+    Vectorised equivalent of EphysAlignment.get_nearest_boundary. Finds distance to closest
+    neighbouring brain region along trajectory. For each point in xyz_coords the plane passing
+    through point and perpendicular to trajectory is sampled and all brain regions that lie in
+    that plane up to a given distance extent from specified point are found. As the trajectory is
+    a straight line, the sampling offsets are the same for every point so all points are looked up
+    in the atlas in one go.
+    :param xyz_coords: 3D coordinates of points along probe or track
+    :type xyz_coords: np.array((n_points, 3)) n_points: no. of points
+    :param allen: dataframe containing allen info. Loaded from allen_structure_tree in
+    ibllib/atlas
+    :type allen: pandas Dataframe
+    :param extent: extent of plane in each direction from origin in (um)
+    :type extent: float
+    :param steps: no. of steps to discretise plane into
+    :type steps: int
+    :param parent: Whether to also compute nearest distance between parents of regions
+    :type parent: bool
+    :return nearest_bound: dict containing results
+    :type nearest_bound: dict
+    """
+    if not brain_atlas:
+        brain_atlas = atlas.AllenAtlas(25)
+
+    vector = atlas.Insertion.from_track(xyz_coords, brain_atlas=brain_atlas).trajectory.vector
+
+    # Offsets of the plane samples relative to the point on the track, ordered by distance
+    offsets = np.r_[np.linspace(-extent / 1e6, extent / 1e6, steps), 0]
+    dx, dy = np.meshgrid(offsets, offsets)
+    dx = dx.ravel()
+    dy = dy.ravel()
+    plane = np.c_[dx, dy, -1 * (vector[0] * dx + vector[1] * dy) / vector[2]]
+    dist = np.sqrt(np.sum(plane ** 2, axis=1))
+    dist_sorted = np.argsort(dist)
+    plane = plane[dist_sorted]
+    dist = dist[dist_sorted]
+    max_dist = np.max(dist)
+
+    xyz_plane = xyz_coords[:, np.newaxis, :] + plane[np.newaxis, :, :]
+
+    # Points where part of the plane lies outside of the atlas volume are left empty
+    ixyz = brain_atlas.bc.xyz2i(xyz_plane)
+    valid = np.all((ixyz >= 0) & (ixyz < brain_atlas.bc.nxyz), axis=(1, 2))
+
+    brain_id = np.zeros(xyz_plane.shape[:2])
+    if np.any(valid):
+        brain_id[valid] = np.reshape(brain_atlas.get_labels(np.reshape(xyz_plane[valid],
+                                                                       (-1, 3))),
+                                     (-1, plane.shape[0]))
+
+    table = region_table(allen)
+
+    nearest_bound = dict()
+    nearest_bound['id'] = brain_id[:, 0]
+    nearest_bound['dist'] = np.where(valid, _first_boundary(brain_id, dist, max_dist), 0)
+    idx, found = _lookup(table, nearest_bound['id'])
+    nearest_bound['col'] = np.where(valid & found, table['col'][idx], np.nan).tolist()
+
+    if parent:
+        brain_idx, _ = _lookup(table, brain_id)
+        brain_parent = table['parent'][brain_idx]
+        brain_parent[~valid] = 0
+        nearest_bound['parent_id'] = brain_parent[:, 0]
+        nearest_bound['parent_dist'] = np.where(valid, _first_boundary(brain_parent, dist,
+                                                                       max_dist), 0)
+        idx, found = _lookup(table, nearest_bound['parent_id'])
+        nearest_bound['parent_col'] = np.where(valid & found, table['col'][idx],
+                                               np.nan).tolist()
+
+    return nearest_bound
+
+
+def compute_nearby_regions(xyz_coords, depth_coords, allen, brain_atlas=None, steps=6):
+    """
+    Compute the nearest boundaries along the track and arrange them into regions ready to plot
+    :param xyz_coords: 3D coordinates of points along track
+    :type xyz_coords: np.array((n_points, 3))
+    :param depth_coords: depth along track where each point is located
+    :type depth_coords: np.array((n_points))
+    :return nearby: dict with x, y and col lists for the regions and their parents
+    :type nearby: dict
+    """
+    nearby_bounds = get_nearest_boundary(xyz_coords, allen, steps=steps,
+                                         brain_atlas=brain_atlas)
+    nearby = dict()
+    nearby['x'], nearby['y'], nearby['col'] = EphysAlignment.arrange_into_regions(
+        depth_coords, nearby_bounds['id'], nearby_bounds['dist'], nearby_bounds['col'])
+    (nearby['parent_x'], nearby['parent_y'],
+     nearby['parent_col']) = EphysAlignment.arrange_into_regions(
+        depth_coords, nearby_bounds['parent_id'], nearby_bounds['parent_dist'],
+        nearby_bounds['parent_col'])
+
+    return nearby
+
+
+class NearbyBoundaryWorker(QtCore.QThread):
+    """
+    Computes the nearby boundaries for a track off the GUI thread. Emits the track hash together
+    with the result so stale results can be discarded
+    """
+    computed = QtCore.pyqtSignal(str, object)
+
+    def __init__(self, key, xyz_coords, depth_coords, allen, brain_atlas, parent=None):
+        super(NearbyBoundaryWorker, self).__init__(parent)
+        self.key = key
+        self.xyz_coords = xyz_coords
+        self.depth_coords = depth_coords
+        self.allen = allen
+        self.brain_atlas = brain_atlas
+
+    def run(self):
+        try:
+            nearby = compute_nearby_regions(self.xyz_coords, self.depth_coords, self.allen,
+                                            brain_atlas=self.brain_atlas)
+        except Exception as err:
+            print(f'could not compute nearby boundaries: {err}')
+            nearby = None
+        self.computed.emit(self.key, nearby)
@@ -1,26 +1,69 @@
 from matplotlib import cm
 from pathlib import Path
+from collections import OrderedDict
+import hashlib
 import numpy as np
 import alf.io
+from brainbox.core import Bunch
 from brainbox.processing import bincount2D
-from brainbox.population.decode import xcorr
 from brainbox.task import passive
-import scipy
 import pandas as pd
 from PyQt5 import QtGui
+from ibllib.ephys.neuropixel import SITES_COORDINATES
 
 BNK_SIZE = 10
 AUTOCORR_BIN_SIZE = 0.25 / 1000
 AUTOCORR_WIN_SIZE = 10 / 1000
+# Cluster datasets that are memory mapped instead of read, only the parts of selected clusters
+# are then read from disk
+CLUSTERS_MMAP = ['waveforms', 'waveformsChannels']
+# No. of cluster autocorrelograms kept in memory
+AUTOCORR_CACHE_SIZE = 256
 FS = 30000
+# Version of the cached RF map and passive responses, increase when their computation changes
+PASSIVE_CACHE_VERSION = 1
 np.seterr(divide='ignore', invalid='ignore')
 
 
+def compute_autocorr(spike_times, bin_size, window_size):
+    """
+    Autocorrelogram of a spike train, equivalent to brainbox xcorr for a single cluster. Each
+    spike is paired with the following spikes until the lag leaves the window, spikes whose window
+    is exhausted are dropped so only pairs within the window are ever considered
+    :param spike_times: sorted spike times (s)
+    :type spike_times: np.array((nspikes))
+    :param bin_size: size of lag bins (s)
+    :param window_size: size of the window of lags (s)
+    :return: counts for each lag bin, np.array((2 * int(.5 * window_size / bin_size) + 1))
+    """
+    n_bins = int(.5 * window_size / bin_size) + 1
+    n = spike_times.size
+    counts = np.zeros(n_bins, dtype=np.int64)
+    idx = np.arange(n - 1)
+    shift = 1
+    while idx.size:
+        idx = idx[idx + shift < n]
+        lag_bins = np.round((spike_times[idx + shift] - spike_times[idx]) / bin_size)
+        keep = lag_bins < n_bins
+        idx = idx[keep]
+        counts += np.bincount(lag_bins[keep].astype(np.int64), minlength=n_bins)
+        shift += 1
+
+    return np.r_[counts[:0:-1], counts]
+
+
 class PlotData:
     def __init__(self, alf_path, ephys_path, shank_idx):
 
         self.alf_path = alf_path
         self.ephys_path = ephys_path
+        # Per cluster statistics for each unit filter
+        self.cluster_stats = dict()
+        self.unit_filter = None
+        self.shank_idx = shank_idx
+        # Spikes grouped by cluster and autocorrelograms of recently selected clusters
+        self.cluster_spikes = None
+        self.autocorr_cache = OrderedDict()
 
         self.chn_coords_all = np.load(Path(self.alf_path, 'channels.localCoordinates.npy'))
         self.chn_ind_all = np.load(Path(self.alf_path, 'channels.rawInd.npy'))
@@ -34,6 +77,15 @@ class PlotData:
         chn_x = np.unique(self.chn_coords_all[:, 0])
         chn_x_diff = np.diff(chn_x)
         n_shanks = np.sum(chn_x_diff > 100) + 1
+        self.n_shanks = n_shanks
+
+        # Not restricted to the channels in the channels object but all channels of the probe
+        chn_coords_raw, chn_ind_raw = self.get_raw_channels(self.chn_coords_all,
+                                                            self.chn_ind_all)
+        in_range = np.bitwise_and(chn_coords_raw[:, 1] >= self.chn_min,
+                                  chn_coords_raw[:, 1] <= self.chn_max)
+        chn_coords_raw = chn_coords_raw[in_range]
+        chn_ind_raw = chn_ind_raw[in_range]
 
         if n_shanks > 1:  # 4-shank
             shanks = {}
@@ -44,31 +96,22 @@ class PlotData:
                                         self.chn_coords_all[:, 0] <= shanks[shank_idx][1])
             self.chn_coords = self.chn_coords_all[shank_chns, :]
             self.chn_ind = self.chn_ind_all[shank_chns]
-            
-            # Not restricited to channels with units but all available channels on this shank
-            self.chn_coords_for_lfp = np.array([[shanks[shank_idx][i], y] for y in range(0, 15*48, 15) for i in [0, 1]])
-            self.chn_ind_for_lfp = [np.r_[0:48, 96:144], 
-                                    np.r_[48:96, 144:192],
-                                    np.r_[192:240, 288:336],
-                                    np.r_[240:288, 336:384]][shank_idx]  # hard-coded for 4-shank probes
+            shank_chns = np.bitwise_and(chn_coords_raw[:, 0] >= shanks[shank_idx][0],
+                                        chn_coords_raw[:, 0] <= shanks[shank_idx][1])
+            self.chn_coords_raw = chn_coords_raw[shank_chns, :]
+            self.chn_ind_raw = chn_ind_raw[shank_chns]
         else:  # 1-shank NP1.0 or NP2.1
             self.chn_coords = self.chn_coords_all
             self.chn_ind = self.chn_ind_all
-            
-            # Not restricited to channels with units but all available channels on this shank
-            if len(chn_x) == 4:  # hard-coded for NP1.0
-                self.chn_coords_for_lfp = np.vstack(([27, 59, 11, 43] * int(384/4), np.repeat(np.r_[0:(20*384/2):20],2))).T
-                self.chn_ind_for_lfp = np.r_[0:384]
-            elif len(chn_x) == 2:  # hard-coded for NP2.1
-                self.chn_coords_for_lfp = np.vstack(([0, 32] * int(384/2), np.repeat(np.r_[0:(15*384/2):15],2))).T
-                self.chn_ind_for_lfp = np.r_[0:384]
-
+            self.chn_coords_raw = chn_coords_raw
+            self.chn_ind_raw = chn_ind_raw
 
         self.N_BNK = len(np.unique(self.chn_coords[:, 0]))
         self.idx_full = np.where(np.isin(self.chn_full, self.chn_coords[:, 1]))[0]
-        
-        self.chn_full_for_lfp = np.unique(self.chn_coords_for_lfp[:, 1])
-        self.idx_full_for_lfp = np.where(np.isin(self.chn_full_for_lfp, self.chn_coords_for_lfp[:, 1]))[0]
+        # All channels of the shank grouped by depth, used to average the raw ephys data over
+        # channels at the same depth whatever the probe layout
+        self.depth_groups = self.get_depth_groups(self.chn_coords_raw[:, 1], self.chn_min,
+                                                  self.chn_diff)
 
         # See if spike data is available
         try:
@@ -79,7 +122,7 @@ class PlotData:
             self.spike_data_status = False
 
         try:
-            self.clusters = alf.io.load_object(self.alf_path, 'clusters')
+            self.clusters = self.load_clusters()
             self.clusters.metrics = pd.read_csv(self.alf_path / "cluster_metrics.csv")
             
             shank_spikes = np.isin(self.chn_ind_all[self.clusters.channels[self.spikes.clusters]],
@@ -114,18 +157,13 @@ class PlotData:
         try:
             rf_map_times = alf.io.load_object(self.alf_path.parent, object='passiveRFM',
                                               namespace='ibl')
-            # This needs to go into brainbox!!
-            rf_map_frames_path = (self.alf_path.parent.parent.
-                                  joinpath('raw_passive_data', '_iblrig_RFMapStim.raw.bin'))
-            rf_map_frames = np.fromfile(rf_map_frames_path, dtype="uint8")
-            y_pix, x_pix = 15, 15
-            frames = np.transpose(np.reshape(rf_map_frames, [y_pix, x_pix, -1], order="F"),
-                                  [2, 1, 0])
+            # The frames are only read if the rf map is not cached
+            self.rf_map_frames_path = (self.alf_path.parent.parent.
+                                       joinpath('raw_passive_data', '_iblrig_RFMapStim.raw.bin'))
 
             self.rf_map = dict()
             self.rf_map['times'] = rf_map_times['times']
-            self.rf_map['frames'] = frames
-            if len(self.rf_map) == 2:
+            if self.rf_map_frames_path.exists():
                 self.rfmap_data_status = True
             else:
                 print('rfmap data was not found, some plots will not display')
@@ -157,6 +195,7 @@ class PlotData:
             self.gabor_data_status = False
 
     def filter_units(self, type):
+        self.unit_filter = type
         if type == 'all':
             self.spike_idx = np.arange(self.spikes['clusters'].size)
 
@@ -184,17 +223,25 @@ class PlotData:
         
     @staticmethod
     def add_behavioral_events(data, events):
+        """
+        Add behavioural event markers to data. Each group of events is drawn as vertical ticks
+        centred at offset above the probe top, setting holds the arguments passed to pg.mkPen
+        """
+        go_cue = events['gocue_direction_outcome']
         data['events'] = [
-                    dict(setting=dict(pen='k', brush='k', symbol='o'), times=events['iti_all'], offset=150),                    
-                    dict(setting=dict(pen='g', brush='g', symbol='t'), times=events['gocue_all'], offset=150),
-                    dict(setting=dict(pen='b', brush='b', symbol='t2'), times=events['gocue_direction_outcome']['R_reward'], offset=100),
-                    dict(setting=dict(pen='b', brush='w', symbol='t2'), times=events['gocue_direction_outcome']['R_noreward'], offset=100),
-                    dict(setting=dict(pen='r', brush='r', symbol='t3'), times=events['gocue_direction_outcome']['L_reward'], offset=50),
-                    dict(setting=dict(pen='r', brush='w', symbol='t3'), times=events['gocue_direction_outcome']['L_noreward'], offset=50),
-                    dict(setting=dict(pen='k', brush='k', symbol='x'), times=events['gocue_direction_outcome']['ignore'], offset=0),
-                ]   
+            dict(name='ITI', setting=dict(color='k'), times=events['iti_all'], offset=150),
+            dict(name='Go cue', setting=dict(color='g'), times=events['gocue_all'], offset=150),
+            dict(name='Go cue R reward', setting=dict(color='b'), times=go_cue['R_reward'],
+                 offset=100),
+            dict(name='Go cue R no reward', setting=dict(color='b', dash=[2, 2]),
+                 times=go_cue['R_noreward'], offset=100),
+            dict(name='Go cue L reward', setting=dict(color='r'), times=go_cue['L_reward'],
+                 offset=50),
+            dict(name='Go cue L no reward', setting=dict(color='r', dash=[2, 2]),
+                 times=go_cue['L_noreward'], offset=50),
+            dict(name='Ignore', setting=dict(color='k'), times=go_cue['ignore'], offset=0),
+        ]
         return data
-    
 
 # Plots that require spike and cluster data
     def get_depth_data_scatter(self, events=None):
@@ -256,17 +303,12 @@ class PlotData:
             data_amp_scatter = None
             return data_fr_scatter, data_p2t_scatter, data_amp_scatter
         else:
-            (clu,
-             spike_depths,
-             spike_amps,
-             n_spikes) = self.compute_spike_average((self.spikes['clusters'][self.spike_idx]
-                                                    [self.kp_idx]), (self.spikes['depths']
-                                                    [self.spike_idx][self.kp_idx]),
-                                                    (self.spikes['amps'][self.spike_idx]
-                                                    [self.kp_idx]))
-            spike_amps = spike_amps * 1e6
-            fr = n_spikes / np.max(self.spikes['times'])
+            stats = self.get_cluster_stats()
+            spike_depths = stats['depths']
+            spike_amps = stats['amps'] * 1e6
+            fr = stats['n_spikes'] / np.max(self.spikes['times'])
             fr_levels = np.quantile(fr, [0, 1])
+            clust_idx = np.arange(stats['clust'].size)
 
             data_fr_scatter = {
                 'x': spike_amps,
@@ -281,21 +323,23 @@ class PlotData:
                 'xaxis': 'Amplitude (uV)',
                 'title': 'Firing Rate (Sp/s)',
                 'cmap': 'hot',
-                'cluster': True
+                'cluster': True,
+                'clust_idx': clust_idx
             }
 
-            p2t = self.clusters['peakToTrough'][clu]
-            
             # Sort p2t from positive to negative to emphasis the axonal spikes
-            p2t, spike_amps, spike_depths = (np.array(l) for l in zip(*sorted(zip(p2t, spike_amps, spike_depths), key=lambda k: k[0], reverse=True)))
+            if 'p2t_order' not in stats:
+                stats['p2t'] = self.get_cluster_p2t()[stats['clust']]
+                stats['p2t_order'] = np.argsort(-stats['p2t'], kind='stable')
+            order = stats['p2t_order']
 
             # Define the p2t levels so always same colourbar across sessions
             p2t_levels = [-1.5, 1.5]
             data_p2t_scatter = {
-                'x': spike_amps,
-                'y': spike_depths,
+                'x': spike_amps[order],
+                'y': spike_depths[order],
 
-                'colours': p2t,
+                'colours': stats['p2t'][order],
                 'pen': 'k',
                 'size': np.array(8),
                 'symbol': np.array('o'),
@@ -305,7 +349,8 @@ class PlotData:
                 'xaxis': 'Amplitude (uV)',
                 'title': 'Peak to Trough duration (ms)',
                 'cmap': 'bwr',
-                'cluster': True
+                'cluster': True,
+                'clust_idx': clust_idx[order]
             }
 
             spike_amps_levels = np.quantile(spike_amps, [0, 1])
@@ -324,10 +369,21 @@ class PlotData:
                 'xaxis': 'Firing Rate (Sp/s)',
                 'title': 'Amplitude (uV)',
                 'cmap': 'magma',
-                'cluster': True
+                'cluster': True,
+                'clust_idx': clust_idx
             }
             return data_fr_scatter, data_p2t_scatter, data_amp_scatter
 
+    def get_cluster_p2t(self):
+        """
+        Peak to trough duration of all clusters in ms. Uses the clusters.peakToTrough dataset if
+        available, otherwise computes it from the template waveforms of all clusters at once
+        :return p2t: np.array((nclusters))
+        """
+        if 'peakToTrough' in self.clusters.keys():
+            return self.clusters['peakToTrough']
+        waveforms = self.clusters['waveforms'][:, :, 0]
+        return (np.argmax(waveforms, axis=1) - np.argmin(waveforms, axis=1)) / FS * 1e3
 
     def get_fr_img(self, events=None):
         if not self.spike_data_status:
@@ -437,7 +493,8 @@ class PlotData:
             except:
                 return None
             corr = lfp_corr.f.lfp_corr if if_corr else lfp_corr.f.lfp_cov
-            corr = corr[np.ix_(self.chn_ind_for_lfp, self.chn_ind_for_lfp)]
+            chn_ind = self.chn_ind_raw[self.depth_groups['index']]
+            corr = corr[np.ix_(chn_ind, chn_ind)]
             corr[np.isnan(corr)] = 0
             scale = (self.chn_max - self.chn_min) / corr.shape[0]
             data_img = {
@@ -477,27 +534,15 @@ class PlotData:
             rms_times = np.array([0, rms_amps.shape[0]])
             xaxis = 'Time samples'
 
-        _rms = np.take(rms_amps, self.chn_ind_for_lfp, axis=1)
-        _, self.chn_depth, chn_count = np.unique(self.chn_coords_for_lfp[:, 1], return_index=True,
-                                                 return_counts=True)
-        self.chn_depth_eq = np.copy(self.chn_depth)
-        self.chn_depth_eq[np.where(chn_count == 2)] += 1
-
-        def avg_chn_depth(a):
-            return(np.mean([a[self.chn_depth], a[self.chn_depth_eq]], axis=0))
-
-        def get_median(a):
-            return(np.median(a))
-
-        def median_subtract(a):
-            return(a - np.median(a))
-        img = np.apply_along_axis(avg_chn_depth, 1, _rms * 1e6)
-        median = np.mean(np.apply_along_axis(get_median, 1, img))
+        _rms = np.take(rms_amps, self.chn_ind_raw, axis=1)
+        img = self.average_over_depth(_rms * 1e6)
+        img_median = np.median(img, axis=1)
+        median = np.mean(img_median)
         # Medium subtract to remove bands, but add back average median so values make sense
-        img = np.apply_along_axis(median_subtract, 1, img) + median
+        img = img - img_median[:, np.newaxis] + median
 
-        img_full = np.full((img.shape[0], self.chn_full_for_lfp.shape[0]), np.nan)
-        img_full[:, self.idx_full_for_lfp] = img
+        img_full = np.full((img.shape[0], self.chn_full.shape[0]), np.nan)
+        img_full[:, self.depth_groups['idx_full']] = img
 
         levels = np.quantile(img, [0.1, 0.9])
         xscale = (rms_times[-1] - rms_times[0]) / img_full.shape[0]
@@ -520,10 +565,11 @@ class PlotData:
         }
 
         # Probe data
-        #  rms_avg = (np.mean(rms_amps, axis=0)[self.chn_ind]) * 1e6
-        rms_avg = (np.mean(rms_amps, axis=0)[self.chn_ind_for_lfp]) * 1e6  # Show all rms_avg channels (not only channels with units)
+        # Show all rms_avg channels (not only channels in the channels object)
+        rms_avg = (np.mean(rms_amps, axis=0)[self.chn_ind_raw]) * 1e6
         probe_levels = np.quantile(rms_avg, [0.1, 0.9])
-        probe_img, probe_scale, probe_offset = self.arrange_channels2banks(rms_avg)
+        probe_img, probe_scale, probe_offset = self.arrange_channels2banks(
+            rms_avg, self.chn_coords_raw)
 
         data_probe = {
             'img': probe_img,
@@ -552,19 +598,11 @@ class PlotData:
             freq_range = [0, 300]
             freq_idx = np.where((self.lfp_freq >= freq_range[0]) &
                                 (self.lfp_freq < freq_range[1]))[0]
-            _lfp = np.take(self.lfp_power[freq_idx], self.chn_ind_for_lfp, axis=1)
+            _lfp = np.take(self.lfp_power[freq_idx], self.chn_ind_raw, axis=1)
             _lfp_dB = 10 * np.log10(_lfp)
-            _, self.chn_depth, chn_count = np.unique(self.chn_coords_for_lfp[:, 1], return_index=True,
-                                                     return_counts=True)
-            self.chn_depth_eq = np.copy(self.chn_depth)
-            self.chn_depth_eq[np.where(chn_count == 2)] += 1
-
-            def avg_chn_depth(a):
-                return(np.mean([a[self.chn_depth], a[self.chn_depth_eq]], axis=0))
-
-            img = np.apply_along_axis(avg_chn_depth, 1, _lfp_dB)
-            img_full = np.full((img.shape[0], self.chn_full_for_lfp.shape[0]), np.nan)
-            img_full[:, self.idx_full_for_lfp] = img
+            img = self.average_over_depth(_lfp_dB)
+            img_full = np.full((img.shape[0], self.chn_full.shape[0]), np.nan)
+            img_full[:, self.depth_groups['idx_full']] = img
 
             levels = np.quantile(img, [0.1, 0.9])
             xscale = (freq_range[-1] - freq_range[0]) / img_full.shape[0]
@@ -584,9 +622,10 @@ class PlotData:
             # Power spectrum in bands on probe
             for freq in freq_bands:
                 freq_idx = np.where((self.lfp_freq >= freq[0]) & (self.lfp_freq < freq[1]))[0]
-                lfp_avg = np.mean(self.lfp_power[freq_idx], axis=0)[self.chn_ind_for_lfp]
+                lfp_avg = np.mean(self.lfp_power[freq_idx], axis=0)[self.chn_ind_raw]
                 lfp_avg_dB = 10 * np.log10(lfp_avg)
-                probe_img, probe_scale, probe_offset = self.arrange_channels2banks(lfp_avg_dB)
+                probe_img, probe_scale, probe_offset = self.arrange_channels2banks(
+                    lfp_avg_dB, self.chn_coords_raw)
                 probe_levels = np.quantile(lfp_avg_dB, [0.1, 0.9])
 
                 lfp_band_data = {f"{freq[0]} - {freq[1]} Hz": {
@@ -608,25 +647,37 @@ class PlotData:
         if not self.rfmap_data_status:
             return data_img, None
         else:
+            img = self.load_passive_cache('rfmap')
+            if not img:
+                if 'frames' not in self.rf_map:
+                    # This needs to go into brainbox!!
+                    rf_map_frames = np.fromfile(self.rf_map_frames_path, dtype="uint8")
+                    y_pix, x_pix = 15, 15
+                    self.rf_map['frames'] = np.transpose(
+                        np.reshape(rf_map_frames, [y_pix, x_pix, -1], order="F"), [2, 1, 0])
+
+                (rf_map_times, rf_map_pos,
+                 rf_stim_frames) = passive.get_on_off_times_and_positions(self.rf_map)
+
+                rf_map, _ = \
+                    passive.get_rf_map_over_depth(rf_map_times, rf_map_pos, rf_stim_frames,
+                                                  self.spikes['times'][self.spike_idx]
+                                                  [self.kp_idx],
+                                                  self.spikes['depths'][self.spike_idx]
+                                                  [self.kp_idx],
+                                                  d_bin=160)
+                rfs_svd = passive.get_svd_map(rf_map)
+                img = dict()
+                img['on'] = np.vstack(rfs_svd['on'])
+                img['off'] = np.vstack(rfs_svd['off'])
+                self.save_passive_cache('rfmap', img)
 
-            (rf_map_times, rf_map_pos,
-             rf_stim_frames) = passive.get_on_off_times_and_positions(self.rf_map)
-
-            rf_map, _ = \
-                passive.get_rf_map_over_depth(rf_map_times, rf_map_pos, rf_stim_frames,
-                                              self.spikes['times'][self.spike_idx][self.kp_idx],
-                                              self.spikes['depths'][self.spike_idx][self.kp_idx],
-                                              d_bin=160)
-            rfs_svd = passive.get_svd_map(rf_map)
-            img = dict()
-            img['on'] = np.vstack(rfs_svd['on'])
-            img['off'] = np.vstack(rfs_svd['off'])
             yscale = ((np.max(self.chn_coords[:, 1]) - np.min(
                 self.chn_coords[:, 1])) / img['on'].shape[0])
             xscale = 1
             levels = np.quantile(np.c_[img['on'], img['off']], [0, 1])
 
-            depths = np.linspace(0, 3840, len(rfs_svd['on']) + 1)
+            depths = np.linspace(0, 3840, img['on'].shape[0] + 1)
 
             sub_type = ['on', 'off']
             for sub in sub_type:
@@ -663,11 +714,16 @@ class PlotData:
         base_stim = 1
         pre_stim = 0.4
         post_stim = 1
-        stim_events = passive.get_stim_aligned_activity(stims, self.spikes['times'][self.spike_idx]
-                                                        [self.kp_idx], self.spikes['depths']
-                                                        [self.spike_idx][self.kp_idx],
-                                                        pre_stim=pre_stim, post_stim=post_stim,
-                                                        base_stim=base_stim)
+        stim_events = self.load_passive_cache('passive')
+        if not stim_events:
+            stim_events = passive.get_stim_aligned_activity(stims, self.spikes['times']
+                                                            [self.spike_idx][self.kp_idx],
+                                                            self.spikes['depths']
+                                                            [self.spike_idx][self.kp_idx],
+                                                            pre_stim=pre_stim,
+                                                            post_stim=post_stim,
+                                                            base_stim=base_stim)
+            self.save_passive_cache('passive', stim_events)
 
         for stim_type, z_score in stim_events.items():
             xscale = (post_stim + pre_stim) / z_score.shape[1]
@@ -690,9 +746,80 @@ class PlotData:
 
         return data_img
     
+    def passive_cache_file(self, name):
+        """
+        Path of the file that caches passive results of this probe and shank
+        """
+        filename = f'_alignmentgui_{name}.npz' if self.n_shanks == 1 else \
+            f'_alignmentgui_{name}_shank{self.shank_idx + 1}.npz'
+        return Path(self.alf_path).joinpath(filename)
+
+    def passive_fingerprint(self):
+        """
+        Fingerprint of the spike and passive stimulus files the RF map and passive responses are
+        computed from, based on file name, size and modification time
+        """
+        alf_path = Path(self.alf_path)
+        files = (sorted(alf_path.glob('spikes.*')) + sorted(alf_path.glob('clusters.*')) +
+                 sorted(alf_path.glob('cluster_metrics.csv')) +
+                 sorted(alf_path.parent.glob('_ibl_passive*')) +
+                 sorted(alf_path.parent.parent.glob('raw_passive_data/_iblrig_RFMapStim.raw.bin')))
+        fingerprint = hashlib.md5()
+        for file in files:
+            stat = file.stat()
+            fingerprint.update(f'{file.name}{stat.st_size}{stat.st_mtime_ns}'.encode())
+        return fingerprint.hexdigest()
+
+    def load_passive_cache(self, name):
+        """
+        Load cached RF map or passive responses for the current unit filter. Results don't
+        depend on the alignment so they are only recomputed when the source data changes
+        :param name: 'rfmap' or 'passive'
+        :type name: str
+        :return: arrays stored for the current unit filter, empty if not cached
+        :type: dict
+        """
+        file = self.passive_cache_file(name)
+        if not file.exists():
+            return dict()
+        prefix = f'{self.unit_filter}__'
+        try:
+            with np.load(file) as cache:
+                if int(cache['version']) != PASSIVE_CACHE_VERSION or \
+                        str(cache['fingerprint']) != self.passive_fingerprint():
+                    return dict()
+                return {key[len(prefix):]: cache[key] for key in cache.files
+                        if key.startswith(prefix)}
+        except Exception as err:
+            print(f'could not load cached {name} data: {err}')
+            return dict()
+
+    def save_passive_cache(self, name, data):
+        """
+        Add results for the current unit filter to the cache file, results of other unit
+        filters computed from the same data are kept
+        """
+        file = self.passive_cache_file(name)
+        fingerprint = self.passive_fingerprint()
+        cache = dict()
+        if file.exists():
+            try:
+                with np.load(file) as f:
+                    if int(f['version']) == PASSIVE_CACHE_VERSION and \
+                            str(f['fingerprint']) == fingerprint:
+                        cache = {key: f[key] for key in f.files}
+            except Exception:
+                cache = dict()
+        cache.update({f'{self.unit_filter}__{key}': val for key, val in data.items()})
+        cache['version'] = PASSIVE_CACHE_VERSION
+        cache['fingerprint'] = fingerprint
+        try:
+            np.savez_compressed(file, **cache)
+        except OSError as err:
+            print(f'could not save {name} data: {err}')
+
     def get_psth(self, clust_idx, events):
-        idx = np.where(self.spikes['clusters'] == self.clust_id[clust_idx])[0]
-        spike_times = self.spikes['times'][idx]
+        spike_times = self.spikes['times'][self.get_cluster_spikes(self.clust_id[clust_idx])]
         
         psth = dict()
         
@@ -738,27 +865,68 @@ class PlotData:
                 activity.extend(temp)
         
         return rasters, np.array(activity), yrast, np.amax(yrast) if yrast !=[] else None, len(activity)
-    
+
+    def get_cluster_spikes(self, clust):
+        """
+        Indices of the spikes of a cluster, in time order. Spikes are grouped by cluster the
+        first time this is called so later lookups don't scan all spikes
+        :param clust: cluster id
+        :type clust: int
+        :return: np.array((nspikes))
+        """
+        if self.cluster_spikes is None:
+            order = np.argsort(self.spikes['clusters'], kind='stable')
+            offsets = np.r_[0, np.cumsum(np.bincount(self.spikes['clusters']))]
+            self.cluster_spikes = (order, offsets)
+        order, offsets = self.cluster_spikes
+        if clust + 1 >= offsets.size:
+            return order[0:0]
+        return order[offsets[clust]:offsets[clust + 1]]
 
     def get_autocorr(self, clust_idx):
-        idx = np.where(self.spikes['clusters'] == self.clust_id[clust_idx])[0]
-        autocorr = xcorr(self.spikes['times'][idx], self.spikes['clusters'][idx],
-                         AUTOCORR_BIN_SIZE, AUTOCORR_WIN_SIZE)
+        clust = self.clust_id[clust_idx]
+        autocorr = self.autocorr_cache.get(clust)
+        if autocorr is None:
+            autocorr = compute_autocorr(self.spikes['times'][self.get_cluster_spikes(clust)],
+                                        AUTOCORR_BIN_SIZE, AUTOCORR_WIN_SIZE)
+            self.autocorr_cache[clust] = autocorr
+            if len(self.autocorr_cache) > AUTOCORR_CACHE_SIZE:
+                self.autocorr_cache.popitem(last=False)
+        else:
+            self.autocorr_cache.move_to_end(clust)
 
-        return autocorr[0, 0, :]
+        return autocorr
 
     def get_template_wf(self, clust_idx):
-        template_wf = (self.clusters['waveforms'][self.clust_id[clust_idx], :, 0])
+        # Only the peak channel of the cluster is read from the memory mapped waveforms
+        template_wf = np.array(self.clusters['waveforms'][self.clust_id[clust_idx], :, 0])
         return template_wf * 1e6
 
-    def arrange_channels2banks(self, data):
+    def load_clusters(self):
+        """
+        Load the clusters object. The template waveforms are by far the largest cluster dataset so
+        they are memory mapped rather than loaded, see CLUSTERS_MMAP
+        :return clusters: cluster datasets
+        :type clusters: Bunch
+        """
+        clusters = Bunch()
+        for file in sorted(Path(self.alf_path).glob('*clusters.*.npy')):
+            attribute = file.name.split('.')[1]
+            clusters[attribute] = np.load(file, mmap_mode='r' if attribute in CLUSTERS_MMAP
+                                          else None)
+        if len(clusters) == 0:
+            raise FileNotFoundError(f'clusters object not found in {self.alf_path}')
+        return clusters
+
+    def arrange_channels2banks(self, data, chn_coords=None):
+        chn_coords = self.chn_coords if chn_coords is None else chn_coords
         bnk_data = []
         bnk_scale = np.empty((self.N_BNK, 2))
         bnk_offset = np.empty((self.N_BNK, 2))
-        for iX, x in enumerate(np.unique(self.chn_coords_for_lfp[:, 0])):
-            bnk_idx = np.where(self.chn_coords_for_lfp[:, 0] == x)[0]
+        for iX, x in enumerate(np.unique(chn_coords[:, 0])):
+            bnk_idx = np.where(chn_coords[:, 0] == x)[0]
 
-            bnk_ycoords = self.chn_coords_for_lfp[bnk_idx, 1]
+            bnk_ycoords = chn_coords[bnk_idx, 1]
             bnk_diff = np.min(np.diff(bnk_ycoords))
 
             # NP1.0 checkerboard
@@ -779,8 +947,8 @@ class PlotData:
                 _bnk_xoffset = BNK_SIZE * iX
 
             else:  # NP2.0
-                _bnk_vals = np.full((self.chn_full_for_lfp.shape[0]), np.nan)
-                idx_full = np.where(np.isin(self.chn_full_for_lfp, bnk_ycoords))
+                _bnk_vals = np.full((self.chn_full.shape[0]), np.nan)
+                idx_full = np.where(np.isin(self.chn_full, bnk_ycoords))
                 _bnk_vals[idx_full] = data[bnk_idx]
 
                 _bnk_data = _bnk_vals[np.newaxis, :]
@@ -788,7 +956,7 @@ class PlotData:
                 _bnk_yscale = ((self.chn_max -
                                 self.chn_min) / _bnk_data.shape[1])
                 _bnk_xscale = BNK_SIZE / _bnk_data.shape[0]
-                _bnk_yoffset = 0
+                _bnk_yoffset = self.chn_min
                 _bnk_xoffset = BNK_SIZE * iX
 
             bnk_data.append(_bnk_data)
@@ -797,22 +965,118 @@ class PlotData:
 
         return bnk_data, bnk_scale, bnk_offset
 
-    def compute_spike_average(self, spike_clusters, spike_depth, spike_amp):
-        clust, inverse, counts = np.unique(spike_clusters, return_inverse=True, return_counts=True)
-        _spike_depth = scipy.sparse.csr_matrix((spike_depth, (inverse,
-                                                np.zeros(inverse.size, dtype=int))))
-        _spike_amp = scipy.sparse.csr_matrix((spike_amp, (inverse,
-                                              np.zeros(inverse.size, dtype=int))))
-        spike_depth_avg = np.ravel(_spike_depth.toarray()) / counts
-        spike_amp_avg = np.ravel(_spike_amp.toarray()) / counts
-        self.clust_id = clust
-        return clust, spike_depth_avg, spike_amp_avg, counts
+    def get_cluster_stats(self):
+        """
+        Per cluster statistics of the spikes kept by the current unit filter. Computed once per
+        filter and cached
+        :return stats: see compute_cluster_stats
+        :type stats: dict
+        """
+        stats = self.cluster_stats.get(self.unit_filter)
+        if stats is None:
+            idx = self.spike_idx[self.kp_idx]
+            stats = self.compute_cluster_stats(self.spikes['clusters'][idx],
+                                               self.spikes['depths'][idx],
+                                               self.spikes['amps'][idx],
+                                               self.spikes['times'][idx])
+            self.cluster_stats[self.unit_filter] = stats
+        self.clust_id = stats['clust']
+        return stats
+
+    @staticmethod
+    def compute_cluster_stats(spike_clusters, spike_depth, spike_amp, spike_times):
+        """
+        Compute the statistics of all clusters in a single pass over the spikes
+        :param spike_clusters: cluster of each spike
+        :type spike_clusters: np.array((nspikes)), int
+        :return stats: dict with for each cluster that has spikes
+            {'clust': cluster id, 'n_spikes': no. of spikes, 'amps': mean amplitude,
+             'depths': mean depth, 'first_time': time of first spike,
+             'last_time': time of last spike}
+        :type stats: dict of np.array((nclusters))
+        """
+        n_clust = np.max(spike_clusters) + 1 if spike_clusters.size else 0
+        counts = np.bincount(spike_clusters, minlength=n_clust)
+        clust = np.flatnonzero(counts)
+        first_time = np.full(n_clust, np.inf)
+        np.minimum.at(first_time, spike_clusters, spike_times)
+        last_time = np.full(n_clust, -np.inf)
+        np.maximum.at(last_time, spike_clusters, spike_times)
+
+        stats = dict()
+        stats['clust'] = clust
+        stats['n_spikes'] = counts[clust]
+        stats['depths'] = np.bincount(spike_clusters, weights=spike_depth,
+                                      minlength=n_clust)[clust] / stats['n_spikes']
+        stats['amps'] = np.bincount(spike_clusters, weights=spike_amp,
+                                    minlength=n_clust)[clust] / stats['n_spikes']
+        stats['first_time'] = first_time[clust]
+        stats['last_time'] = last_time[clust]
+        return stats
+
+    @staticmethod
+    def get_raw_channels(chn_coords, chn_ind, geometry=SITES_COORDINATES):
+        """
+        Coordinates of all channels of the probe, including those missing from the channels
+        object, e.g. the reference channel. The missing channels are placed with the probe
+        geometry when the channels object matches it. Other probes, e.g. NP2.4 whose channels
+        depend on the recording, can't place them and only keep the channels of the channels
+        object
+        :param chn_coords: coordinates of the channels in the channels object
+        :type chn_coords: np.array((nchannels, 2))
+        :param chn_ind: raw index of the channels in the channels object
+        :type chn_ind: np.array((nchannels))
+        :param geometry: coordinates of each raw channel of the probe, defaults to NP1
+        :type geometry: np.array((nraw, 2))
+        :return chn_coords_raw: coordinates of each channel, np.array((nraw, 2))
+        :return chn_ind_raw: raw index of each channel, np.array((nraw))
+        """
+        if np.max(chn_ind) < geometry.shape[0] and np.allclose(geometry[chn_ind], chn_coords):
+            return geometry.astype(float), np.arange(geometry.shape[0])
+        order = np.argsort(chn_ind)
+        return chn_coords[order], chn_ind[order]
+
+    @staticmethod
+    def get_depth_groups(depths, chn_min, chn_diff):
+        """
+        Group channels by their depth on the probe so that data can be averaged over channels at
+        the same depth with a single reduction
+        :param depths: depth of each channel
+        :type depths: np.array((nchannels))
+        :param chn_min: depth of the deepest channel on the probe
+        :param chn_diff: spacing between channel depths
+        :return groups: dict with
+            {'depths': unique depths, np.array((ndepths))
+             'index': channels sorted by depth, np.array((nchannels))
+             'offsets': start of each depth group in index, np.array((ndepths))
+             'counts': no. of channels in each depth group, np.array((ndepths))
+             'idx_full': position of each depth on the full probe, np.array((ndepths))
+            }
+        :type groups: dict
+        """
+        index = np.argsort(depths, kind='stable')
+        unique, offsets, counts = np.unique(depths[index], return_index=True,
+                                            return_counts=True)
+        idx_full = np.round((unique - chn_min) / chn_diff).astype(int)
+        return {'depths': unique, 'index': index, 'offsets': offsets, 'counts': counts,
+                'idx_full': idx_full}
+
+    def average_over_depth(self, data):
+        """
+        Average data of channels that are at the same depth
+        :param data: data for each channel of the shank, ordered as chn_ind_raw
+        :type data: np.array((n, nchannels))
+        :return: np.array((n, ndepths))
+        """
+        groups = self.depth_groups
+        return (np.add.reduceat(data[:, groups['index']], groups['offsets'], axis=1) /
+                groups['counts'])
 
     def compute_timescales(self):
         self.t_autocorr = 1e3 * np.arange((AUTOCORR_WIN_SIZE / 2) - AUTOCORR_WIN_SIZE,
                                           (AUTOCORR_WIN_SIZE / 2) + AUTOCORR_BIN_SIZE,
                                           AUTOCORR_BIN_SIZE)
-        n_template = self.clusters['waveforms'][0, :, 0].size
+        n_template = self.clusters['waveforms'].shape[1]
         self.t_template = 1e3 * (np.arange(n_template)) / FS
 
     def normalise_data(self, data, lquant=0, uquant=1):
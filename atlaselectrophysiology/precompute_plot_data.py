@@ -0,0 +1,270 @@
+"""
+Precompute the data displayed in the alignment GUI for many insertions so that sessions open
+without recomputing the plots.
+
+Each folder is an ALF folder as opened in offline mode. If a kilosort and raw ephys folder are
+given the ALF data is first extracted with extract_files.extract_data. The plot data for each
+shank is saved in the ALF folder and loaded by the GUI when it is up to date with the data.
+
+Usage:
+    python precompute_plot_data.py /path/to/alf_folder1 /path/to/alf_folder2 -n 4 -m 8
+    python precompute_plot_data.py -r /path/to/root_folder
+    python precompute_plot_data.py -l sessions.txt
+where each line of sessions.txt is 'alf_folder [ks_folder ephys_folder]'
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import hashlib
+import pickle
+import traceback
+
+import numpy as np
+
+import atlaselectrophysiology.plot_data as pd
+from atlaselectrophysiology.extract_files import extract_data
+
+PLOT_DATA_VERSION = 5
+# File types that plot data is computed from, other files in the folder don't affect the cache
+SOURCE_SUFFIXES = ['.npy', '.npz', '.csv', '.bin']
+# Caches written by the GUI into the ALF folder, these are derived from the data
+CACHE_PREFIX = '_alignmentgui_'
+
+
+def plot_data_file(alf_path, shank_idx=0, n_shanks=1):
+    """
+    Name of file that stores the precomputed plot data of a shank
+    """
+    filename = 'alignment_gui_data.pkl' if n_shanks == 1 else \
+        f'alignment_gui_data_shank{shank_idx + 1}.pkl'
+    return Path(alf_path).joinpath(filename)
+
+
+def get_nshanks(alf_path):
+    """
+    Find out the number of shanks on the probe, either 1 or 4
+    """
+    chn_coords = np.load(Path(alf_path).joinpath('channels.localCoordinates.npy'))
+    return int(np.sum(np.diff(np.unique(chn_coords[:, 0])) > 100) + 1)
+
+
+def default_ephys_path(alf_path):
+    """
+    Raw ephys folder the GUI opens with an ALF folder, raw_ephys_data/<probe> of the session for
+    sessions downloaded from Alyx, otherwise the ALF folder itself as in offline mode
+    """
+    alf_path = Path(alf_path)
+    ephys_path = alf_path.parent.parent.joinpath('raw_ephys_data', alf_path.name)
+    return ephys_path if ephys_path.is_dir() else alf_path
+
+
+def source_fingerprint(alf_path, ephys_path=None):
+    """
+    Fingerprint of the data files the plots are computed from, based on file name, size and
+    modification time
+    :return: hex digest
+    :type: str
+    """
+    paths = {Path(alf_path)}
+    if ephys_path is not None:
+        paths.add(Path(ephys_path))
+    files = sorted(file for path in paths for file in path.iterdir()
+                   if file.is_file() and file.suffix in SOURCE_SUFFIXES and
+                   not file.name.startswith(CACHE_PREFIX))
+    fingerprint = hashlib.md5()
+    for file in files:
+        stat = file.stat()
+        fingerprint.update(f'{file.name}{stat.st_size}{stat.st_mtime_ns}'.encode())
+    return fingerprint.hexdigest()
+
+
+def compute_plot_data(plotdata):
+    """
+    Compute all data displayed in the alignment GUI. Keys are the attribute names used by the
+    GUI. Behavioural events are not included as they are added by the GUI when loading
+    :param plotdata: plot data of a shank
+    :type plotdata: PlotData
+    :return data: data for each plot
+    :type data: dict
+    """
+    data = dict()
+    data['scat_drift_data'] = plotdata.get_depth_data_scatter()
+    (data['scat_fr_data'], data['scat_p2t_data'],
+     data['scat_amp_data']) = plotdata.get_fr_p2t_data_scatter()
+    data['img_corr_data'] = plotdata.get_correlation_data_img()
+    data['img_lfp_corr_data'] = plotdata.get_lfp_corr_cov_data_img(if_corr=True)
+    data['img_lfp_cov_data'] = plotdata.get_lfp_corr_cov_data_img(if_corr=False)
+    data['img_fr_data'] = plotdata.get_fr_img()
+    data['img_rms_APdata'], data['probe_rms_APdata'] = plotdata.get_rms_data_img_probe('AP')
+    data['img_rms_LFPdata'], data['probe_rms_LFPdata'] = plotdata.get_rms_data_img_probe('LF')
+    data['img_lfp_data'], data['probe_lfp_data'] = plotdata.get_lfp_spectrum_data()
+    data['line_fr_data'], data['line_amp_data'] = plotdata.get_fr_amp_data_line()
+    data['probe_rfmap'], data['rfmap_boundaries'] = plotdata.get_rfmap_data()
+    data['img_stim_data'] = plotdata.get_passive_events()
+
+    return data
+
+
+def save_plot_data(data, alf_path, ephys_path=None, shank_idx=0, n_shanks=1):
+    file = plot_data_file(alf_path, shank_idx, n_shanks)
+    with open(file, 'wb') as f:
+        pickle.dump({'version': PLOT_DATA_VERSION,
+                     'fingerprint': source_fingerprint(alf_path, ephys_path),
+                     'data': data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return file
+
+
+def load_plot_data(alf_path, ephys_path=None, shank_idx=0):
+    """
+    Load precomputed plot data if it exists and was computed from the current data files
+    :return data: data for each plot, None if not available or out of date
+    :type data: dict
+    """
+    file = plot_data_file(alf_path, shank_idx, get_nshanks(alf_path))
+    if not file.exists():
+        return None
+    try:
+        with open(file, 'rb') as f:
+            plot_data = pickle.load(f)
+    except Exception as err:
+        print(f'could not load precomputed plot data: {err}')
+        return None
+
+    if plot_data.get('version') != PLOT_DATA_VERSION or \
+            plot_data.get('fingerprint') != source_fingerprint(alf_path, ephys_path):
+        print('precomputed plot data is out of date, recomputing')
+        return None
+
+    print(f'loaded precomputed plot data from {file}')
+    return plot_data['data']
+
+
+def precompute_session(alf_path, ks_path=None, ephys_path=None, force=False,
+                       max_length_in_sec=None):
+    """
+    Extract the ALF data if needed and precompute the plot data of every shank of a session
+    :param alf_path: folder with ALF data, extracted data is written here
+    :param ks_path: kilosort output folder, only needed for extraction
+    :param ephys_path: raw ephys folder, the plot data is only loaded by the GUI when opened
+    with the same folder. Defaults to default_ephys_path
+    :param force: recompute even if the saved data is up to date
+    :return status: description of what was done
+    :type status: str
+    """
+    alf_path = Path(alf_path)
+    if ks_path is not None and ephys_path is not None and \
+            (force or not alf_path.joinpath('spikes.times.npy').exists()):
+        alf_path.mkdir(parents=True, exist_ok=True)
+        extract_data(Path(ks_path), Path(ephys_path), alf_path,
+                     max_length_in_sec=max_length_in_sec)
+    ephys_path = Path(ephys_path) if ephys_path is not None else default_ephys_path(alf_path)
+
+    n_shanks = get_nshanks(alf_path)
+    computed = []
+    for shank_idx in range(n_shanks):
+        if not force and load_plot_data(alf_path, ephys_path, shank_idx=shank_idx) is not None:
+            continue
+        plotdata = pd.PlotData(alf_path, ephys_path, shank_idx)
+        save_plot_data(compute_plot_data(plotdata), alf_path, ephys_path, shank_idx=shank_idx,
+                       n_shanks=n_shanks)
+        computed.append(shank_idx + 1)
+
+    if computed:
+        return f'computed shanks {computed}'
+    return 'up to date'
+
+
+def limit_memory(max_memory):
+    """
+    Limit the memory available to the worker process, tasks that exceed the limit fail with a
+    MemoryError instead of taking down the machine
+    :param max_memory: limit in GB, no limit if None
+    :type max_memory: float
+    """
+    if max_memory is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        print('memory limits are not supported on this platform')
+        return
+    limit = int(max_memory * 1024 ** 3)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _run_task(task, force, max_length_in_sec):
+    try:
+        return precompute_session(*task, force=force, max_length_in_sec=max_length_in_sec)
+    except MemoryError:
+        return 'failed: memory limit exceeded'
+    except Exception:
+        return 'failed: ' + traceback.format_exc()
+
+
+def precompute_sessions(tasks, n_workers=None, max_memory=None, force=False,
+                        max_length_in_sec=None):
+    """
+    Precompute plot data for many sessions in a pool of processes
+    :param tasks: (alf_path, ks_path, ephys_path) for each session, ks_path and ephys_path can be
+    None if the session is already extracted
+    :type tasks: list of tuple
+    :param n_workers: number of processes, defaults to number of cpus
+    :param max_memory: memory limit per process in GB
+    :return status: status of each session
+    :type status: dict
+    """
+    status = dict()
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=limit_memory,
+                             initargs=(max_memory,)) as executor:
+        futures = {executor.submit(_run_task, task, force, max_length_in_sec): task[0]
+                   for task in tasks}
+        for future in as_completed(futures):
+            status[futures[future]] = future.result()
+            print(f'{futures[future]}: {status[futures[future]]}')
+
+    return status
+
+
+def find_sessions(root_path):
+    """
+    Find all ALF folders below root_path. The channel locations saved by the GUI in a
+    channel_locations folder of an ALF folder have no raw channel indices so are not included
+    """
+    return sorted(file.parent for file in Path(root_path).rglob('channels.localCoordinates.npy')
+                  if file.parent.joinpath('channels.rawInd.npy').exists())
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Precompute alignment GUI plot data')
+    parser.add_argument('folders', nargs='*', help='ALF folders to precompute')
+    parser.add_argument('-r', '--root', default=None, required=False,
+                        help='Precompute all ALF folders found below this folder')
+    parser.add_argument('-l', '--list', default=None, required=False,
+                        help='File with one "alf_folder [ks_folder ephys_folder]" per line')
+    parser.add_argument('-n', '--n_workers', default=None, type=int, required=False,
+                        help='Number of processes')
+    parser.add_argument('-m', '--max_memory', default=None, type=float, required=False,
+                        help='Memory limit per process in GB')
+    parser.add_argument('-t', '--max_length', default=None, type=float, required=False,
+                        help='Max length of raw data in sec to use for extraction')
+    parser.add_argument('-f', '--force', default=False, action='store_true',
+                        help='Recompute sessions that are up to date')
+    args = parser.parse_args()
+
+    tasks = [(folder, None, None) for folder in args.folders]
+    if args.root:
+        tasks += [(folder, None, None) for folder in find_sessions(args.root)]
+    if args.list:
+        with open(args.list, 'r') as f:
+            for line in f:
+                paths = line.split()
+                if paths:
+                    tasks.append((paths[0], *paths[1:3]) if len(paths) == 3 else
+                                 (paths[0], None, None))
+
+    status = precompute_sessions(tasks, n_workers=args.n_workers, max_memory=args.max_memory,
+                                 force=args.force, max_length_in_sec=args.max_length)
+    n_failed = np.sum([val.startswith('failed') for val in status.values()])
+    print(f'{len(status) - n_failed}/{len(status)} sessions done')
@@ -0,0 +1,168 @@
+"""
+Region meshes shown at a level of detail chosen by their size on screen. The meshes are decimated
+to the levels in LOD_REDUCTION the first time they are used and the levels are cached on disk.
+"""
+from pathlib import Path
+import hashlib
+
+import numpy as np
+import vtk
+
+MESH_CACHE_DIR = Path.home().joinpath('.iblapps', 'mesh_cache')
+# Fraction of triangles of the full mesh removed at each level of detail, level 0 is the full mesh
+LOD_REDUCTION = [0, 0.8, 0.95, 0.99]
+# Smallest size of a region on screen (pixels) each level of detail is used for
+LOD_PIXELS = [400, 120, 30, 0]
+
+
+def read_obj(obj_file):
+    """
+    Reads an *.obj file as triangles
+    :return: vtk polydata
+    """
+    reader = vtk.vtkOBJReader()
+    reader.SetFileName(str(obj_file))
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(reader.GetOutputPort())
+    triangles.Update()
+    return triangles.GetOutput()
+
+
+def decimate(polydata, reduction):
+    """
+    Reduces the number of triangles of a mesh
+    :param reduction: fraction of triangles to remove
+    :return: vtk polydata
+    """
+    decimation = vtk.vtkQuadricDecimation()
+    decimation.SetInputData(polydata)
+    decimation.SetTargetReduction(reduction)
+    decimation.VolumePreservationOn()
+    decimation.Update()
+    return decimation.GetOutput()
+
+
+def screen_size(renderer, bounds):
+    """
+    Size on screen of the bounding box of an actor
+    :param renderer: vtk renderer
+    :param bounds: xmin, xmax, ymin, ymax, zmin, zmax of actor
+    :return: largest extent of the projected bounding box (pixels)
+    """
+    coordinate = vtk.vtkCoordinate()
+    coordinate.SetCoordinateSystemToWorld()
+    corners = []
+    for x in bounds[0:2]:
+        for y in bounds[2:4]:
+            for z in bounds[4:6]:
+                coordinate.SetValue(x, y, z)
+                corners.append(coordinate.GetComputedDoubleDisplayValue(renderer))
+    return np.max(np.ptp(np.array(corners), axis=0))
+
+
+def choose_lod(pixels):
+    """
+    Level of detail to use for a region of given size on screen
+    """
+    return next(level for level, min_pixels in enumerate(LOD_PIXELS) if pixels >= min_pixels)
+
+
+class RegionMesh:
+    def __init__(self, obj_file, cache_dir=MESH_CACHE_DIR):
+        """
+        Mesh of a region at each level of detail in LOD_REDUCTION. The decimated meshes are
+        computed the first time a level is needed and cached on disk, each level is only read
+        when used
+        :param obj_file: full path to a local *.obj file
+        :param cache_dir: folder to cache decimated meshes in
+        """
+        self.obj_file = Path(obj_file)
+        self.cache_dir = Path(cache_dir)
+        self.levels = {}
+
+    def cache_file(self, level):
+        # Meshes are recomputed when the obj file or the levels of detail change
+        key = hashlib.md5(f'{self.obj_file.resolve()}_{self.obj_file.stat().st_mtime}_'
+                          f'{LOD_REDUCTION}'.encode()).hexdigest()[:12]
+        return self.cache_dir.joinpath(f'{self.obj_file.stem}_{key}_lod{level}.vtp')
+
+    def build(self):
+        """
+        Decimates the mesh to all levels of detail and saves them to the cache
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        polydata = read_obj(self.obj_file)
+        writer = vtk.vtkXMLPolyDataWriter()
+        for level, reduction in enumerate(LOD_REDUCTION):
+            # Each level is decimated from the previous one, which is quicker than from the
+            # full mesh
+            if level > 0:
+                polydata = decimate(polydata, 1 - (1 - reduction) / (1 - LOD_REDUCTION[level - 1]))
+            writer.SetFileName(str(self.cache_file(level)))
+            writer.SetInputData(polydata)
+            writer.Write()
+
+    def get(self, level):
+        """
+        :return: vtk polydata of mesh at level of detail
+        """
+        if level not in self.levels:
+            if not self.cache_file(level).exists():
+                self.build()
+            reader = vtk.vtkXMLPolyDataReader()
+            reader.SetFileName(str(self.cache_file(level)))
+            reader.Update()
+            self.levels[level] = reader.GetOutput()
+        return self.levels[level]
+
+
+class RegionMeshes:
+    def __init__(self, fig, cache_dir=MESH_CACHE_DIR):
+        """
+        Region meshes of a mayavi figure shown at a level of detail chosen by their size on
+        screen. The levels are updated each time the camera moves
+        :param fig: mayavi figure
+        :param cache_dir: folder to cache decimated meshes in
+        """
+        self.fig = fig
+        self.cache_dir = cache_dir
+        self.renderer = fig.scene.renderer._vtk_obj
+        self.regions = {}
+        self.renderer.GetActiveCamera().AddObserver('ModifiedEvent', self.update)
+
+    def add(self, obj_file, color=(1., 1., 1.), opacity=0.4, name=None):
+        """
+        Adds a region mesh from an *.obj file to the figure
+        :param obj_file: full path to a local *.obj file
+        :param color: rgb tuple of floats between 0 and 1
+        :param opacity: float between 0 and 1
+        :param name: name of region, defaults to name of obj file
+        :return: vtk actor
+        """
+        mesh = RegionMesh(obj_file, cache_dir=self.cache_dir)
+        # Start with the coarsest mesh to find the size of the region on screen
+        level = len(LOD_REDUCTION) - 1
+        mapper = vtk.vtkPolyDataMapper()
+        mapper.SetInputData(mesh.get(level))
+        actor = vtk.vtkActor()
+        actor.SetMapper(mapper)
+        actor.GetProperty().SetOpacity(opacity)
+        actor.GetProperty().SetColor(color)
+        self.regions[name or mesh.obj_file.stem] = {'mesh': mesh, 'actor': actor,
+                                                    'level': level}
+        self.update_region(self.regions[name or mesh.obj_file.stem])
+        self.fig.scene.add_actor(actor)
+        return actor
+
+    def update_region(self, region):
+        level = choose_lod(screen_size(self.renderer, region['actor'].GetBounds()))
+        if level != region['level']:
+            region['actor'].GetMapper().SetInputData(region['mesh'].get(level))
+            region['level'] = level
+
+    def update(self, *args):
+        """
+        Sets the level of detail of each region for the current view
+        """
+        for region in self.regions.values():
+            self.update_region(region)
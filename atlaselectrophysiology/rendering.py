@@ -6,6 +6,8 @@ import vtk
 from matplotlib import pyplot as plt  # noqa
 import mayavi.mlab as mlab
 
+from atlaselectrophysiology.region_meshes import RegionMeshes
+
 
 def add_mesh(fig, obj_file, color=(1., 1., 1.), opacity=0.4):
     """
@@ -30,6 +32,32 @@ def add_mesh(fig, obj_file, color=(1., 1., 1.), opacity=0.4):
     return mapper, actor
 
 
+def region_meshes(fig):
+    """
+    Region meshes of a mayavi figure, created the first time a region is added
+    :return: RegionMeshes
+    """
+    if getattr(fig, 'region_meshes', None) is None:
+        fig.region_meshes = RegionMeshes(fig)
+    return fig.region_meshes
+
+
+def add_region(fig, obj_file, color=(1., 1., 1.), opacity=0.4, name=None):
+    """
+    Adds a region mesh from an *.obj file to the mayavi figure, shown at a level of detail chosen
+    by its size on screen
+    :param fig: mayavi figure
+    :param obj_file: full path to a local *.obj file
+    :param color: rgb tuple of floats between 0 and 1
+    :param opacity: float between 0 and 1
+    :param name: name of region, defaults to name of obj file
+    :return: vtk actor
+    """
+    actor = region_meshes(fig).add(obj_file, color=color, opacity=opacity, name=name)
+    fig.scene.render()
+    return actor
+
+
 def figure(grid=False, **kwargs):
     """
     Creates a mayavi figure with the brain atlas mesh
@@ -38,7 +66,8 @@ def figure(grid=False, **kwargs):
     fig = mlab.figure(bgcolor=(1, 1, 1), **kwargs)
     # engine = mlab.get_engine() # Returns the running mayavi engine.
     obj_file = Path(__file__).parent.joinpath("root.obj")
-    mapper, actor = add_mesh(fig, obj_file)
+    actor = add_region(fig, obj_file, name='root')
+    mapper = actor.GetMapper()
 
     if grid:
         # https://vtk.org/Wiki/VTK/Examples/Python/Visualization/CubeAxesActor
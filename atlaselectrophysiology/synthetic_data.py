@@ -0,0 +1,280 @@
+"""
+Generate synthetic ALF and spikeglx datasets in the layout read by the alignment GUI so that the
+data processing can be run and benchmarked without access to real recordings.
+
+Usage:
+    python synthetic_data.py /path/to/output -s 1000000 -d 3600 -c 500 -l NP1.0
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from ibllib.ephys.neuropixel import SITES_COORDINATES
+
+FS_AP = 30000
+FS_LF = 2500
+N_CHANNELS = 384
+N_SAMPLES_WAVEFORM = 82
+N_CHANNELS_WAVEFORM = 32
+LAYOUTS = ['NP1.0', 'NP2.1', 'NP2.4']
+# Size of the RF map stimulus (pixels) and no. of frames shown
+RFMAP_PIX = 15
+RFMAP_FRAMES = 6000
+# No. of presentations of each passive stimulus
+N_PASSIVE_STIMS = 40
+
+
+def make_channels(layout='NP1.0'):
+    """
+    Local coordinates and raw indices of the channels of a probe
+    :param layout: probe layout, one of LAYOUTS
+    :type layout: str
+    :return chn_coords: x and y position of each channel (um), np.array((nchannels, 2))
+    :return chn_ind: raw index of each channel, np.array((nchannels))
+    """
+    chn_ind = np.arange(N_CHANNELS)
+    if layout == 'NP1.0':
+        # Checkerboard of 4 columns, 2 channels per row 20 um apart
+        x, y = SITES_COORDINATES.T
+    elif layout == 'NP2.1':
+        # 2 columns, 2 channels per row 15 um apart
+        x = np.tile([0, 32], N_CHANNELS // 2)
+        y = np.repeat(np.arange(N_CHANNELS // 2) * 15, 2)
+    elif layout == 'NP2.4':
+        # 4 shanks 250 um apart with 2 columns each
+        n_per_shank = N_CHANNELS // 4
+        shank = np.repeat(np.arange(4), n_per_shank)
+        x = shank * 250 + np.tile([0, 32], N_CHANNELS // 2)
+        y = np.tile(np.repeat(np.arange(n_per_shank // 2) * 15, 2), 4)
+    else:
+        raise ValueError(f'layout must be one of {LAYOUTS}')
+
+    return np.c_[x, y].astype(float), chn_ind
+
+
+def make_alf(out_path, n_spikes=1000000, duration=3600, n_clusters=500, layout='NP1.0', seed=0):
+    """
+    Write a synthetic ALF folder with spikes, clusters, channels and the ephys qc datasets
+    :param out_path: folder to write to, created if it doesn't exist
+    :param n_spikes: total no. of spikes
+    :param duration: length of recording (s)
+    :param n_clusters: no. of clusters
+    :param layout: probe layout, one of LAYOUTS
+    :param seed: seed of the random generator
+    :return out_path: folder written to
+    :type out_path: pathlib.Path
+    """
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    chn_coords, chn_ind = make_channels(layout)
+    np.save(out_path.joinpath('channels.localCoordinates.npy'), chn_coords)
+    np.save(out_path.joinpath('channels.rawInd.npy'), chn_ind)
+
+    # Clusters with log-normal firing rates on random channels
+    clust_channels = rng.integers(0, N_CHANNELS, n_clusters)
+    clust_depths = chn_coords[clust_channels, 1]
+    clust_amps = rng.lognormal(np.log(80e-6), 0.5, n_clusters)
+    rates = rng.lognormal(0, 1, n_clusters)
+    spike_clusters = rng.choice(n_clusters, n_spikes, p=rates / np.sum(rates))
+
+    spike_times = np.sort(rng.uniform(0, duration, n_spikes))
+    spike_clusters = spike_clusters.astype(np.int64)
+    np.save(out_path.joinpath('spikes.times.npy'), spike_times)
+    np.save(out_path.joinpath('spikes.clusters.npy'), spike_clusters)
+    np.save(out_path.joinpath('spikes.depths.npy'),
+            clust_depths[spike_clusters] + rng.normal(0, 10, n_spikes))
+    np.save(out_path.joinpath('spikes.amps.npy'),
+            clust_amps[spike_clusters] * rng.lognormal(0, 0.2, n_spikes))
+
+    # Template waveforms with a trough followed by a peak on the first channel
+    t = np.arange(N_SAMPLES_WAVEFORM)
+    trough = rng.integers(30, 42, n_clusters)
+    p2t_samples = rng.integers(6, 30, n_clusters)
+    waveforms = (-np.exp(-0.5 * ((t - trough[:, np.newaxis]) / 3) ** 2) +
+                 0.3 * np.exp(-0.5 * ((t - (trough + p2t_samples)[:, np.newaxis]) / 6) ** 2))
+    decay = np.exp(-np.arange(N_CHANNELS_WAVEFORM) / 4)
+    waveforms = (waveforms[:, :, np.newaxis] * decay * clust_amps[:, np.newaxis, np.newaxis])
+    waveforms_channels = np.clip(clust_channels[:, np.newaxis] +
+                                 np.arange(N_CHANNELS_WAVEFORM), 0, N_CHANNELS - 1)
+
+    np.save(out_path.joinpath('clusters.channels.npy'), clust_channels)
+    np.save(out_path.joinpath('clusters.depths.npy'), clust_depths)
+    np.save(out_path.joinpath('clusters.amps.npy'), clust_amps)
+    np.save(out_path.joinpath('clusters.peakToTrough.npy'), p2t_samples / FS_AP * 1e3)
+    np.save(out_path.joinpath('clusters.waveforms.npy'), waveforms.astype(np.float32))
+    np.save(out_path.joinpath('clusters.waveformsChannels.npy'), waveforms_channels)
+    pd.DataFrame({'cluster_id': np.arange(n_clusters),
+                  'ks2_label': rng.choice(['good', 'mua'], n_clusters),
+                  'label': rng.choice([0, 1], n_clusters)}).to_csv(
+        out_path.joinpath('cluster_metrics.csv'), index=False)
+
+    # Ephys qc datasets, rms with a band of higher values in the middle of the probe
+    depth_profile = 1 + np.exp(-0.5 * ((chn_coords[:, 1] - np.median(chn_coords[:, 1])) /
+                                       500) ** 2)
+    n_windows = max(int(duration / 4), 2)
+    for band, scale in zip(['AP', 'LF'], [10e-6, 50e-6]):
+        rms = (scale * depth_profile * rng.lognormal(0, 0.1, (n_windows, N_CHANNELS)))
+        np.save(out_path.joinpath(f'_iblqc_ephysTimeRms{band}.rms.npy'), rms.astype(np.single))
+        np.save(out_path.joinpath(f'_iblqc_ephysTimeRms{band}.timestamps.npy'),
+                np.linspace(0, duration, n_windows).astype(np.single))
+    freqs = np.linspace(0, FS_LF / 2, 513)
+    power = (1 / (1 + freqs[:, np.newaxis]) * depth_profile * 1e-10 *
+             rng.lognormal(0, 0.1, (freqs.size, N_CHANNELS)))
+    np.save(out_path.joinpath('_iblqc_ephysSpectralDensityLF.power.npy'), power.astype(np.single))
+    np.save(out_path.joinpath('_iblqc_ephysSpectralDensityLF.freqs.npy'), freqs.astype(np.single))
+    lfp = rng.normal(0, 1, (N_CHANNELS, 2000))
+    np.savez(out_path.joinpath('lfp_corr'), lfp_corr=np.corrcoef(lfp), lfp_cov=np.cov(lfp))
+
+    return out_path
+
+
+def make_passive(alf_path, duration=3600, seed=0):
+    """
+    Write synthetic passive stimulus datasets where they are read for an ALF folder
+    session/alf/probe: the RF map, auditory stimuli and gabor tables in session/alf and the RF map
+    frames in session/raw_passive_data. The passive protocol takes up the last 40 % of the
+    recording
+    :param alf_path: ALF folder of the probe
+    :param duration: length of recording (s)
+    :param seed: seed of the random generator
+    :return session_path: session folder written to
+    :type session_path: pathlib.Path
+    """
+    session_path = Path(alf_path).parent.parent
+    session_path.joinpath('alf').mkdir(parents=True, exist_ok=True)
+    session_path.joinpath('raw_passive_data').mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    # RF map of sparse white and black squares on a gray background
+    frames = np.full((RFMAP_FRAMES, RFMAP_PIX, RFMAP_PIX), 128, dtype=np.uint8)
+    stim = rng.random(frames.shape) < 0.05
+    frames[stim] = rng.choice(np.array([0, 255], dtype=np.uint8), np.sum(stim))
+    # Stored as read by PlotData.get_rfmap_data
+    np.transpose(frames, [2, 1, 0]).flatten(order='F').tofile(
+        session_path.joinpath('raw_passive_data', '_iblrig_RFMapStim.raw.bin'))
+    np.save(session_path.joinpath('alf', '_ibl_passiveRFM.times.npy'),
+            np.linspace(0.6, 0.8, RFMAP_FRAMES) * duration)
+
+    # Auditory stimuli and gabor patches in the rest of the passive protocol
+    def onsets():
+        return np.sort(rng.uniform(0.8, 1, N_PASSIVE_STIMS) * duration - 1)
+
+    stims = dict()
+    for stim_type in ['valve', 'tone', 'noise']:
+        stims[f'{stim_type}On'] = onsets()
+        stims[f'{stim_type}Off'] = stims[f'{stim_type}On'] + 0.1
+    pd.DataFrame(stims).to_csv(session_path.joinpath('alf', '_ibl_passiveStims.table.csv'),
+                               index=False)
+    gabor_start = onsets()
+    pd.DataFrame({'start': gabor_start, 'stop': gabor_start + 0.3,
+                  'position': rng.choice([-35, 35], N_PASSIVE_STIMS),
+                  'contrast': rng.choice([0.0625, 0.125, 0.25, 1], N_PASSIVE_STIMS),
+                  'phase': rng.uniform(0, 2 * np.pi, N_PASSIVE_STIMS)}).to_csv(
+        session_path.joinpath('alf', '_ibl_passiveGabor.table.csv'), index=False)
+
+    return session_path
+
+
+def make_behavioral_events(duration=3600, n_trials=400, seed=0):
+    """
+    Synthetic behavioural events in the format of LoadDataLocal.get_behavioral_event_data, the
+    trials take up the first 60 % of the recording
+    :param duration: length of recording (s)
+    :param n_trials: no. of trials
+    :param seed: seed of the random generator
+    :return events: event times
+    :type events: dict
+    """
+    rng = np.random.default_rng(seed)
+    gocue = np.sort(rng.uniform(0, 0.6, n_trials) * duration)
+    choice = gocue + rng.uniform(0.2, 2, n_trials)
+    iti = choice + 1
+    outcome = rng.choice(['L_reward', 'R_reward', 'L_noreward', 'R_noreward', 'ignore'],
+                         n_trials, p=[0.35, 0.35, 0.1, 0.1, 0.1])
+    left = np.char.startswith(outcome, 'L')
+    right = np.char.startswith(outcome, 'R')
+
+    events = {'gocue_all': gocue, 'ignore_all': gocue[outcome == 'ignore'],
+              'left_all': choice[left], 'right_all': choice[right], 'iti_all': iti}
+    trial_types = ['L_reward', 'R_reward', 'L_noreward', 'R_noreward']
+    events['gocue_direction_outcome'] = {key: gocue[outcome == key] for key in trial_types}
+    events['gocue_direction_outcome']['ignore'] = gocue[outcome == 'ignore']
+    events['choice_direction_outcome'] = {key: choice[outcome == key] for key in trial_types}
+    events['iti_direction_outcome'] = {key: iti[outcome == key] for key in trial_types}
+    return events
+
+
+def make_spikeglx(out_path, duration=10, band='ap', seed=0):
+    """
+    Write a synthetic spikeglx binary file and its meta file for a Neuropixel 1.0 probe
+    :param out_path: folder to write to, created if it doesn't exist
+    :param duration: length of recording (s)
+    :param band: 'ap' or 'lf'
+    :return bin_file: path of binary file
+    :type bin_file: pathlib.Path
+    """
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    fs = FS_AP if band == 'ap' else FS_LF
+    n_samples = int(duration * fs)
+    n_saved = N_CHANNELS + 1
+
+    bin_file = out_path.joinpath(f'_spikeglx_ephysData_g0_t0.imec0.{band}.bin')
+    # Write in chunks of one second so long files don't need to fit in memory
+    with open(bin_file, 'wb') as f:
+        for first in range(0, n_samples, fs):
+            n = min(fs, n_samples - first)
+            data = rng.normal(0, 20, (n, n_saved)).astype(np.int16)
+            # Sync channel toggles every half second
+            data[:, -1] = ((first + np.arange(n)) // (fs // 2) % 2) * 64
+            data.tofile(f)
+
+    imro = ''.join(f'({i} 0 0 500 250 1)' for i in range(N_CHANNELS))
+    meta = {
+        'appVersion': '20190327',
+        'fileSizeBytes': n_samples * n_saved * 2,
+        'fileTimeSecs': duration,
+        'imAiRangeMax': 0.6,
+        'imAiRangeMin': -0.6,
+        'imDatPrb_type': 0,
+        'imMaxInt': 512,
+        'imSampRate': fs,
+        'imroTbl': f'(0,{N_CHANNELS})' + imro,
+        'nSavedChans': n_saved,
+        'snsApLfSy': f'{N_CHANNELS},0,1' if band == 'ap' else f'0,{N_CHANNELS},1',
+        'snsSaveChanSubset': 'all',
+        'typeThis': 'imec',
+    }
+    with open(bin_file.with_suffix('.meta'), 'w') as f:
+        f.write('\n'.join(f'{key}={val}' for key, val in meta.items()) + '\n')
+
+    return bin_file
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic ALF/spikeglx dataset')
+    parser.add_argument('out_path', help='Folder to write dataset to')
+    parser.add_argument('-s', '--n_spikes', default=1000000, type=int, required=False)
+    parser.add_argument('-d', '--duration', default=3600, type=float, required=False,
+                        help='Length of recording (s)')
+    parser.add_argument('-c', '--n_clusters', default=500, type=int, required=False)
+    parser.add_argument('-l', '--layout', default='NP1.0', choices=LAYOUTS, required=False)
+    parser.add_argument('-r', '--raw_duration', default=0, type=float, required=False,
+                        help='Length of raw spikeglx ap and lf files (s), 0 to not write them')
+    parser.add_argument('-p', '--passive', default=False, action='store_true',
+                        help='Write passive datasets, out_path should be session/alf/probe')
+    args = parser.parse_args()
+
+    make_alf(args.out_path, n_spikes=args.n_spikes, duration=args.duration,
+             n_clusters=args.n_clusters, layout=args.layout)
+    if args.passive:
+        make_passive(args.out_path, duration=args.duration)
+    if args.raw_duration:
+        make_spikeglx(args.out_path, duration=args.raw_duration, band='ap')
+        make_spikeglx(args.out_path, duration=args.raw_duration, band='lf')
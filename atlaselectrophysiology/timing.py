@@ -0,0 +1,183 @@
+"""
+Timing of the steps of the alignment GUI. Each timed call is written as a json line to a
+rotating log file so that timings can be compared across sessions and versions.
+
+To summarise the timings recorded in the log:
+    python timing.py
+    python timing.py -f /path/to/alignment_gui_timing.jsonl -n plot_
+"""
+from contextlib import contextmanager
+from pathlib import Path
+import functools
+import json
+import logging
+import logging.handlers
+import time
+
+import numpy as np
+
+TIMING_LOG = Path.home().joinpath('.iblapps', 'alignment_gui_timing.jsonl')
+TIMING_LOG_SIZE = 5 * 1024 ** 2
+TIMING_LOG_COUNT = 5
+
+_logger = logging.getLogger('atlaselectrophysiology.timing')
+_logger.propagate = False
+_session = {'session': None}
+
+
+def setup_log(log_file=TIMING_LOG):
+    """
+    Write timings to a rotating json lines log, only the first call adds a handler
+    """
+    if _logger.handlers:
+        return
+    try:
+        log_file = Path(log_file)
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=TIMING_LOG_SIZE,
+                                                       backupCount=TIMING_LOG_COUNT)
+    except OSError as err:
+        print(f'could not open timing log: {err}')
+        handler = logging.NullHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _logger.addHandler(handler)
+    _logger.setLevel(logging.INFO)
+
+
+def set_session(session):
+    """
+    Session that following timings are recorded for
+    """
+    _session['session'] = str(session) if session is not None else None
+
+
+@contextmanager
+def span(name, **info):
+    """
+    Time the enclosed block and write it to the timing log
+    :param name: name of timed step, e.g. PlotData.get_fr_img
+    :type name: str
+    :param info: extra information to store with the timing
+    """
+    setup_log()
+    start = time.time()
+    t0 = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        record = {'name': name, 'start': start, 'duration': time.perf_counter() - t0,
+                  'status': status, 'session': _session['session']}
+        record.update(info)
+        _logger.info(json.dumps(record, default=str))
+
+
+def timed(name=None):
+    """
+    Decorator to time every call of a function
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument(obj, prefix=None, methods=None):
+    """
+    Time all public method calls of an object instance
+    :param obj: instance to instrument, e.g. PlotData or LoadData
+    :param prefix: prefix of span names, defaults to class name
+    :param methods: names of methods to time, defaults to all public methods
+    :return: the instrumented object
+    """
+    prefix = prefix or type(obj).__name__
+    if methods is None:
+        methods = [m for m in dir(type(obj)) if not m.startswith('_') and
+                   callable(getattr(type(obj), m, None))]
+    for method in methods:
+        func = getattr(obj, method)
+        if getattr(func, '_timed', False):
+            continue
+        wrapper = timed(f'{prefix}.{method}')(func)
+        wrapper._timed = True
+        setattr(obj, method, wrapper)
+    return obj
+
+
+def load_timings(log_file=TIMING_LOG):
+    """
+    Read all timings from the log file and its rotated backups
+    :return: list of timing records
+    """
+    log_file = Path(log_file)
+    files = sorted(log_file.parent.glob(log_file.name + '.*'), reverse=True) + [log_file]
+    records = []
+    for file in files:
+        if not file.exists():
+            continue
+        with open(file, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return records
+
+
+def summarise(records, name_filter=None, percentiles=(50, 90, 99)):
+    """
+    Aggregate timings by name
+    :param records: timing records from load_timings
+    :param name_filter: only include names that contain this string
+    :param percentiles: percentiles of the durations to compute
+    :return summary: for each name the no. of calls and sessions and duration percentiles (s)
+    :type summary: dict
+    """
+    durations = dict()
+    sessions = dict()
+    for record in records:
+        if name_filter and name_filter not in record['name']:
+            continue
+        durations.setdefault(record['name'], []).append(record['duration'])
+        sessions.setdefault(record['name'], set()).add(record.get('session'))
+
+    summary = dict()
+    for name, duration in durations.items():
+        summary[name] = {'count': len(duration), 'sessions': len(sessions[name])}
+        summary[name].update({f'p{p}': val for p, val in
+                              zip(percentiles, np.percentile(duration, percentiles))})
+    return summary
+
+
+def print_summary(summary):
+    if not summary:
+        print('no timings recorded')
+        return
+    keys = [key for key in next(iter(summary.values())).keys()]
+    width = max(len(name) for name in summary)
+    print(f"{'name':<{width}} " + ' '.join(f'{key:>9}' for key in keys))
+    for name, stats in sorted(summary.items(), key=lambda k: -k[1][keys[-1]]):
+        print(f'{name:<{width}} ' + ' '.join(f'{stats[key]:>9d}' if isinstance(stats[key], int)
+                                             else f'{stats[key]:>9.4f}' for key in keys))
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Summarise alignment GUI timings')
+    parser.add_argument('-f', '--file', default=str(TIMING_LOG), required=False,
+                        help='Timing log file')
+    parser.add_argument('-n', '--name', default=None, required=False,
+                        help='Only show steps whose name contains this string')
+    args = parser.parse_args()
+
+    print_summary(summarise(load_timings(args.file), name_filter=args.name))
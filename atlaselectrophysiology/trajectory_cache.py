@@ -0,0 +1,190 @@
+"""
+Local cache of the histology track trajectories registered on Alyx, used to find insertions
+close to the one being aligned.
+
+The trajectories and the coordinates sampled along the active part of each track are saved to
+disk, later sessions only download the trajectories modified since the last refresh. The mean of
+the sampled points of each track is indexed in a KD-tree so nearby insertions are found with a
+radius search instead of computing the distance to every track.
+"""
+from datetime import datetime, timedelta
+from pathlib import Path
+import hashlib
+import json
+
+import numpy as np
+from scipy.spatial import cKDTree
+import ibllib.atlas as atlas
+import ibllib.pipes.histology as histology
+
+CACHE_DIR = Path.home().joinpath('.iblapps')
+# Depths along the track sampled for the distance between trajectories (m)
+TRACK_DEPTHS = np.arange(200, 4100, 20) / 1e6
+# Deleted trajectories are only noticed on a full refresh, done when the cache is this old
+FULL_REFRESH_AGE = timedelta(days=7)
+CACHE_VERSION = 1
+
+
+def cache_file(base_url):
+    """
+    Cache file for the trajectories of an Alyx database
+    """
+    return CACHE_DIR.joinpath(f'trajectories_{hashlib.md5(base_url.encode()).hexdigest()[:8]}'
+                              '.npz')
+
+
+class TrajectoryCache:
+    def __init__(self, rest, file=None, depths=TRACK_DEPTHS):
+        """
+        :param rest: function to query the Alyx REST api, one.alyx.rest or a local stand-in
+        with the same signature
+        :param file: file the cache is saved to, no cache is saved if None
+        :type file: pathlib.Path
+        :param depths: depths along the track to sample (m)
+        """
+        self.rest = rest
+        self.file = Path(file) if file is not None else None
+        self.depths = depths
+        self.records = []
+        self.ids = []
+        self.coords = np.empty((0, len(depths), 3))
+        self.modified = None
+        self.refreshed = None
+        self.tree = None
+        self.load()
+
+    def load(self):
+        """
+        Load the cache from disk, an unreadable or out of date cache is ignored
+        """
+        if self.file is None or not self.file.exists():
+            return
+        try:
+            cache = np.load(self.file, allow_pickle=False)
+            info = json.loads(str(cache['info']))
+            if info['version'] != CACHE_VERSION or \
+                    not np.array_equal(cache['depths'], self.depths):
+                return
+            self.records = info['records']
+            self.modified = info['modified']
+            self.refreshed = info['refreshed']
+            self.coords = cache['coords']
+            self.ids = [rec['id'] for rec in self.records]
+        except Exception as err:
+            print(f'could not load trajectory cache: {err}')
+
+    def save(self):
+        if self.file is None:
+            return
+        info = {'version': CACHE_VERSION, 'records': self.records, 'modified': self.modified,
+                'refreshed': self.refreshed}
+        try:
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.file, 'wb') as f:
+                np.savez(f, info=json.dumps(info), coords=self.coords, depths=self.depths)
+        except OSError as err:
+            print(f'could not save trajectory cache: {err}')
+
+    def sample_track(self, record):
+        """
+        3D coordinates of the points sampled along the active part of a trajectory
+        :return: np.array((ndepths, 3))
+        """
+        traj = atlas.Insertion.from_dict(record)
+        return histology.interpolate_along_track(np.vstack([traj.tip, traj.entry]), self.depths)
+
+    def refresh(self, full=False):
+        """
+        Update the cache with the histology tracks modified since the last refresh. Tracks that
+        have no tracing are not kept
+        :param full: download all trajectories instead of only the modified ones
+        """
+        if self.modified is None or self.refreshed is None or \
+                datetime.now() - datetime.fromisoformat(self.refreshed) > FULL_REFRESH_AGE:
+            full = True
+
+        refreshed = datetime.now().isoformat()
+        if full:
+            records = self.rest('trajectories', 'list', provenance='Histology track')
+            self.records = []
+            self.ids = []
+            self.coords = np.empty((0, len(self.depths), 3))
+        else:
+            records = self.rest('trajectories', 'list', provenance='Histology track',
+                                django=f'datetime__gt,{self.modified}')
+
+        index = {traj_id: i for i, traj_id in enumerate(self.ids)}
+        keep = np.ones(len(self.records), dtype=bool)
+        new_records = []
+        new_coords = []
+        for record in records:
+            i = index.get(record['id'])
+            if record['x'] is None:
+                if i is not None:
+                    keep[i] = False
+                continue
+            coords = self.sample_track(record)
+            if i is None:
+                new_records.append(record)
+                new_coords.append(coords)
+            else:
+                self.records[i] = record
+                self.coords[i] = coords
+
+        self.records = [rec for rec, k in zip(self.records, keep) if k] + new_records
+        self.coords = np.concatenate([self.coords[keep],
+                                      np.reshape(new_coords, (-1, len(self.depths), 3))])
+        self.ids = [rec['id'] for rec in self.records]
+        modified = [rec['datetime'] for rec in records if rec.get('datetime')]
+        if full:
+            # Without modification times the next refresh has to download everything again
+            self.modified = max(modified) if modified else None
+        else:
+            self.modified = max(modified, default=self.modified)
+        self.refreshed = refreshed
+        self.tree = None
+        self.save()
+
+        return self.records
+
+    def build_tree(self):
+        """
+        KD-tree over the mean of the sampled points of each track
+        """
+        self.tree = cKDTree(np.mean(self.coords, axis=1))
+
+    def nearby(self, traj_id, n=10, radius=100e-6):
+        """
+        Find the trajectories closest to a trajectory by average distance between points sampled
+        at the same depths. Candidates are found with a radius search around the mean point of the
+        track, the radius is doubled until enough trajectories lie within it
+        :param traj_id: id of trajectory
+        :param n: no. of trajectories to return, including traj_id itself
+        :param radius: starting search radius (m)
+        :return idx: index of closest trajectories in records, ordered by distance
+        :type idx: np.array((n))
+        :return dist: average distance to closest trajectories (m)
+        :type dist: np.array((n))
+        :return dist_mlap: average distance to closest trajectories in ml and ap only (m)
+        :type dist_mlap: np.array((n))
+        """
+        if self.tree is None:
+            self.build_tree()
+        chosen = self.coords[self.ids.index(traj_id)]
+        n = min(n, len(self.ids))
+
+        while True:
+            # The average distance between points is at least the distance between the mean
+            # points, so all trajectories with an average distance below radius are candidates
+            candidates = np.sort(self.tree.query_ball_point(np.mean(chosen, axis=0), r=radius))
+            dist = np.mean(np.sqrt(np.sum((self.coords[candidates] - chosen) ** 2, axis=2)),
+                           axis=1)
+            if np.sum(dist <= radius) >= n or candidates.size == len(self.ids):
+                break
+            radius *= 2
+
+        order = np.argsort(dist)[:n]
+        idx = candidates[order]
+        dist_mlap = np.mean(np.sqrt(np.sum((self.coords[idx, :, 0:2] - chosen[:, 0:2]) ** 2,
+                                           axis=2)), axis=1)
+        return idx, dist[order], dist_mlap
@@ -0,0 +1,208 @@
+"""
+Outbox of uploads to Alyx. The requests of an upload are built once on the GUI thread and saved to
+disk as a job, jobs are then sent in order by a background worker. Each step of a job is retried
+when it fails and marked as done once sent, so a job that could not be sent is resumed from the
+failed step the next time the outbox is flushed, also after the GUI is restarted.
+"""
+from pathlib import Path
+import hashlib
+import json
+import os
+import time
+import traceback
+import uuid
+
+from PyQt5 import QtCore
+
+OUTBOX_DIR = Path.home().joinpath('.iblapps', 'upload_outbox')
+MAX_ATTEMPTS = 5
+# Delay before the first retry of a step (s), doubled for each following retry
+RETRY_DELAY = 2
+# No. of channels created with a single request
+CHANNEL_BATCH_SIZE = 1000
+
+
+def outbox_folder(base_url):
+    """
+    Outbox folder of an Alyx database, so jobs are only ever sent to the database they were made
+    for
+    """
+    return OUTBOX_DIR.joinpath(hashlib.md5(base_url.encode()).hexdigest()[:8])
+
+
+class UploadOutbox:
+    def __init__(self, rest, folder=OUTBOX_DIR, handlers=None, max_attempts=MAX_ATTEMPTS,
+                 retry_delay=RETRY_DELAY):
+        """
+        :param rest: function to query the Alyx REST api, one.alyx.rest or a stand-in with the
+        same signature
+        :param folder: folder jobs are saved to
+        :param handlers: functions to send steps that are not plain REST requests, keyed by step
+        type. Called with the step data, return a dict of results
+        :type handlers: dict
+        """
+        self.rest = rest
+        self.folder = Path(folder)
+        self.handlers = {'trajectory': self.send_trajectory, 'channels': self.send_channels,
+                         'json': self.send_json}
+        self.handlers.update(handlers or {})
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def add(self, steps, info=None):
+        """
+        Save a new job to the outbox
+        :param steps: steps to send in order, each a dict with 'type' and 'data'
+        :type steps: list of dict
+        :param info: information returned with the results once the job is sent
+        :return job_id: id of job
+        :type job_id: str
+        """
+        job_id = f'{time.time_ns()}_{uuid.uuid4().hex[:8]}'
+        job = {'id': job_id, 'info': info or {}, 'results': {}, 'error': None,
+               'steps': [dict(step, done=False) for step in steps]}
+        self.save_job(job)
+        return job_id
+
+    def job_file(self, job_id):
+        return self.folder.joinpath(f'{job_id}.json')
+
+    def save_job(self, job):
+        """
+        Write job to the outbox, written to a temporary file first so a job is never left half
+        written
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        file = self.job_file(job['id'])
+        tmp_file = file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_file, file)
+
+    def pending(self):
+        """
+        Ids of jobs in the outbox, oldest first
+        """
+        if not self.folder.exists():
+            return []
+        return sorted(file.stem for file in self.folder.glob('*.json'))
+
+    def find(self, **info):
+        """
+        Ids of jobs in the outbox whose info has the given values, oldest first
+        """
+        job_ids = []
+        for job_id in self.pending():
+            try:
+                with open(self.job_file(job_id), 'r') as f:
+                    job_info = json.load(f)['info']
+            except FileNotFoundError:
+                # Job was sent while looking for it
+                continue
+            if all(job_info.get(key) == val for key, val in info.items()):
+                job_ids.append(job_id)
+        return job_ids
+
+    def send(self, job_id):
+        """
+        Send the steps of a job that have not been sent yet. A job that is fully sent is removed
+        from the outbox
+        :return job: the job with the results of all steps
+        :type job: dict
+        """
+        with open(self.job_file(job_id), 'r') as f:
+            job = json.load(f)
+
+        for step in job['steps']:
+            if step['done']:
+                continue
+            for attempt in range(self.max_attempts):
+                try:
+                    results = self.handlers[step['type']](step['data'], job['results'], step)
+                    break
+                except Exception:
+                    job['error'] = traceback.format_exc()
+                    # Keep progress within the step, e.g. channel batches already sent
+                    self.save_job(job)
+                    if attempt == self.max_attempts - 1:
+                        raise
+                    time.sleep(self.retry_delay * 2 ** attempt)
+            job['results'].update(results or {})
+            job['error'] = None
+            step['done'] = True
+            self.save_job(job)
+
+        self.job_file(job_id).unlink()
+        return job
+
+    def flush(self, on_done=None, on_failed=None):
+        """
+        Send all jobs in the outbox. Sending stops at the first job that fails, it is kept and
+        retried with the later jobs on the next flush, so a job is never sent after a newer one
+        :param on_done: called with the job id, info and results of each sent job
+        :param on_failed: called with the job id, info and error of each job that failed
+        """
+        for job_id in self.pending():
+            try:
+                job = self.send(job_id)
+            except Exception as err:
+                print(f'upload {job_id} failed, it will be retried later: {err}')
+                if on_failed is not None:
+                    with open(self.job_file(job_id), 'r') as f:
+                        info = json.load(f)['info']
+                    on_failed(job_id, info, str(err))
+                break
+            if on_done is not None:
+                on_done(job_id, job['info'], job['results'])
+
+    def send_trajectory(self, data, results, step):
+        """
+        Replace the trajectory of the probe insertion with the same provenance by a new one
+        """
+        if step.get('trajectory_id') is None:
+            prev_traj = self.rest('trajectories', 'list', probe_insertion=data['probe_insertion'],
+                                  provenance=data['provenance'])
+            for traj in prev_traj:
+                self.rest('trajectories', 'delete', id=traj['id'])
+            traj = self.rest('trajectories', 'create', data=data)
+            step['trajectory_id'] = traj['id']
+        return {'trajectory_id': step['trajectory_id']}
+
+    def send_channels(self, data, results, step):
+        """
+        Create the channels of the trajectory created by the previous trajectory step, in batches
+        of CHANNEL_BATCH_SIZE channels
+        """
+        n_sent = step.get('n_sent', 0)
+        while n_sent < len(data):
+            batch = [dict(chn, trajectory_estimate=results['trajectory_id'])
+                     for chn in data[n_sent:n_sent + CHANNEL_BATCH_SIZE]]
+            self.rest('channels', 'create', data=batch)
+            n_sent += len(batch)
+            step['n_sent'] = n_sent
+        return {'n_channels': n_sent}
+
+    def send_json(self, data, results, step):
+        """
+        Update the json field of the trajectory of the probe insertion with given provenance
+        """
+        traj = self.rest('trajectories', 'list', probe_insertion=data['probe_insertion'],
+                         provenance=data['provenance'])
+        self.rest('trajectories', 'partial_update', id=traj[0]['id'],
+                  data={'json': data['json']})
+        return {'trajectory_id': traj[0]['id']}
+
+
+class UploadWorker(QtCore.QThread):
+    """
+    Sends the jobs in the outbox off the GUI thread
+    """
+    done = QtCore.pyqtSignal(str, object, object)
+    failed = QtCore.pyqtSignal(str, object, str)
+
+    def __init__(self, outbox, parent=None):
+        super(UploadWorker, self).__init__(parent)
+        self.outbox = outbox
+
+    def run(self):
+        self.outbox.flush(on_done=self.done.emit, on_failed=self.failed.emit)
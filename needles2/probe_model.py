@@ -1,3 +1,9 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import itertools
+from pathlib import Path
+import hashlib
+import json
+
 import numpy as np
 from brainbox.numerical import ismember
 from oneibl.one import ONE
@@ -9,15 +15,144 @@ import time
 from scipy.signal import fftconvolve
 from ibllib.dsp import fcn_cosine
 
-PROV_2_VAL = {
-    'Resolved': 90,
-    'Ephys aligned histology track': 70,
-    'Histology track': 50,
-    'Micro-manipulator': 30,
-    'Planned': 10}
+from atlaselectrophysiology.compare_alignments import SharedAtlas, attach_atlas
+from needles2.trajectory_store import TrajectoryStore, store_file, PROV_2_VAL
 
 VAL_2_PROV = {v: k for k, v in PROV_2_VAL.items()}
 
+CACHE_DIR = Path.home().joinpath('.iblapps', 'needles2')
+# No. of trajectories sent to a worker process at once
+CHANNEL_CHUNK_SIZE = 50
+# Distances over which the coverage of a channel falls from 1 to 0 (m)
+COVERAGE_DIST = np.array([100, 150]) / 1e6
+# Memory used by the blocks of the coverage convolution (bytes), not including the volumes
+COVERAGE_MEMORY = 1e9
+# Approximate memory used per voxel of a block by the fft convolution (bytes)
+BYTES_PER_VOXEL = 24
+
+# Atlas of the worker process, set by _init_worker
+_worker = {}
+
+
+def get_channels(traj, ins, ba, depths=None):
+    """
+    Channel locations of a trajectory
+    :param traj: trajectory
+    :param ins: insertion of trajectory, only needed for histology and ephys aligned trajectories
+    :param ba: brain atlas
+    :param depths: depths of channels along probe (um)
+    :return: 3D coordinates of channels relative to bregma (m)
+    :type: np.array((nchannels, 3))
+    """
+    if depths is None:
+        depths = SITES_COORDINATES[:, 1]
+    if traj['provenance'] == 'Planned' or traj['provenance'] == 'Micro-manipulator':
+        ins = atlas.Insertion.from_dict(traj)
+        # Deepest coordinate first
+        xyz = np.c_[ins.tip, ins.entry].T
+        xyz_channels = histology.interpolate_along_track(xyz, (depths +
+                                                               TIP_SIZE_UM) / 1e6)
+    else:
+        xyz = np.array(ins['json']['xyz_picks']) / 1e6
+        if traj['provenance'] == 'Histology track':
+            xyz = xyz[np.argsort(xyz[:, 2]), :]
+            xyz_channels = histology.interpolate_along_track(xyz, (depths +
+                                                                   TIP_SIZE_UM) / 1e6)
+        else:
+            align_key = ins['json']['extended_qc']['alignment_stored']
+            feature = traj['json'][align_key][0]
+            track = traj['json'][align_key][1]
+            ephysalign = EphysAlignment(xyz, depths, track_prev=track,
+                                        feature_prev=feature,
+                                        brain_atlas=ba, speedy=True)
+            xyz_channels = ephysalign.get_channel_locations(feature, track)
+
+    return xyz_channels
+
+
+def coverage_kernel(dx):
+    """
+    Cosine kernel of the coverage of a single channel
+    :param dx: voxel size (m)
+    """
+    template = np.arange(- np.max(COVERAGE_DIST) - dx, np.max(COVERAGE_DIST) + 2 * dx, dx) ** 2
+    kernel = sum(np.meshgrid(template, template, template))
+    kernel = 1 - fcn_cosine(COVERAGE_DIST)(np.sqrt(kernel))
+    return kernel.astype(np.float32)
+
+
+def block_convolve(vol, kernel, memory_budget=COVERAGE_MEMORY, n_threads=1):
+    """
+    Convolution of a sparse volume with a kernel, same as fftconvolve with mode='same' in float32.
+    Only the bounding box of the non zero voxels is convolved, split in blocks whose full
+    convolutions are added to the output (overlap-add). The blocks are sized so that 4 of them
+    fit in memory_budget and don't depend on the number of threads, the results are added in the
+    same order so are identical for any number of threads
+    :param vol: volume to convolve
+    :param kernel: kernel with the same size along each axis
+    :param memory_budget: memory used by the blocks (bytes)
+    :param n_threads: number of blocks convolved at once, limited by the memory budget
+    :return: convolved volume
+    :type: np.array of float32, same shape as vol
+    """
+    out = np.zeros(vol.shape, dtype=np.float32)
+    nonzero = [np.flatnonzero(np.any(vol, axis=tuple(ax for ax in range(3) if ax != axis)))
+               for axis in range(3)]
+    if any(idx.size == 0 for idx in nonzero):
+        return out
+    lims = [(idx[0], idx[-1] + 1) for idx in nonzero]
+
+    k = kernel.shape[0]
+    # Offset of the start of the full convolution of a block relative to the block
+    offset = (k - 1) // 2
+    edge = max(int((memory_budget / 4 / BYTES_PER_VOXEL) ** (1 / 3)) - (k - 1), k)
+    n_threads = int(max(1, min(n_threads, memory_budget // (BYTES_PER_VOXEL * (edge + k) ** 3))))
+    starts = list(itertools.product(*[range(lim[0], lim[1], edge) for lim in lims]))
+
+    def convolve(start):
+        block = vol[tuple(slice(s, min(s + edge, lim[1])) for s, lim in zip(start, lims))]
+        if not np.any(block):
+            return None
+        return fftconvolve(block.astype(np.float32), kernel, mode='full')
+
+    def add(start, result):
+        out_slice = []
+        result_slice = []
+        for s, n, size in zip(start, result.shape, vol.shape):
+            first = s - offset
+            out_slice.append(slice(max(first, 0), min(first + n, size)))
+            result_slice.append(slice(max(first, 0) - first, min(first + n, size) - first))
+        out[tuple(out_slice)] += result[tuple(result_slice)]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for i in range(0, len(starts), n_threads):
+            batch = starts[i:i + n_threads]
+            for start, result in zip(batch, executor.map(convolve, batch)):
+                if result is not None:
+                    add(start, result)
+
+    return out
+
+
+def _init_worker(template, volumes):
+    _worker['ba'] = attach_atlas(template, volumes)
+
+
+def _get_channels_chunk(tasks):
+    """
+    Channel locations of a chunk of trajectories, None for trajectories that fail
+    """
+    depths = SITES_COORDINATES[:, 1]
+    xyz_channels = []
+    for traj, ins in tasks:
+        try:
+            xyz_channels.append(get_channels(traj, ins, _worker['ba'], depths=depths))
+        except Exception as err:
+            print(err)
+            print(traj['id'])
+            xyz_channels.append(None)
+    return xyz_channels
+
 
 class ProbeModel:
     def __init__(self, one=None, ba=None, lazy=False):
@@ -34,16 +169,18 @@ class ProbeModel:
         self.cvol = None
         self.cvol_flat = None
         self.initialised = False
+        base_url = getattr(self.one.alyx, '_base_url', None) or ''
+        self.store = TrajectoryStore(self.one.alyx.rest, file=store_file(base_url))
 
         if not lazy:
             self.initialise()
 
     def initialise(self):
-        self.get_traj_for_provenance(provenance='Histology track', django=['x__isnull,False'])
+        self.store.refresh()
+        self.get_traj_for_provenance(provenance='Histology track')
         self.get_traj_for_provenance(provenance='Ephys aligned histology track')
         self.get_traj_for_provenance(provenance='Ephys aligned histology track',
-                                     django=['probe_insertion__json__extended_qc__'
-                                             'alignment_resolved,True'], prov_dict='Resolved')
+                                     prov_dict='Resolved')
         self.find_traj_is_best(provenance='Histology track')
         self.find_traj_is_best(provenance='Ephys aligned histology track')
         self.traj['Resolved']['is_best'] = np.arange(len(self.traj['Resolved']['traj']))
@@ -55,67 +192,38 @@ class ProbeModel:
     def get_traj_info(traj):
         return traj['probe_insertion'], traj['x'], traj['y']
 
-    def get_traj_for_provenance(self, provenance='Histology track', django=None,
-                                prov_dict=None):
-        start = time.time()
-        if django is None:
-            django = []
-
+    def set_traj(self, prov_dict, trajs):
+        self.traj[prov_dict]['traj'] = np.empty(len(trajs), dtype=object)
+        self.traj[prov_dict]['traj'][:] = trajs
+        self.traj[prov_dict]['ins'] = np.array([traj['probe_insertion'] for traj in trajs])
+        self.traj[prov_dict]['x'] = np.array([traj['x'] for traj in trajs], dtype=float)
+        self.traj[prov_dict]['y'] = np.array([traj['y'] for traj in trajs], dtype=float)
+
+    def get_traj_for_provenance(self, provenance='Histology track', prov_dict=None):
+        """
+        Get the trajectories of a provenance from the local store
+        :param prov_dict: key of self.traj to store trajectories in, defaults to provenance.
+        'Resolved' only gets the trajectories of insertions with a resolved alignment
+        """
         if prov_dict is None:
             prov_dict = provenance
-
-        django_base = ['probe_insertion__session__project__name__icontains,'
-                       'ibl_neuropixel_brainwide_01']
-        django_str = ','.join(django_base + django)
-
-        self.traj[prov_dict]['traj'] = np.array(self.one.alyx.rest('trajectories', 'list',
-                                                                   provenance=provenance,
-                                                                   django=django_str))
-        ins_ids, x, y = zip(*[self.get_traj_info(traj) for traj in self.traj[prov_dict]['traj']])
-        self.traj[prov_dict]['ins'] = np.array(ins_ids)
-        self.traj[prov_dict]['x'] = np.array(x)
-        self.traj[prov_dict]['y'] = np.array(y)
-        end = time.time()
-        print(end-start)
+        if provenance == 'Resolved':
+            provenance = 'Ephys aligned histology track'
+        if not self.store.get_info('refreshed'):
+            self.store.refresh()
+        self.set_traj(prov_dict, self.store.trajectories(provenance,
+                                                         resolved=prov_dict == 'Resolved'))
 
     def get_insertions_with_xyz(self):
-        start = time.time()
-        django_str = 'session__project__name__icontains,ibl_neuropixel_brainwide_01,' \
-                     'json__has_key,xyz_picks'
-        self.ins['insertions'] = self.one.alyx.rest('insertions', 'list', django=django_str)
+        self.ins['insertions'] = self.store.insertions_with_xyz()
         self.ins['ids'] = np.array([ins['id'] for ins in self.ins['insertions']])
 
-        end = time.time()
-        print(end-start)
-
-
     def compute_best_for_provenance(self, provenance='Histology track'):
-        val = PROV_2_VAL[provenance]
-        prov_to_include = []
-        for k, v in VAL_2_PROV.items():
-            if k >= val:
-                prov_to_include.append(v)
-
-        for iP, prov in enumerate(prov_to_include):
-            if not 'is_best' in self.traj[prov].keys():
-                self.find_traj_is_best(prov)
-
-            if iP == 0:
-                self.traj['Best']['traj'] = self.traj[prov]['traj'][self.traj[prov]['is_best']]
-                self.traj['Best']['ins'] = self.traj[prov]['ins'][self.traj[prov]['is_best']]
-                self.traj['Best']['x'] = self.traj[prov]['x'][self.traj[prov]['is_best']]
-                self.traj['Best']['y'] = self.traj[prov]['y'][self.traj[prov]['is_best']]
-            else:
-                self.traj['Best']['traj'] = np.r_[self.traj['Best']['traj'],
-                                                  (self.traj[prov]['traj']
-                                                  [self.traj[prov]['is_best']])]
-                self.traj['Best']['ins'] = np.r_[self.traj['Best']['ins'],
-                                                 (self.traj[prov]['ins']
-                                                 [self.traj[prov]['is_best']])]
-                self.traj['Best']['x'] = np.r_[self.traj['Best']['x'],
-                                               self.traj[prov]['x'][self.traj[prov]['is_best']]]
-                self.traj['Best']['y'] = np.r_[self.traj['Best']['y'],
-                                               self.traj[prov]['y'][self.traj[prov]['is_best']]]
+        """
+        Get the best trajectory of each insertion whose best trajectory has at least the rank of
+        provenance
+        """
+        self.set_traj('Best', self.store.best(min_rank=PROV_2_VAL[provenance]))
 
     def find_traj_is_best(self, provenance='Histology track'):
         val = PROV_2_VAL[provenance]
@@ -140,43 +248,97 @@ class ProbeModel:
             self.traj[provenance]['is_best'] = (self.traj[provenance]['is_best']
                                                 [np.where(np.invert(isin))[0]])
 
-    def get_all_channels(self, provenance):
+    def get_insertion(self, traj):
+        """
+        Insertion of a trajectory from the insertions with xyz picks, None if it has no picks
+        """
+        ins_idx = np.where(traj['probe_insertion'] == self.ins['ids'])[0]
+        return self.ins['insertions'][ins_idx[0]] if ins_idx.size else None
 
+    @staticmethod
+    def channel_key(traj, ins):
+        """
+        Hash of everything the channel locations of a trajectory depend on
+        """
+        ins_info = None if ins is None else \
+            [ins['json'].get('xyz_picks'),
+             ins['json'].get('extended_qc', {}).get('alignment_stored')]
+        return hashlib.md5(json.dumps([traj, ins_info], sort_keys=True, default=str)
+                           .encode()).hexdigest()
+
+    def get_all_channels(self, provenance, n_workers=None):
+        """
+        Channel locations of all trajectories of a provenance. The channels of each trajectory are
+        saved to disk, so only trajectories that are new or have changed are computed again. These
+        are computed in a pool of worker processes
+        :param provenance: provenance of trajectories
+        :param n_workers: number of processes, defaults to number of cpus
+        :return: 3D coordinates of channels within the atlas relative to bregma (m)
+        :type: np.array((nchannels, 3))
+        """
         depths = SITES_COORDINATES[:, 1]
         start1 = time.time()
-        for iT, traj in enumerate(self.traj[provenance]['traj']):
+        trajs = self.traj[provenance]['traj']
+        tasks = [(traj, self.get_insertion(traj)) for traj in trajs]
+        keys = np.array([self.channel_key(*task) for task in tasks])
+
+        # Each trajectory has one channel per depth, failed trajectories are left as nan
+        all_channels = np.full((len(trajs), depths.size, 3), np.nan)
+        cache_file = CACHE_DIR.joinpath(f'channels_{provenance.replace(" ", "_")}.npz')
+        if cache_file.exists():
+            with np.load(cache_file) as cached:
+                if cached['channels'].shape[1] == depths.size:
+                    _, idx, cached_idx = np.intersect1d(keys, cached['keys'], return_indices=True)
+                    all_channels[idx] = cached['channels'][cached_idx]
+        todo = np.where(np.isnan(all_channels[:, 0, 0]))[0]
+
+        if todo.size > 0:
+            # The aligned trajectories need the label volume to find the histology regions, it is
+            # shared with the worker processes rather than copied to each of them
+            shared = SharedAtlas(self.ba)
+            chunks = [todo[i:i + CHANNEL_CHUNK_SIZE]
+                      for i in range(0, todo.size, CHANNEL_CHUNK_SIZE)]
             try:
-                xyz_channels = self.get_channels(traj, depths=depths)
-
-                if iT == 0:
-                    all_channels = xyz_channels
-                else:
-                    all_channels = np.r_[all_channels, xyz_channels]
-            except Exception as err:
-                print(err)
-                print(traj['id'])
+                with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                         initargs=(shared.template, shared.volumes)) as executor:
+                    results = executor.map(_get_channels_chunk,
+                                           [[tasks[i] for i in chunk] for chunk in chunks])
+                    for chunk, xyz_channels in zip(chunks, results):
+                        for i, xyz in zip(chunk, xyz_channels):
+                            if xyz is not None:
+                                all_channels[i] = xyz
+            finally:
+                shared.close()
+
+            computed = ~np.isnan(all_channels[:, 0, 0])
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            np.savez(cache_file, keys=keys[computed], channels=all_channels[computed])
 
         end = time.time()
         print(end-start1)
+        all_channels = all_channels.reshape(-1, 3)
+        all_channels = all_channels[~np.isnan(all_channels[:, 0])]
         iii = self.ba.bc.xyz2i(all_channels)
-        keep_idx = np.setdiff1d(np.arange(all_channels.shape[0]), np.unique(np.where(iii < 0)[0]))
-        return all_channels[keep_idx, :]
-
-    def compute_coverage(self, all_channels):
-
+        return all_channels[~np.any(iii < 0, axis=1), :]
+
+    def compute_coverage(self, all_channels, memory_budget=COVERAGE_MEMORY, n_threads=1):
+        """
+        Coverage of the atlas by the channels, each voxel with a channel is convolved with a
+        cosine kernel
+        :param all_channels: 3D coordinates of channels relative to bregma (m)
+        :param memory_budget: memory used by the convolution on top of the volumes (bytes)
+        :param n_threads: number of threads, the coverage doesn't depend on it
+        :return: coverage volume
+        :type: np.array of float32
+        """
         start = time.time()
-        cvol = np.zeros(self.ba.image.shape, dtype=np.float)
+        cvol = np.zeros(self.ba.image.shape, dtype=bool)
         val, counts = np.unique(self.ba._lookup(all_channels), return_counts=True)
         #cvol[np.unravel_index(val, cvol.shape)] = counts
         cvol[np.unravel_index(val, cvol.shape)] = 1
 
-        DIST_FCN = np.array([100, 150]) / 1e6
-        dx = self.ba.bc.dx
-        template = np.arange(- np.max(DIST_FCN) - dx, np.max(DIST_FCN) + 2 * dx, dx) ** 2
-        kernel = sum(np.meshgrid(template, template, template))
-        kernel = 1 - fcn_cosine(DIST_FCN)(np.sqrt(kernel))
-        #
-        cvol = fftconvolve(cvol, kernel, mode='same')
+        cvol = block_convolve(cvol, coverage_kernel(self.ba.bc.dx), memory_budget=memory_budget,
+                              n_threads=n_threads)
         end = time.time()
         print(end-start)
         self.cvol = cvol
@@ -210,38 +372,10 @@ class ProbeModel:
         return best_traj, ins
 
     def get_channels(self, traj, ins=None, depths=None):
-        if depths is None:
-            depths = SITES_COORDINATES[:, 1]
-        if traj['provenance'] == 'Planned' or traj['provenance'] == 'Micro-manipulator':
-            ins = atlas.Insertion.from_dict(traj)
-            # Deepest coordinate first
-            xyz = np.c_[ins.tip, ins.entry].T
-            xyz_channels = histology.interpolate_along_track(xyz, (depths +
-                                                                   TIP_SIZE_UM) / 1e6)
-        else:
-            if ins is None:
-                ins_idx = np.where(traj['probe_insertion'] == self.ins['ids'])[0][0]
-                xyz = np.array(self.ins['insertions'][ins_idx]['json']['xyz_picks']) / 1e6
-            else:
-                xyz = np.array(ins['json']['xyz_picks']) / 1e6
-            if traj['provenance'] == 'Histology track':
-                xyz = xyz[np.argsort(xyz[:, 2]), :]
-                xyz_channels = histology.interpolate_along_track(xyz, (depths +
-                                                                       TIP_SIZE_UM) / 1e6)
-            else:
-                if ins is None:
-                    align_key = (self.ins['insertions'][ins_idx]['json']['extended_qc']
-                                 ['alignment_stored'])
-                else:
-                    align_key = ins['json']['extended_qc']['alignment_stored']
-                feature = traj['json'][align_key][0]
-                track = traj['json'][align_key][1]
-                ephysalign = EphysAlignment(xyz, depths, track_prev=track,
-                                            feature_prev=feature,
-                                            brain_atlas=self.ba, speedy=True)
-                xyz_channels = ephysalign.get_channel_locations(feature, track)
-
-        return xyz_channels
+        if ins is None and traj['provenance'] not in ['Planned', 'Micro-manipulator']:
+            ins_idx = np.where(traj['probe_insertion'] == self.ins['ids'])[0][0]
+            ins = self.ins['insertions'][ins_idx]
+        return get_channels(traj, ins, self.ba, depths=depths)
 
     def get_brain_regions(self, traj, ins=None, mapping='Allen'):
         depths = SITES_COORDINATES[:, 1]
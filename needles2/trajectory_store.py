@@ -0,0 +1,196 @@
+"""
+Local store of the trajectories and insertions of the brainwide map used by needles2.
+
+The records are kept in a SQLite database, later sessions only download the trajectories
+modified since the last refresh and the insertions of those trajectories. The best trajectory
+of each insertion, the one with the highest ranked provenance, is kept in its own table that is
+only updated for the insertions whose trajectories changed.
+"""
+from datetime import datetime, timedelta
+from pathlib import Path
+import hashlib
+import json
+import sqlite3
+
+PROV_2_VAL = {
+    'Resolved': 90,
+    'Ephys aligned histology track': 70,
+    'Histology track': 50,
+    'Micro-manipulator': 30,
+    'Planned': 10}
+
+STORE_DIR = Path.home().joinpath('.iblapps', 'needles2')
+# Deleted trajectories and changes to insertions without a change to their trajectories are only
+# noticed on a full refresh, done when the store is this old
+FULL_REFRESH_AGE = timedelta(days=7)
+STORE_VERSION = 1
+TRAJ_DJANGO = 'probe_insertion__session__project__name__icontains,ibl_neuropixel_brainwide_01'
+INS_DJANGO = 'session__project__name__icontains,ibl_neuropixel_brainwide_01'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trajectories (
+    id TEXT PRIMARY KEY, probe_insertion TEXT, provenance TEXT, rank INTEGER, x REAL, y REAL,
+    datetime TEXT, record TEXT);
+CREATE INDEX IF NOT EXISTS trajectories_provenance ON trajectories (provenance);
+CREATE INDEX IF NOT EXISTS trajectories_insertion ON trajectories (probe_insertion);
+CREATE TABLE IF NOT EXISTS insertions (
+    id TEXT PRIMARY KEY, has_xyz INTEGER, resolved INTEGER, record TEXT);
+CREATE TABLE IF NOT EXISTS best (
+    probe_insertion TEXT PRIMARY KEY, trajectory TEXT, rank INTEGER);
+CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# Best trajectory of the insertions in the affected table. Ephys aligned trajectories of resolved
+# insertions rank as resolved. SQLite returns the id of the row with the maximum rank
+BEST_SQL = """
+INSERT INTO best
+SELECT t.probe_insertion, t.id,
+       MAX(CASE WHEN t.provenance = 'Ephys aligned histology track' AND i.resolved
+           THEN ? ELSE t.rank END)
+FROM trajectories t LEFT JOIN insertions i ON i.id = t.probe_insertion
+WHERE t.x IS NOT NULL AND t.probe_insertion IN (SELECT id FROM affected)
+GROUP BY t.probe_insertion
+"""
+
+
+def store_file(base_url):
+    """
+    Store file for the trajectories of an Alyx database
+    """
+    return STORE_DIR.joinpath(f'trajectories_{hashlib.md5(base_url.encode()).hexdigest()[:8]}'
+                              '.sqlite')
+
+
+def insertion_row(record):
+    qc = (record.get('json') or {}).get('extended_qc') or {}
+    return (record['id'], 'xyz_picks' in (record.get('json') or {}),
+            bool(qc.get('alignment_resolved', False)), json.dumps(record))
+
+
+class TrajectoryStore:
+    def __init__(self, rest, file=':memory:'):
+        """
+        :param rest: function to query the Alyx REST api, one.alyx.rest or a local stand-in
+        with the same signature
+        :param file: SQLite database file, kept in memory only by default
+        """
+        self.rest = rest
+        if file != ':memory:':
+            Path(file).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(file))
+        if self.get_info('version') not in [None, str(STORE_VERSION)]:
+            self.db.executescript('DROP TABLE IF EXISTS trajectories; '
+                                  'DROP TABLE IF EXISTS insertions; DROP TABLE IF EXISTS best; '
+                                  'DROP TABLE IF EXISTS info;')
+        self.db.executescript(SCHEMA)
+        self.set_info('version', STORE_VERSION)
+        self.db.commit()
+
+    def get_info(self, key):
+        try:
+            row = self.db.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def set_info(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO info VALUES (?, ?)', (key, value))
+
+    def refresh(self, full=False):
+        """
+        Update the store with the trajectories modified since the last refresh
+        :param full: download all trajectories and insertions instead of only the modified ones
+        """
+        modified = self.get_info('modified')
+        refreshed = self.get_info('refreshed')
+        if modified is None or refreshed is None or \
+                datetime.now() - datetime.fromisoformat(refreshed) > FULL_REFRESH_AGE:
+            full = True
+
+        refreshed = datetime.now().isoformat()
+        django = TRAJ_DJANGO if full else f'{TRAJ_DJANGO},datetime__gt,{modified}'
+        records = []
+        for provenance in PROV_2_VAL.keys():
+            if provenance != 'Resolved':
+                records += self.rest('trajectories', 'list', provenance=provenance,
+                                     django=django)
+
+        if full:
+            insertions = self.rest('insertions', 'list', django=INS_DJANGO)
+            self.db.execute('DELETE FROM trajectories')
+            self.db.execute('DELETE FROM insertions')
+        else:
+            ins_ids = sorted({rec['probe_insertion'] for rec in records})
+            insertions = [self.rest('insertions', 'read', id=ins_id) for ins_id in ins_ids]
+            # Alyx keeps one trajectory per insertion and provenance, a trajectory that was
+            # deleted and created again, e.g. when an alignment is uploaded, replaces the old one
+            self.db.executemany(
+                'DELETE FROM trajectories WHERE probe_insertion = ? AND provenance = ? '
+                'AND id != ?',
+                [(rec['probe_insertion'], rec['provenance'], rec['id']) for rec in records])
+
+        self.db.executemany(
+            'INSERT OR REPLACE INTO trajectories VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(rec['id'], rec['probe_insertion'], rec['provenance'], PROV_2_VAL[rec['provenance']],
+              rec['x'], rec['y'], rec.get('datetime'), json.dumps(rec)) for rec in records])
+        self.db.executemany('INSERT OR REPLACE INTO insertions VALUES (?, ?, ?, ?)',
+                            [insertion_row(ins) for ins in insertions])
+
+        # Update the best trajectory of insertions with modified trajectories
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS affected (id TEXT PRIMARY KEY)')
+        self.db.execute('DELETE FROM affected')
+        if full:
+            self.db.execute('INSERT INTO affected SELECT DISTINCT probe_insertion '
+                            'FROM trajectories')
+            self.db.execute('DELETE FROM best')
+        else:
+            self.db.executemany('INSERT OR IGNORE INTO affected VALUES (?)',
+                                [(rec['probe_insertion'],) for rec in records])
+            self.db.execute('DELETE FROM best WHERE probe_insertion IN (SELECT id FROM affected)')
+        self.db.execute(BEST_SQL, (PROV_2_VAL['Resolved'],))
+
+        modified_times = [rec['datetime'] for rec in records if rec.get('datetime')]
+        if modified_times:
+            self.set_info('modified', max(modified_times + [modified or '']))
+        elif full:
+            # Without modification times the next refresh has to download everything again
+            self.db.execute("DELETE FROM info WHERE key = 'modified'")
+        self.set_info('refreshed', refreshed)
+        self.db.commit()
+
+        return records
+
+    def trajectories(self, provenance, resolved=False):
+        """
+        Trajectories of a provenance that have coordinates
+        :param resolved: only return trajectories of insertions with a resolved alignment
+        :return: trajectory records
+        :type: list of dict
+        """
+        sql = 'SELECT t.record FROM trajectories t'
+        if resolved:
+            sql += ' JOIN insertions i ON i.id = t.probe_insertion AND i.resolved'
+        rows = self.db.execute(sql + ' WHERE t.provenance = ? AND t.x IS NOT NULL '
+                               'ORDER BY t.rowid', (provenance,))
+        return [json.loads(row[0]) for row in rows]
+
+    def insertions_with_xyz(self):
+        """
+        :return: insertion records that have xyz picks
+        :type: list of dict
+        """
+        rows = self.db.execute('SELECT record FROM insertions WHERE has_xyz ORDER BY rowid')
+        return [json.loads(row[0]) for row in rows]
+
+    def best(self, min_rank=0):
+        """
+        Best trajectory of each insertion
+        :param min_rank: only return insertions whose best trajectory has at least this rank,
+        see PROV_2_VAL
+        :return: trajectory records
+        :type: list of dict
+        """
+        rows = self.db.execute('SELECT t.record FROM best b JOIN trajectories t '
+                               'ON t.id = b.trajectory WHERE b.rank >= ? ORDER BY b.rank DESC, '
+                               't.rowid', (min_rank,))
+        return [json.loads(row[0]) for row in rows]
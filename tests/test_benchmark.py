@@ -0,0 +1,102 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from atlaselectrophysiology import benchmark, channel_table, synthetic_data
+from atlaselectrophysiology.precompute_plot_data import (
+    find_sessions, load_plot_data, precompute_session)
+import atlaselectrophysiology.plot_data as pd
+
+
+class TestSyntheticData(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_path = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_layouts(self):
+        for layout, n_shanks in zip(synthetic_data.LAYOUTS, [1, 1, 4]):
+            with self.subTest(layout=layout):
+                alf_path = synthetic_data.make_alf(self.data_path.joinpath(layout),
+                                                   n_spikes=10000, duration=60, n_clusters=20,
+                                                   layout=layout)
+                plotdata = pd.PlotData(alf_path, alf_path, n_shanks - 1)
+                self.assertEqual(plotdata.n_shanks, n_shanks)
+                self.assertTrue(plotdata.spike_data_status)
+                self.assertTrue(plotdata.cluster_data_status)
+                data, _ = plotdata.get_rms_data_img_probe('AP')
+                self.assertEqual(data['img'].shape[1], plotdata.chn_full.size)
+
+    def test_depth_groups(self):
+        # Reference channel and a channel of the second shank missing from the channels object
+        missing = [191, 300]
+        for layout, n_shanks in zip(['NP1.0', 'NP2.4'], [1, 4]):
+            with self.subTest(layout=layout):
+                chn_coords, chn_ind = synthetic_data.make_channels(layout)
+                keep = np.setdiff1d(chn_ind, missing)
+                coords, ind = pd.PlotData.get_raw_channels(chn_coords[keep], chn_ind[keep])
+                if layout == 'NP1.0':
+                    # Missing channels are placed with the probe geometry
+                    np.testing.assert_array_equal(ind, chn_ind)
+                    np.testing.assert_array_equal(coords, chn_coords)
+                else:
+                    # The channels of NP2.4 depend on the recording so can't be placed
+                    np.testing.assert_array_equal(ind, keep)
+                    np.testing.assert_array_equal(coords, chn_coords[keep])
+                chn_diff = np.min(np.diff(np.unique(chn_coords[:, 1])))
+                n_per_shank = chn_ind.size // n_shanks
+                for shank in range(n_shanks):
+                    shank_chns = ind // n_per_shank == shank
+                    groups = pd.PlotData.get_depth_groups(coords[shank_chns, 1],
+                                                          np.min(chn_coords[:, 1]), chn_diff)
+                    self.assertEqual(np.sum(groups['counts']), np.sum(shank_chns))
+                    depths = coords[shank_chns, 1][groups['index']]
+                    np.testing.assert_array_equal(np.repeat(groups['depths'], groups['counts']),
+                                                  depths)
+
+    def test_find_sessions(self):
+        alf_path = synthetic_data.make_alf(self.data_path.joinpath('subject', 'alf'),
+                                           n_spikes=1000, duration=60, n_clusters=20)
+        chn_coords = np.load(alf_path.joinpath('channels.localCoordinates.npy'))
+        table = channel_table.channel_table(np.zeros((chn_coords.shape[0], 3)), chn_coords,
+                                            {'id': np.zeros(chn_coords.shape[0]),
+                                             'acronym': np.full(chn_coords.shape[0], 'void')})
+        channel_table.save_alf(table, alf_path.joinpath('channel_locations'))
+        self.assertEqual(find_sessions(self.data_path), [alf_path])
+
+    def test_precompute_ephys_path(self):
+        # Sessions downloaded from Alyx have their raw ephys data outside the ALF folder
+        alf_path = synthetic_data.make_alf(self.data_path.joinpath('subject', 'alf', 'probe00'),
+                                           n_spikes=1000, duration=60, n_clusters=20)
+        ephys_path = self.data_path.joinpath('subject', 'raw_ephys_data', 'probe00')
+        synthetic_data.make_spikeglx(ephys_path, duration=1, band='lf')
+        self.assertEqual(precompute_session(alf_path), 'computed shanks [1]')
+        self.assertIsNotNone(load_plot_data(alf_path, ephys_path))
+        self.assertEqual(precompute_session(alf_path, ephys_path=ephys_path), 'up to date')
+        # The raw data is part of the fingerprint
+        self.assertIsNone(load_plot_data(alf_path, alf_path))
+
+    def test_benchmark(self):
+        run = benchmark.benchmark(data_path=self.data_path, n_spikes=10000, duration=60,
+                                  n_clusters=20, raw_duration=2, repeat=1, alignment=False)
+        self.assertTrue(all(res['status'] == 'ok' for res in run['results'].values()))
+        for name in ['get_rfmap_data', 'get_passive_events', 'get_psth']:
+            self.assertIn(f'PlotData.{name}', run['results'])
+        self.assertEqual(benchmark.compare_results(run['results'], run['results']), [])
+
+    def test_compare_results(self):
+        baseline = {'a': {'status': 'ok', 'duration': 1, 'peak_memory': 10},
+                    'b': {'status': 'ok', 'duration': 1, 'peak_memory': 10}}
+        results = {'a': {'status': 'ok', 'duration': 1.1, 'peak_memory': 10},
+                   'b': {'status': 'ok', 'duration': 1.5, 'peak_memory': np.float64(20)}}
+        regressions = benchmark.compare_results(results, baseline, threshold=0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(reg.startswith('b:') for reg in regressions))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
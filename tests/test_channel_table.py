@@ -0,0 +1,41 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from atlaselectrophysiology import channel_table
+
+
+class TestChannelTable(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = Path(self.tmp.name)
+        rng = np.random.default_rng(0)
+        xyz_channels = rng.uniform(-5e-3, 5e-3, (384, 3))
+        xyz_channels[5, 2] = np.nan
+        chn_coords = np.c_[np.tile([43, 11, 59, 27], 96), np.repeat(np.arange(192) * 20, 2)]
+        brain_regions = {'id': rng.integers(0, 1000, 384),
+                         'acronym': rng.choice(['CA1', 'DG-mo', 'void', 'Prosub"'], 384)}
+        self.table = channel_table.channel_table(xyz_channels, chn_coords, brain_regions)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_write_json(self):
+        extra = {'origin': {'probe': 'probe00', 'shank': [1, 2.5], 'resolved': None}}
+        file = self.folder.joinpath('channel_locations.json')
+        channel_table.write_json(self.table, file, extra=extra)
+        with open(file, 'rb') as f:
+            written = f.read()
+
+        reference = self.folder.joinpath('reference.json')
+        with open(reference, 'w') as f:
+            json.dump({**channel_table.channel_dict(self.table), **extra}, f, indent=2)
+        with open(reference, 'rb') as f:
+            self.assertEqual(written, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
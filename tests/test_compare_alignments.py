@@ -0,0 +1,85 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+from ibllib.ephys.neuropixel import SITES_COORDINATES
+
+from atlaselectrophysiology.compare_alignments import AlignmentComparison, compute_insertion
+from tests.test_probe_model import small_atlas
+
+IDENTITY = [[-0.006, 0.006], [-0.006, 0.006]]
+# Alignment that moves the channels 500 um up the track
+SHIFTED = [[-0.006, 0.006], [-0.0055, 0.0065]]
+
+
+def make_insertion(i, alignments):
+    return {'probe_insertion': f'ins{i}', 'subject': 'subj', 'date': '2021-01-01',
+            'probe_name': 'probe00', 'xyz_picks': [[-50 * j, 0, -500 * j] for j in range(1, 13)],
+            'depths': SITES_COORDINATES[:, 1].tolist(), 'alignments': alignments}
+
+
+class LocalOne:
+    """
+    Stand-in for ONE that serves aligned trajectories, insertions and the channels of sessions
+    """
+    def __init__(self, trajectories, insertions, channels):
+        self.trajectories = trajectories
+        self.insertions = insertions
+        self.channels = channels
+        self.alyx = mock.Mock(rest=self.rest)
+
+    def rest(self, url, action, id=None, **kwargs):
+        if url == 'insertions':
+            return self.insertions[id]
+        return self.trajectories
+
+    def load_dataset(self, eid, dataset, collection=None):
+        if (eid, collection) not in self.channels:
+            raise FileNotFoundError(f'{dataset} not found')
+        return self.channels[(eid, collection)]
+
+
+class TestCompareAlignments(unittest.TestCase):
+    def setUp(self):
+        self.brain_atlas = small_atlas()
+
+    def test_compute_insertion(self):
+        insertion = make_insertion(0, {'2021-01-01T00:00:00_user1': IDENTITY,
+                                       '2021-01-02T00:00:00_user2': SHIFTED})
+        results = compute_insertion(insertion, brain_atlas=self.brain_atlas)
+        self.assertEqual(set(results.keys()), {'original', *insertion['alignments'].keys()})
+        for res in results.values():
+            self.assertEqual(res['xyz_channels'].shape, (SITES_COORDINATES.shape[0], 3))
+            self.assertEqual(res['region_id'].size, SITES_COORDINATES.shape[0])
+        np.testing.assert_allclose(results['2021-01-01T00:00:00_user1']['xyz_channels'],
+                                   results['original']['xyz_channels'])
+
+        scores = AlignmentComparison.score([insertion], {'ins0': results})
+        self.assertEqual(list(scores['user']), ['user1', 'user2'])
+        self.assertAlmostEqual(scores['dist_original'][0], 0)
+        self.assertTrue(400 < scores['dist_original'][1] < 600)
+        self.assertAlmostEqual(scores['dist_others'][0], scores['dist_others'][1])
+        self.assertTrue(np.all((scores['region_agreement'] >= 0) &
+                               (scores['region_agreement'] <= 1)))
+
+    def test_get_insertions(self):
+        trajectories = [{'probe_insertion': f'ins{i}', 'probe_name': 'probe00',
+                         'session': {'id': f'eid{i}', 'subject': 'subj',
+                                     'start_time': '2021-01-01T10:00:00'},
+                         'json': {'2021-01-01T00:00:00_user1': IDENTITY}} for i in range(2)]
+        insertions = {f'ins{i}': {'json': {'xyz_picks': make_insertion(i, {})['xyz_picks']}}
+                      for i in range(2)}
+        chn_coords = np.c_[np.tile([0, 32], 192), np.repeat(np.arange(192) * 15, 2)]
+        one = LocalOne(trajectories, insertions, {('eid0', 'alf/probe00'): chn_coords})
+        comparison = AlignmentComparison(one=one, brain_atlas=self.brain_atlas, cache_dir=None)
+
+        depths = [ins['depths'] for ins in comparison.get_insertions()]
+        # The geometry of the session is used when available
+        np.testing.assert_array_equal(depths[0], chn_coords[:, 1])
+        np.testing.assert_array_equal(depths[1], SITES_COORDINATES[:, 1])
+        depths = [ins['depths'] for ins in comparison.get_insertions(load_channels=False)]
+        np.testing.assert_array_equal(depths[0], SITES_COORDINATES[:, 1])
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,70 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from ibllib.atlas import BrainAtlas, BrainRegions
+
+from needles2 import probe_model
+from tests.test_trajectory_store import LocalRest, make_trajectory, make_insertion
+
+
+class LocalOne:
+    """
+    Stand-in for ONE that only has the alyx rest function
+    """
+    def __init__(self, rest):
+        self.alyx = mock.Mock(rest=rest, _base_url='http://localhost')
+
+
+def small_atlas():
+    """
+    Atlas of 4 x 4 x 8 mm with bregma at the centre of the top surface and two regions along dv
+    """
+    label = np.zeros((40, 40, 80), dtype=np.int16)
+    label[:, :, 5:40] = 5
+    label[:, :, 40:75] = 10
+    return BrainAtlas(np.zeros(label.shape, dtype=np.float32), label,
+                      np.array([1, -1, -1]) * 100e-6, BrainRegions(), iorigin=[20, 20, 0])
+
+
+class TestProbeModel(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        patches = [mock.patch('needles2.probe_model.CACHE_DIR', Path(self.tmp.name)),
+                   mock.patch('needles2.trajectory_store.STORE_DIR', Path(self.tmp.name))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_aligned_channels(self):
+        """
+        The channels of aligned trajectories are computed in the worker processes, which need the
+        label volume of the atlas
+        """
+        ins = make_insertion(0)
+        ins['json']['xyz_picks'] = [[-50 * i, 0, -500 * i] for i in range(1, 13)]
+        ins['json']['extended_qc']['alignment_stored'] = '2021-01-01T00:00:00_user'
+        traj = make_trajectory(0, 'Ephys aligned histology track', 'ins0')
+        traj['json'] = {'2021-01-01T00:00:00_user': [[-0.006, 0.006], [-0.006, 0.006]]}
+        rest = LocalRest([traj], [ins])
+        model = probe_model.ProbeModel(one=LocalOne(rest), ba=small_atlas(), lazy=True)
+        model.initialise()
+
+        channels = model.get_all_channels('Ephys aligned histology track', n_workers=1)
+        self.assertEqual(channels.shape, (probe_model.SITES_COORDINATES.shape[0], 3))
+        # Each channel lies on the line through the picks
+        np.testing.assert_allclose(channels[:, 0], channels[:, 2] / 10, atol=1e-9)
+        # The channels are cached so they aren't computed again
+        with mock.patch('needles2.probe_model.ProcessPoolExecutor') as executor:
+            cached = model.get_all_channels('Ephys aligned histology track', n_workers=1)
+        executor.assert_not_called()
+        np.testing.assert_array_equal(cached, channels)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
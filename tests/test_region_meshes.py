@@ -0,0 +1,77 @@
+import tempfile
+import types
+import unittest
+from pathlib import Path
+
+import vtk
+
+from atlaselectrophysiology import region_meshes
+from atlaselectrophysiology.region_meshes import RegionMesh, RegionMeshes
+
+
+def write_sphere(file, radius=1000, resolution=100):
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(radius)
+    sphere.SetThetaResolution(resolution)
+    sphere.SetPhiResolution(resolution)
+    sphere.Update()
+    writer = vtk.vtkOBJWriter()
+    writer.SetFileName(str(file))
+    writer.SetInputData(sphere.GetOutput())
+    writer.Write()
+    return sphere.GetOutput().GetNumberOfPolys()
+
+
+class TestRegionMeshes(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.obj_file = Path(self.tmp.name).joinpath('region.obj')
+        self.n_triangles = write_sphere(self.obj_file)
+        self.cache_dir = Path(self.tmp.name).joinpath('cache')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_levels(self):
+        mesh = RegionMesh(self.obj_file, cache_dir=self.cache_dir)
+        n_triangles = [mesh.get(level).GetNumberOfPolys()
+                       for level in range(len(region_meshes.LOD_REDUCTION))]
+        self.assertEqual(n_triangles[0], self.n_triangles)
+        for n, reduction in zip(n_triangles, region_meshes.LOD_REDUCTION):
+            self.assertAlmostEqual(n / self.n_triangles, 1 - reduction, delta=0.02)
+        self.assertEqual(len(list(self.cache_dir.glob('*.vtp'))),
+                         len(region_meshes.LOD_REDUCTION))
+        # A new mesh reads the levels from the cache
+        self.assertEqual(RegionMesh(self.obj_file, cache_dir=self.cache_dir).get(2)
+                         .GetNumberOfPolys(), n_triangles[2])
+
+    def test_render(self):
+        renderer = vtk.vtkRenderer()
+        window = vtk.vtkRenderWindow()
+        window.SetOffScreenRendering(1)
+        window.AddRenderer(renderer)
+        window.SetSize(400, 400)
+        # Stand-in for the parts of a mayavi figure that are used
+        fig = types.SimpleNamespace(scene=types.SimpleNamespace(
+            renderer=types.SimpleNamespace(_vtk_obj=renderer), add_actor=renderer.AddActor))
+
+        meshes = RegionMeshes(fig, cache_dir=self.cache_dir)
+        meshes.add(self.obj_file, name='region')
+        renderer.ResetCamera()
+        camera = renderer.GetActiveCamera()
+        camera.Dolly(1.5)
+        window.Render()
+        # Filling the window the full mesh is shown
+        self.assertEqual(meshes.regions['region']['level'], 0)
+
+        # Far away the coarsest mesh is shown
+        camera.Dolly(0.02)
+        window.Render()
+        self.assertEqual(meshes.regions['region']['level'], len(region_meshes.LOD_REDUCTION) - 1)
+        self.assertEqual(meshes.regions['region']['actor'].GetMapper().GetInput()
+                         .GetNumberOfPolys(),
+                         RegionMesh(self.obj_file, self.cache_dir).get(3).GetNumberOfPolys())
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+from scipy.interpolate import interp1d
+
+from atlaselectrophysiology.get_scale_factor import scale_regions
+
+
+def scale_regions_loop(region, feature, track):
+    """
+    Scale factors computed one region at a time as in EphysAlignment.get_scale_factor
+    """
+    region_feature = interp1d(track, feature, fill_value='extrapolate')(region) * 1e6
+    scale = []
+    for reg, reg_orig in zip(region_feature, region * 1e6):
+        scale = np.r_[scale, (reg[1] - reg[0]) / (reg_orig[1] - reg_orig[0])]
+    boundaries = np.where(np.diff(np.around(scale, 3)))[0]
+    if boundaries.size == 0:
+        return np.array([[region_feature[0][0], region_feature[-1][1]]]), np.unique(scale)
+    scaled_region = np.empty((boundaries.size + 1, 2))
+    scale_factor = []
+    for iB, b in enumerate(boundaries):
+        scaled_region[iB, 1] = region_feature[b][1]
+        scaled_region[iB, 0] = region_feature[0][0] if iB == 0 else \
+            region_feature[boundaries[iB - 1]][1]
+        scale_factor = np.r_[scale_factor, scale[b]]
+    scaled_region[-1, 0] = region_feature[boundaries[-1]][1]
+    scaled_region[-1, 1] = region_feature[-1][1]
+    return scaled_region, np.r_[scale_factor, scale[-1]]
+
+
+class TestScaleFactor(unittest.TestCase):
+    def test_scale_regions(self):
+        rng = np.random.default_rng(0)
+        bounds = np.r_[0, np.cumsum(rng.uniform(50, 500, 20))] / 1e6 - 2e-3
+        region = np.c_[bounds[:-1], bounds[1:]]
+        for n_lines in [0, 2, 3, 6]:
+            track = np.sort(np.r_[bounds[0] - 1e-3, rng.uniform(bounds[0], bounds[-1], n_lines),
+                                  bounds[-1] + 1e-3])
+            feature = track + np.cumsum(rng.uniform(-1, 1, track.size)) * 1e-4
+            if n_lines == 0:
+                feature = track + 2e-4
+            scaled_region, scale_factor = scale_regions(region, feature, track)
+            scaled_region_loop, scale_factor_loop = scale_regions_loop(region, feature, track)
+            np.testing.assert_allclose(scaled_region, scaled_region_loop)
+            np.testing.assert_allclose(scale_factor, scale_factor_loop)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,103 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from atlaselectrophysiology.trajectory_cache import TrajectoryCache
+
+
+class LocalRest:
+    """
+    Stand-in for one.alyx.rest that serves the trajectories list endpoint from a json file
+    """
+    def __init__(self, file):
+        self.file = file
+        self.queries = []
+
+    def __call__(self, url, action, provenance=None, django=None):
+        self.queries.append(django)
+        with open(self.file, 'r') as f:
+            records = [rec for rec in json.load(f) if rec['provenance'] == provenance]
+        if django is not None:
+            field, value = django.split(',')
+            records = [rec for rec in records if rec['datetime'] > value]
+        return records
+
+
+def make_trajectory(i, rng, modified='2021-01-01T00:00:00'):
+    return {'id': f'traj{i}', 'provenance': 'Histology track', 'datetime': modified,
+            'x': rng.uniform(-3000, 3000), 'y': rng.uniform(-4000, 2000), 'z': 0,
+            'depth': 4000, 'theta': rng.uniform(0, 20), 'phi': 180, 'probe_name': 'probe00',
+            'session': {'subject': f'subj{i % 5}', 'start_time': '2021-01-01T10:00:00'}}
+
+
+class TestTrajectoryCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rest_file = Path(self.tmp.name).joinpath('trajectories.json')
+        self.cache_file = Path(self.tmp.name).joinpath('cache.npz')
+        rng = np.random.default_rng(0)
+        self.records = [make_trajectory(i, rng) for i in range(200)]
+        self.records[3]['x'] = None
+        self.write_records()
+        self.rest = LocalRest(self.rest_file)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_records(self):
+        with open(self.rest_file, 'w') as f:
+            json.dump(self.records, f)
+
+    def test_incremental_refresh(self):
+        cache = TrajectoryCache(self.rest, file=self.cache_file)
+        self.assertEqual(len(cache.refresh()), 199)
+        self.assertNotIn('traj3', cache.ids)
+
+        # Move one trajectory, remove the tracing of another and add a new one
+        rng = np.random.default_rng(1)
+        self.records[0]['x'] += 500
+        self.records[0]['datetime'] = '2021-02-01T00:00:00'
+        self.records[1]['x'] = None
+        self.records[1]['datetime'] = '2021-02-01T00:00:00'
+        self.records.append(make_trajectory(200, rng, modified='2021-02-01T00:00:00'))
+        self.write_records()
+
+        cache = TrajectoryCache(self.rest, file=self.cache_file)
+        self.assertEqual(len(cache.ids), 199)
+        cache.refresh()
+        self.assertEqual(self.rest.queries[-1], 'datetime__gt,2021-01-01T00:00:00')
+        self.assertEqual(len(cache.ids), 199)
+        self.assertNotIn('traj1', cache.ids)
+        self.assertIn('traj200', cache.ids)
+
+        full = TrajectoryCache(self.rest)
+        full.refresh()
+        order = [full.ids.index(traj_id) for traj_id in cache.ids]
+        np.testing.assert_allclose(cache.coords, full.coords[order])
+
+    def test_refresh_without_changes(self):
+        cache = TrajectoryCache(self.rest, file=self.cache_file)
+        cache.refresh()
+        for _ in range(2):
+            cache = TrajectoryCache(self.rest, file=self.cache_file)
+            cache.refresh()
+            self.assertEqual(self.rest.queries[-1], 'datetime__gt,2021-01-01T00:00:00')
+            self.assertEqual(cache.modified, '2021-01-01T00:00:00')
+            self.assertEqual(len(cache.ids), 199)
+
+    def test_nearby(self):
+        cache = TrajectoryCache(self.rest)
+        cache.refresh()
+        for traj_id in cache.ids[:20]:
+            idx, dist, dist_mlap = cache.nearby(traj_id, n=10)
+            chosen = cache.coords[cache.ids.index(traj_id)]
+            avg_dist = np.mean(np.sqrt(np.sum((cache.coords - chosen) ** 2, axis=2)), axis=1)
+            np.testing.assert_allclose(dist, np.sort(avg_dist)[:10])
+            self.assertEqual(cache.ids[idx[0]], traj_id)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,98 @@
+import unittest
+
+from needles2.trajectory_store import TrajectoryStore
+
+
+class LocalRest:
+    """
+    Stand-in for one.alyx.rest that serves the trajectories and insertions endpoints from lists
+    of records
+    """
+    def __init__(self, trajectories, insertions):
+        self.trajectories = trajectories
+        self.insertions = insertions
+        self.queries = []
+
+    def __call__(self, url, action, provenance=None, django=None, id=None):
+        self.queries.append((url, action, django))
+        if url == 'insertions':
+            if action == 'read':
+                return next(ins for ins in self.insertions if ins['id'] == id)
+            return self.insertions
+        records = [rec for rec in self.trajectories if rec['provenance'] == provenance]
+        if 'datetime__gt' in django:
+            modified = django.split('datetime__gt,')[1]
+            records = [rec for rec in records if rec['datetime'] > modified]
+        return records
+
+
+def make_trajectory(i, provenance, ins, modified='2021-01-01T00:00:00'):
+    return {'id': f'traj{i}', 'probe_insertion': ins, 'provenance': provenance,
+            'datetime': modified, 'x': 100. * i, 'y': -100. * i, 'json': None}
+
+
+def make_insertion(i, xyz=True, resolved=False):
+    json = {'extended_qc': {'alignment_resolved': resolved}}
+    if xyz:
+        json['xyz_picks'] = [[0, 0, 0], [0, 0, -4000]]
+    return {'id': f'ins{i}', 'json': json}
+
+
+class TestTrajectoryStore(unittest.TestCase):
+    def setUp(self):
+        self.trajectories = [make_trajectory(0, 'Planned', 'ins0'),
+                             make_trajectory(1, 'Micro-manipulator', 'ins0'),
+                             make_trajectory(2, 'Planned', 'ins1'),
+                             make_trajectory(3, 'Histology track', 'ins1'),
+                             make_trajectory(4, 'Ephys aligned histology track', 'ins1'),
+                             make_trajectory(5, 'Planned', 'ins2')]
+        self.insertions = [make_insertion(0, xyz=False), make_insertion(1, resolved=True),
+                           make_insertion(2, xyz=False)]
+        self.rest = LocalRest(self.trajectories, self.insertions)
+        self.store = TrajectoryStore(self.rest)
+
+    def best(self, min_rank=0):
+        return {traj['probe_insertion']: traj['id'] for traj in self.store.best(min_rank)}
+
+    def test_refresh(self):
+        self.store.refresh()
+        self.assertEqual(self.best(), {'ins0': 'traj1', 'ins1': 'traj4', 'ins2': 'traj5'})
+        self.assertEqual(self.best(min_rank=90), {'ins1': 'traj4'})
+        self.assertEqual([ins['id'] for ins in self.store.insertions_with_xyz()], ['ins1'])
+        self.assertEqual(len(self.store.trajectories('Ephys aligned histology track',
+                                                     resolved=True)), 1)
+
+        # Trace the histology of ins2 and remove the coordinates of the micro-manipulator
+        # trajectory of ins0, only these are downloaded on the next refresh
+        self.trajectories.append(make_trajectory(6, 'Histology track', 'ins2',
+                                                 modified='2021-02-01T00:00:00'))
+        self.insertions[2] = make_insertion(2)
+        self.trajectories[1]['x'] = None
+        self.trajectories[1]['datetime'] = '2021-02-01T00:00:00'
+        n_queries = len(self.rest.queries)
+        records = self.store.refresh()
+
+        self.assertEqual(len(records), 2)
+        for url, action, django in self.rest.queries[n_queries:]:
+            if url == 'trajectories':
+                self.assertTrue(django.endswith('datetime__gt,2021-01-01T00:00:00'))
+            else:
+                self.assertEqual(action, 'read')
+        self.assertEqual(self.best(), {'ins0': 'traj0', 'ins1': 'traj4', 'ins2': 'traj6'})
+        self.assertEqual([ins['id'] for ins in self.store.insertions_with_xyz()],
+                         ['ins1', 'ins2'])
+
+    def test_reupload(self):
+        self.store.refresh()
+        # Uploading an alignment deletes the aligned trajectory and creates a new one
+        self.trajectories.pop(4)
+        self.trajectories.append(make_trajectory(7, 'Ephys aligned histology track', 'ins1',
+                                                 modified='2021-02-01T00:00:00'))
+        self.store.refresh()
+        self.assertEqual([traj['id'] for traj in
+                          self.store.trajectories('Ephys aligned histology track')], ['traj7'])
+        self.assertEqual(self.best(), {'ins0': 'traj1', 'ins1': 'traj7', 'ins2': 'traj5'})
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
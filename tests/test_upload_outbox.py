@@ -0,0 +1,163 @@
+import tempfile
+import unittest
+import uuid
+
+from atlaselectrophysiology import upload_outbox
+from atlaselectrophysiology.upload_outbox import UploadOutbox
+
+
+class MockAlyx:
+    """
+    In memory stand-in for the trajectories and channels endpoints of Alyx. Requests fail while
+    fail_next is above 0 to simulate a flaky connection
+    """
+    def __init__(self):
+        self.trajectories = {}
+        self.channels = []
+        self.requests = []
+        self.fail_next = 0
+
+    def rest(self, url, action, id=None, data=None, **kwargs):
+        self.requests.append((url, action))
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            raise ConnectionError('mock connection error')
+        if url == 'trajectories' and action == 'list':
+            return [traj for traj in self.trajectories.values()
+                    if all(traj[key] == val for key, val in kwargs.items())]
+        if url == 'trajectories' and action == 'create':
+            traj = dict(data, id=str(uuid.uuid4()))
+            self.trajectories[traj['id']] = traj
+            return traj
+        if url == 'trajectories' and action == 'delete':
+            self.trajectories.pop(id)
+            self.channels = [chn for chn in self.channels if chn['trajectory_estimate'] != id]
+            return
+        if url == 'trajectories' and action == 'partial_update':
+            self.trajectories[id].update(data)
+            return self.trajectories[id]
+        if url == 'channels' and action == 'create':
+            self.channels += data
+            return data
+        raise ValueError(f'{url} {action} not supported')
+
+
+class TestUploadOutbox(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.alyx = MockAlyx()
+        self.qc_calls = []
+        self.steps = [
+            {'type': 'trajectory', 'data': {'probe_insertion': 'probe', 'x': 100.0,
+                                            'provenance': 'Ephys aligned histology track',
+                                            'json': {'2021-01-01T00:00:00_user': [[0], [0]]}}},
+            {'type': 'channels', 'data': [{'x': float(i), 'axial': 20.0 * i}
+                                          for i in range(2500)]},
+            {'type': 'qc', 'data': {'probe_id': 'probe'}}]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def outbox(self, max_attempts=3):
+        return UploadOutbox(self.alyx.rest, folder=self.tmp.name, max_attempts=max_attempts,
+                            retry_delay=0, handlers={'qc': self.run_qc})
+
+    def run_qc(self, data, results, step):
+        self.qc_calls.append(data)
+        return {'resolved': 0}
+
+    def test_send(self):
+        outbox = self.outbox()
+        done = []
+        outbox.add(self.steps, info={'type': 'alignment'})
+        outbox.flush(on_done=lambda *args: done.append(args))
+
+        self.assertEqual(outbox.pending(), [])
+        self.assertEqual(len(done), 1)
+        self.assertEqual(done[0][1], {'type': 'alignment'})
+        self.assertEqual(done[0][2]['resolved'], 0)
+        self.assertEqual(len(self.alyx.trajectories), 1)
+        traj_id = done[0][2]['trajectory_id']
+        self.assertEqual(len(self.alyx.channels), 2500)
+        self.assertTrue(all(chn['trajectory_estimate'] == traj_id for chn in self.alyx.channels))
+        n_batches = -(-2500 // upload_outbox.CHANNEL_BATCH_SIZE)
+        self.assertEqual(self.alyx.requests.count(('channels', 'create')), n_batches)
+
+        # Uploading again replaces the trajectory and its channels
+        outbox.add(self.steps)
+        outbox.flush()
+        self.assertEqual(len(self.alyx.trajectories), 1)
+        self.assertEqual(len(self.alyx.channels), 2500)
+
+    def test_retry(self):
+        self.alyx.fail_next = 2
+        outbox = self.outbox(max_attempts=3)
+        outbox.add(self.steps)
+        outbox.flush()
+        self.assertEqual(outbox.pending(), [])
+        self.assertEqual(len(self.alyx.channels), 2500)
+
+    def test_order(self):
+        outbox = self.outbox(max_attempts=1)
+        first = outbox.add(self.steps)
+        steps = [dict(step) for step in self.steps]
+        steps[0] = {'type': 'trajectory', 'data': dict(self.steps[0]['data'], x=200.0)}
+        second = outbox.add(steps)
+
+        # The newer job is not sent while the older one fails
+        self.alyx.fail_next = 1
+        outbox.flush()
+        self.assertEqual(outbox.pending(), [first, second])
+        self.assertEqual(self.alyx.requests, [('trajectories', 'list')])
+
+        outbox.flush()
+        self.assertEqual(outbox.pending(), [])
+        self.assertEqual([traj['x'] for traj in self.alyx.trajectories.values()], [200.0])
+
+    def test_find(self):
+        outbox = self.outbox()
+        first = outbox.add(self.steps, info={'type': 'alignment', 'probe_id': 'probe'})
+        outbox.add(self.steps, info={'type': 'alignment', 'probe_id': 'other'})
+        outbox.add(self.steps, info={'type': 'dj', 'probe_id': 'probe'})
+        self.assertEqual(outbox.find(type='alignment', probe_id='probe'), [first])
+        outbox.flush()
+        self.assertEqual(outbox.find(type='alignment', probe_id='probe'), [])
+
+    def test_resume(self):
+        outbox = self.outbox(max_attempts=1)
+        job_id = outbox.add(self.steps)
+        failed = []
+        # Fail the second channel batch, the job stays in the outbox
+        alyx_rest = self.alyx.rest
+
+        def flaky_rest(url, action, **kwargs):
+            if url == 'channels' and self.alyx.requests.count(('channels', 'create')) == 1:
+                self.alyx.requests.append((url, action))
+                raise ConnectionError('mock connection error')
+            return alyx_rest(url, action, **kwargs)
+
+        outbox.rest = flaky_rest
+        outbox.flush(on_failed=lambda *args: failed.append(args))
+        self.assertEqual(outbox.pending(), [job_id])
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(self.qc_calls, [])
+
+        # A new outbox, e.g. after restarting the GUI, resumes from the failed batch
+        outbox = self.outbox()
+        outbox.flush()
+        self.assertEqual(outbox.pending(), [])
+        self.assertEqual(len(self.alyx.trajectories), 1)
+        self.assertEqual(self.alyx.requests.count(('trajectories', 'create')), 1)
+        self.assertEqual(len(self.alyx.channels), 2500)
+        self.assertEqual(len(self.qc_calls), 1)
+
+    def test_outbox_folder(self):
+        base_url = 'https://alyx.internationalbrainlab.org'
+        folder = upload_outbox.outbox_folder(base_url)
+        self.assertEqual(folder, upload_outbox.outbox_folder(base_url))
+        self.assertNotEqual(folder, upload_outbox.outbox_folder('https://dev.alyx.org'))
+        self.assertEqual(folder.parent, upload_outbox.OUTBOX_DIR)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)